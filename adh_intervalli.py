@@ -0,0 +1,214 @@
+"""
+Pagina "Aderenza a intervalli" condivisa da adh_v17.py (denominatore = periodo
+di osservazione) e adh_v17_persistenza.py (denominatore = persistenza reale):
+stessi input, calcolo (core.adherence.adh_intervalli), grafici ed export;
+cambiano solo il denominatore, il nome nell'archivio risultati e le note.
+"""
+import streamlit as st
+import pandas as pd
+
+from core import adherence, cohort, ingestion, jobs, lazy, perf, plots, store
+import ui
+
+# denominatore → (nome di pagina/archivio, note sul calcolo dell'aderenza)
+VARIANTI = {
+    "periodo": ("adh_v17", """
+- **Metodo**: *Intervalli pesati sul periodo* (stile agent).
+- **Periodo**: da prima dispensazione del paziente/terapia per **{period_days}** giorni.
+- **Per intervallo**: `coperti_i = min(giorni_coperti, durata_intervallo)`; ultimo intervallo troncato a fine periodo.
+- **Aderenza**: `ADH_anno = (Σ coperti_i) / {period_days}` (limitata a [0,1]).
+- **Riepilogo**: Media, DS, N e % ≥ soglia per **{group_by_col}**.
+"""),
+    "persistenza": ("adh_v17_persistenza", """
+- **Metodo**: *Intervalli pesati sulla persistenza reale*.
+- **Periodo**: da prima dispensazione del paziente/terapia per **{period_days}** giorni.
+- **Per intervallo**: `coperti_i = min(giorni_coperti, durata_intervallo)`; ultimo intervallo troncato a fine periodo.
+- **Persistenza**: dalla prima dispensazione all'ultimo giorno coperto, troncata a fine periodo.
+- **Aderenza**: `ADH_anno = (Σ coperti_i) / giorni di persistenza` (limitata a [0,1]; 0 senza copertura).
+- **Riepilogo**: Media, DS, N e % ≥ soglia per **{group_by_col}**.
+"""),
+}
+
+
+@st.cache_data(show_spinner=False)
+def _read_any(file_bytes: bytes, name: str) -> pd.DataFrame:
+    """Legge CSV (auto-sep, fallback ;) o XLSX, con cache."""
+    return ingestion.read_any(file_bytes, name)
+
+
+def pagina(denominatore):
+    """Esegue la pagina con il denominatore dell'aderenza scelto (`periodo` o `persistenza`)."""
+    nome, note = VARIANTI[denominatore]
+    st.set_page_config(page_title="Aderenza - Intervalli (stile agent)", layout="wide")
+    st.title("📊 Aderenza a Intervalli (stile agent) + Export Excel")
+    prof = perf.Profiler(nome)
+
+    # ---------------- Inputs ----------------
+    disp_file = st.file_uploader("Carica DISPENSAZIONI (xlsx/csv)", type=["xlsx", "csv"])
+    ddd_file  = st.file_uploader("Carica LOOKUP DDD giornaliera (xlsx/csv)", type=["xlsx", "csv"])
+
+    c1, c2, c3 = st.columns([1,1,1])
+    with c1:
+        period_days = st.number_input("Periodo di osservazione (giorni)", min_value=30, max_value=2000, value=365, step=30)
+    with c2:
+        thr = st.slider("Soglia per % aderenti (≥)", 0.50, 1.00, 0.80, 0.05)
+    with c3:
+        dedup = st.checkbox("Somma duplicati stesso giorno/paziente/terapia", value=True)
+    motore_tabellare = ui.engine_select()
+
+    if disp_file and ddd_file:
+        with prof.stage("lettura file") as fase:
+            disp = _read_any(disp_file.getvalue(), disp_file.name)
+            ddd  = _read_any(ddd_file.getvalue(),  ddd_file.name)
+            fase.out(disp)
+
+        st.subheader("Anteprima dispensazioni")
+        st.dataframe(disp.head())
+        st.subheader("Anteprima lookup DDD")
+        st.dataframe(ddd.head())
+
+        # --- Select columns (DISP) ---
+        col_cf   = st.selectbox("Colonna codice fiscale (DISP)", disp.columns)
+        sugg = next((c for c in disp.columns if "Principio" in c or "ATC" in c or "terap" in c.lower()), disp.columns[0])
+        col_ther = st.selectbox("Colonna terapia/gruppo (DISP, es. Principio Attivo)", disp.columns, index=list(disp.columns).index(sugg))
+        col_keyD = st.selectbox("Colonna CHIAVE per join con lookup (DISP)", disp.columns)
+        col_date = st.selectbox("Colonna data erogazione (DISP)", disp.columns)
+        col_dddE = st.selectbox("Colonna DDD erogate (DISP)", disp.columns)
+
+        # --- Select columns (DDD) ---
+        col_keyL = st.selectbox("Colonna CHIAVE nel lookup (DDD)", ddd.columns)
+        sugg_std = next((c for c in ddd.columns if "std" in c.lower() or "standard" in c.lower()), ddd.columns[-1])
+        col_std  = st.selectbox("Colonna DDD_standard_giornaliera (DDD)", ddd.columns, index=list(ddd.columns).index(sugg_std))
+
+        # --- Colonna per stratificazione (es. Principio Attivo) ---
+        group_candidate_cols = [c for c in disp.columns if c not in {col_cf, col_date, col_dddE}]
+        group_by_col = st.selectbox(
+            "Stratifica e riepiloga per:",
+            group_candidate_cols,
+            index=(group_candidate_cols.index(col_ther) if col_ther in group_candidate_cols else 0)
+        )
+
+        if len({col_cf, col_ther, col_keyD, col_date, col_dddE}) < 5 or col_std == col_keyL:
+            st.info("Scegli colonne distinte per codice fiscale, terapia, chiave, data e DDD (e per chiave/DDD_standard nel lookup)."); st.stop()
+
+        # archivio su disco: stesso file, mappatura, parametri e motore → nessun ricalcolo
+        params = dict(col_cf=col_cf, col_ther=col_ther, col_keyD=col_keyD, col_date=col_date, col_dddE=col_dddE,
+                      col_keyL=col_keyL, col_std=col_std, group_by_col=group_by_col, period_days=int(period_days),
+                      dedup=bool(dedup), motore_tabellare=motore_tabellare)
+        motore = store.engine_version(adherence, cohort, ingestion, lazy, __file__)
+        file_hashes = [ingestion.file_hash(disp_file.getvalue()), ingestion.file_hash(ddd_file.getvalue())]
+        skey = store.key(nome, file_hashes, params, motore)
+        with prof.stage("lettura archivio risultati"):
+            salvato = store.load(skey)
+        if salvato is None:
+            # coda del server (core.jobs): con altri calcoli pesanti in corso si attende il turno
+            attesa = st.empty()
+            with jobs.shared().slot(jobs.estimate_mb(*disp.shape), "Aderenza a intervalli",
+                                    on_wait=lambda pos: attesa.info(f"⏳ Server occupato: analisi in coda, posizione {pos}")):
+                attesa.empty()
+                # --- Cleanup & join ---
+                with prof.stage("parsing date", disp) as fase:
+                    disp = fase.out(ingestion.parse_dates(disp, col_date))
+                with prof.stage("join lookup DDD", disp) as fase:
+                    disp, miss_key = cohort.join_ddd_lookup(disp, ddd, col_keyD, col_keyL, col_std, col_dddE)
+                    fase.out(disp)
+
+                # --- Dedup opzionale ROBUSTA (evita collisioni reset_index) ---
+                if dedup:
+                    with prof.stage("somma duplicati", disp) as fase:
+                        disp = fase.out(lazy.dedup_same_day(disp, [col_cf, col_ther, "__KEY__", col_date],
+                                                            engine=motore_tabellare))
+
+                # ---------------- CALCOLO A INTERVALLI (denominatore della variante) ----------------
+                with prof.stage("aderenza a intervalli", disp) as fase:
+                    res = fase.out(adherence.adh_intervalli(disp, col_cf, col_ther, col_date, period_days, denominatore=denominatore))
+
+                # ---------------- STRATIFICAZIONE (definitiva, no conflitti) ----------------
+                with prof.stage("stratificazione", res) as fase:
+                    if group_by_col in (col_cf, col_ther):
+                        # Già presente in res → niente merge
+                        out = res.copy()
+                    else:
+                        s = cohort.group_mode(disp, [col_cf, col_ther], group_by_col)
+                        tmp_name = "__strat_tmp__"
+                        strat_map = s.rename(tmp_name).reset_index()  # DF senza conflitti
+                        out = res.merge(strat_map, on=[col_cf, col_ther], how="left")
+                        # Rinomina sicura
+                        if tmp_name in out.columns:
+                            if group_by_col in out.columns and group_by_col not in (col_cf, col_ther):
+                                out.drop(columns=[group_by_col], inplace=True, errors="ignore")
+                            out.rename(columns={tmp_name: group_by_col}, inplace=True)
+                    fase.out(out)
+            salvato = dict(res=res, out=out, miss_key=int(miss_key))
+            store.save(skey, salvato, nome, f"{disp_file.name} • {period_days} gg • {group_by_col}", params, motore)
+        res, out = salvato["res"], salvato["out"]
+        if salvato["miss_key"] > 0:
+            st.warning(f"⚠️ {salvato['miss_key']} righe senza DDD_standard_giornaliera → escluse")
+
+        # ---------------- OUTPUT: per paziente × terapia ----------------
+        st.subheader("📂 Risultati per paziente × terapia (Intervalli)")
+        if res.empty:
+            st.info("Nessun risultato nel periodo selezionato."); st.stop()
+        ui.result_table(res, "adh_paziente")  # solo la pagina visibile; completa nell'Excel
+
+        # ---------------- RIEPILOGO STRATIFICATO ----------------
+        with prof.stage("riepilogo stratificato", out) as fase:
+            summary = fase.out(lazy.riepilogo_adh(out, group_by_col, thr, engine=motore_tabellare))
+
+        st.subheader(f"📊 Riepilogo per **{group_by_col}**")
+        st.dataframe(summary)
+
+        # ---------------- GRAFICI ----------------
+        st.subheader(f"📉 Dispersione per {group_by_col}")
+        # box da statistiche precalcolate; punti solo come campione stratificato
+        mostra_punti = st.checkbox(f"Mostra punti (campione stratificato, max {plots.POINTS_BUDGET:,})", value=True)
+        with prof.stage("figura box plot", out):
+            fig_box = plots.box_figure(out, group_by_col, "ADH_anno", points=mostra_punti, boxmean="sd")  # media + DS
+            fig_box.add_hline(y=thr, line_dash="dash", line_color="black", annotation_text=f"Soglia={thr:.2f}")
+            fig_box.update_layout(yaxis_title="ADH_anno", xaxis_title=group_by_col)
+        with prof.stage("rendering box plot"):
+            st.plotly_chart(fig_box, use_container_width=True)
+
+        st.subheader("📈 Dispersione complessiva")
+        media = float(out["ADH_anno"].mean()); vmin = float(out["ADH_anno"].min()); vmax = float(out["ADH_anno"].max())
+        # conteggi per classe lato server; i singoli punti (WebGL) solo su richiesta
+        vista = st.radio("Vista dispersione", plots.DISPERSION_MODES, horizontal=True,
+                         index=plots.DISPERSION_MODES.index(plots.POINTS if len(out) <= plots.POINTS_BUDGET else plots.DENSITY))
+        with prof.stage("figura dispersione", out):
+            fig = plots.dispersion_figure(out["ADH_anno"], vista)
+            fig.add_hline(y=media, line_color="blue", annotation_text=f"Media={media:.2f}")
+            fig.add_hline(y=thr, line_dash="dash", line_color="black", annotation_text=f"Soglia={thr:.2f}")
+            fig.add_hline(y=vmin, line_dash="dot", line_color="red", annotation_text=f"Min={vmin:.2f}")
+            fig.add_hline(y=vmax, line_dash="dot", line_color="green", annotation_text=f"Max={vmax:.2f}")
+            fig.update_layout(yaxis_title="ADH_anno")
+        with prof.stage("rendering dispersione"):
+            st.plotly_chart(fig, use_container_width=True)
+
+        # ---------------- EXPORT EXCEL ----------------
+        st.subheader("⬇️ Esporta Excel")
+        res_x = res.copy(); res_x["ADH_anno"] = res_x["ADH_anno"].round(4)
+        tot = pd.DataFrame({
+            "Periodo_giorni": [period_days],
+            "Soglia": [thr],
+            "Media_globale": [round(media, 4)],
+            "Min_globale": [round(vmin, 4)],
+            "Max_globale": [round(vmax, 4)],
+            "N_pazienti": [len(out)],
+            "N_aderenti_(≥soglia)": [int((out['ADH_anno'] >= thr).sum())],
+            "%_aderenti_(≥soglia)": [round((out['ADH_anno'] >= thr).mean() * 100, 2)],
+        })
+        ui.download_buttons({
+            "pazienti": res_x,
+            f"riepilogo_{group_by_col[:28]}": summary,
+            "totali": tot,
+        }, f"aderenza_intervalli_{group_by_col}", "Scarica risultati", extra={"Performance": prof.to_frame()})
+
+        # ---------------- Performance ----------------
+        prof.log()
+        with st.expander("⏱️ Performance", expanded=False):
+            st.caption(f"Totale fasi misurate: {prof.total():.2f} s")
+            st.dataframe(prof.to_frame(), hide_index=True)
+
+        # ---------------- Note ----------------
+        with st.expander("ℹ️ Note metodologiche"):
+            st.markdown(note.format(period_days=period_days, group_by_col=group_by_col))
@@ -0,0 +1,40 @@
+"""
+App multipagina: un solo processo Streamlit per tutte le analisi, con i motori
+di calcolo condivisi nel pacchetto `core` (importati e in cache una volta sola).
+Avvio: streamlit run app.py
+"""
+import streamlit as st
+
+st.set_page_config(layout="wide")
+
+pages = {
+    "Percorsi terapeutici": [
+        st.Page("sankey_v10.py", title="Sankey linee terapeutiche", icon="🔀", url_path="sankey", default=True),
+        st.Page("app_linee_terapeutiche_con_tabella1.py", title="Linee terapeutiche e Tabella 1", icon="📋",
+                url_path="linee"),
+    ],
+    "Aderenza": [
+        st.Page("app_aderenza_persistenza_v10 (1).py", title="PDC su persistenza", icon="💊", url_path="pdc"),
+        st.Page("adh_v17.py", title="Aderenza a intervalli", icon="📊", url_path="adh"),
+        st.Page("adh_v17_persistenza.py", title="Aderenza a intervalli (persistenza)", icon="📊",
+                url_path="adh-persistenza"),
+    ],
+    "Persistenza": [
+        st.Page("app_persistenza_km_v8d.py", title="Kaplan–Meier e log-rank", icon="📈", url_path="km"),
+    ],
+    "Gestione": [
+        st.Page("archivio_risultati.py", title="Archivio risultati", icon="🗄️", url_path="archivio-risultati"),
+    ],
+    # versioni precedenti, autonome (non usano `core`): restano per confronto
+    "Archivio": [
+        st.Page("app_persistenza_km_v8c.py", title="KM v8c", url_path="km-v8c"),
+        st.Page("app_aderenza_ddd_v8d.py", title="Aderenza DDD v8d", url_path="ddd-v8d"),
+        st.Page("app_aderenza_ddd_v8f.py", title="Aderenza DDD v8f", url_path="ddd-v8f"),
+        st.Page("app_aderenza_ddd_v8f_persistenza_full.py", title="Aderenza DDD v8f persistenza", url_path="ddd-v8f-pers"),
+        st.Page("sankey_v9.py", title="Sankey v9", url_path="sankey-v9"),
+        st.Page("sankey_v8.py", title="Sankey v8", url_path="sankey-v8"),
+        st.Page("app_sankey_corretto_v6.py", title="Sankey v6", url_path="sankey-v6"),
+    ],
+}
+
+st.navigation(pages).run()
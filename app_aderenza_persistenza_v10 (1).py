@@ -1,79 +1,96 @@
 
 import streamlit as st
 import pandas as pd
-import io
-import plotly.express as px
+
+from core import adherence, cohort, ingestion, jobs, lazy, perf, plots, store
+import ui
 
 st.set_page_config(layout="wide")
 st.title("Aderenza terapeutica PDC su persistenza reale – v10") 
+prof = perf.Profiler("aderenza_persistenza_v10")
 
 # -------------------------------
-# Utils
+# Cache
 # -------------------------------
 @st.cache_data(show_spinner=False)
-def _read_excel(file):
-    return pd.read_excel(file)
-
-def _safe_numeric(series):
-    s = pd.to_numeric(series, errors="coerce")
-    s = s.where(pd.notnull(s), 0)
-    return s
-
-def _check_unique(tab_ddd, atc_ddd_col):
-    dup = tab_ddd[atc_ddd_col].value_counts()
-    problematic = dup[dup > 1]
-    if not problematic.empty:
-        st.warning(
+def _read_excel(file_hash, _file_bytes):
+    """Legge l'Excel una sola volta per contenuto (chiave = hash del file)."""
+    return ingestion.read_excel(_file_bytes)
+
+# -------------------------------
+# Analisi (eseguita in un job: nessuna chiamata st.* qui dentro)
+# -------------------------------
+def _analisi(df, tab_ddd, p, progress):
+    """Parse, merge DDD, selezione naïve, PDC su persistenza e riepilogo; avvisi e fasi nel risultato."""
+    jp = perf.Profiler("aderenza_persistenza_v10")
+    avvisi = []
+    id_col, atc_col, date_col, ddd_col = p["id_col"], p["atc_col"], p["date_col"], p["ddd_col"]
+    engine = p["motore_tabellare"]
+
+    # Parse e merge
+    progress(0.0, "Parsing e merge DDD")
+    with jp.stage("parsing date", df) as fase:
+        df = df.copy()
+        df[date_col] = pd.to_datetime(df[date_col], errors="coerce", dayfirst=True)
+        df = fase.out(df.dropna(subset=[date_col]))
+
+    dup = cohort.duplicate_keys(tab_ddd, p["atc_ddd_col"])
+    if len(dup):
+        avvisi.append(("warning",
             "⚠️ Nella tabella DDD ci sono ATC duplicati: "
-            + ", ".join(map(str, problematic.index[:10]))
-            + (" ..." if len(problematic) > 10 else "")
+            + ", ".join(map(str, dup[:10]))
+            + (" ..." if len(dup) > 10 else "")
             + ". Questo può duplicare le righe in merge."
-        )
-
-def calcola_pdc_persistenza(ev, start, periodo):
-    """
-    ev: DataFrame con colonne [__date, 'giorni_coperti'] già ordinate per data.
-    start: inizio osservazione (Timestamp)
-    periodo: giorni (int) della finestra massima
-    Calcola il PDC pesato sugli intervalli ma con denominatore = durata della PERSISTENZA REALE
-    (dalla prima dispensazione fino all'ultimo giorno coperto), troncata alla finestra.
-    Ritorna (pdc_persistenza, giorni_persistenza).
-    """
-    end = start + pd.Timedelta(days=int(periodo))
-    ev = ev[ev["__date"] < end].copy()
-
-    # Aggiungi un evento fittizio alla 'end' per chiudere l'ultimo intervallo
-    ev = pd.concat([
-        ev,
-        pd.DataFrame([{"__date": end, "giorni_coperti": 0.0}])
-    ], ignore_index=True, axis=0).sort_values("__date")
-
-    prev_date = start
-    stock = 0.0
-    covered_total = 0.0  # numeratore (giorni coperti totali)
-    last_covered = None  # ultimo istante coperto
-
-    for _, row in ev.iterrows():
-        date = row["__date"]
-        interval_len = (date - prev_date).days
-        if interval_len > 0:
-            used = min(stock, interval_len)
-            covered_total += used
-            if used > 0:
-                last_covered = prev_date + pd.Timedelta(days=int(used))
-            stock -= used
-        stock += float(row["giorni_coperti"])
-        prev_date = date
-
-    if last_covered is None:
-        # nessuna copertura
-        giorni_persistenza = 0
-        pdc_persistenza = 0.0
-    else:
-        giorni_persistenza = max((min(last_covered, end) - start).days, 0)
-        pdc_persistenza = covered_total / giorni_persistenza if giorni_persistenza > 0 else 0.0
-
-    return float(min(max(pdc_persistenza, 0.0), 1.0)), int(giorni_persistenza)
+        ))
+    with jp.stage("merge DDD", df) as fase:
+        df, n_missing, invalid_std = lazy.merge_ddd_standard(df, tab_ddd, atc_col, p["atc_ddd_col"], p["ddd_std_col"],
+                                                             ddd_col, engine=engine)
+        fase.out(df)
+    if n_missing:
+        avvisi.append(("warning", "⚠️ Alcuni ATC non hanno corrispondenza nella tabella DDD. Le relative righe saranno trattate come DDD=0."))
+
+    # Righe con DDD_standard <= 0 non sono utilizzabili per il computo giorni coperti
+    if invalid_std > 0:
+        avvisi.append(("info", f"ℹ️ {invalid_std} righe con DDD_standard ≤ 0: il contributo in giorni_coperti sarà 0."))
+
+    # Selezione naïve
+    progress(0.05, "Selezione naïve")
+    naive_keys = [id_col] if p["naive_scope"] == "Per paziente" else [id_col, atc_col]
+    with jp.stage("selezione naïve", df) as fase:
+        df = fase.out(lazy.select_naive(df, naive_keys, date_col, p["cutoff_naive"], first_col="__first_date",
+                                        engine=engine))
+    if df.empty:
+        return dict(errore="Nessun paziente/ATC naïve secondo i criteri selezionati.", avvisi=avvisi, fasi=jp.stages)
+
+    # Prepara eventi
+    df["giorni_coperti"] = cohort.giorni_coperti(df[ddd_col], df["DDD_standard"])
+    df["__date"] = df[date_col]
+
+    # Calcolo PDC su persistenza (avanzamento a blocchi di unità)
+    def avanzamento(frac, msg=None):
+        progress(0.1 + 0.85 * frac, msg)
+
+    with jp.stage("PDC su persistenza", df) as fase:
+        if p["unit_scope"] == "Per paziente (ATC principale)":
+            aderenza = adherence.pdc_persistenza(df, [id_col], p["periodo"], progress=avanzamento)
+            atc_principale = cohort.group_mode(df, [id_col], atc_col)
+            aderenza.insert(1, "ATC_unit", atc_principale.reindex(aderenza[id_col]).to_numpy())
+        else:
+            aderenza = adherence.pdc_persistenza(df, [id_col, atc_col], p["periodo"],
+                                                 progress=avanzamento).rename(columns={atc_col: "ATC_unit"})
+        fase.out(aderenza)
+    aderenza["Aderente"] = aderenza["PDC_persistenza"] >= p["soglia"]
+
+    progress(0.95, "Riepilogo")
+    with jp.stage("riepilogo per ATC", aderenza) as fase:
+        riepilogo = fase.out(lazy.riepilogo_pdc(aderenza, engine=engine))
+    return dict(aderenza=aderenza, riepilogo=riepilogo, soglia=p["soglia"], avvisi=avvisi, fasi=jp.stages)
+
+def _analisi_archiviata(df, tab_ddd, p, skey, motore, descrizione, progress):
+    """_analisi con salvataggio del risultato (senza le fasi) nell'archivio su disco (core.store)."""
+    res = _analisi(df, tab_ddd, p, progress)
+    store.save(skey, {k: v for k, v in res.items() if k != "fasi"}, "pdc_v10", descrizione, p, motore)
+    return res
 
 # -------------------------------
 # Upload
@@ -82,8 +99,16 @@ file_disp = st.file_uploader("📁 Carica file Excel con dispensazioni singole",
 file_ddd = st.file_uploader("📁 Carica file Excel con tabella DDD (ATC, DDD_standard)", type=["xlsx"], key="ddd")
 
 if file_disp and file_ddd:
-    df = _read_excel(file_disp)
-    tab_ddd = _read_excel(file_ddd)
+    disp_bytes, ddd_bytes = file_disp.getvalue(), file_ddd.getvalue()
+    file_keys = (ingestion.file_hash(disp_bytes), ingestion.file_hash(ddd_bytes))
+    with prof.stage("lettura Excel") as fase:
+        df = _read_excel(file_keys[0], disp_bytes)
+        tab_ddd = _read_excel(file_keys[1], ddd_bytes)
+        fase.out(df)
+    # job e risultati in sessione valgono solo per i file caricati ora
+    for k in ("pdc_job", "pdc_done"):
+        if st.session_state.get(k) is not None and tuple(st.session_state[k][1:3]) != file_keys:
+            del st.session_state[k]
     st.success("✅ File caricati!")
     st.caption(f"Dispensazioni: {df.shape[0]:,} righe • DDD: {tab_ddd.shape[0]:,} righe")
 
@@ -105,99 +130,72 @@ if file_disp and file_ddd:
             periodo = st.number_input("Finestra massima (giorni)", min_value=30, max_value=1825, value=365, step=30)
             soglia = st.number_input("Soglia aderenza (PDC su persistenza)", min_value=0.0, max_value=1.0, value=0.80, step=0.05, format="%.2f")
         st.markdown("---")
-        col4, col5 = st.columns(2)
+        col4, col5, col6 = st.columns(3)
         with col4:
             naive_scope = st.radio("Selezione naïve", ["Per paziente", "Per paziente+ATC"], horizontal=True)
         with col5:
             unit_scope = st.radio("Unità di analisi", ["Per paziente (ATC principale)", "Per paziente+ATC"], horizontal=True)
+        with col6:
+            motore_tabellare = ui.engine_select()
         submitted = st.form_submit_button("Avvia analisi (PDC su persistenza)")
 
+    # -------------------------------
+    # Calcolo in background (job del server)
+    # -------------------------------
+    params = dict(id_col=id_col, atc_col=atc_col, date_col=date_col, ddd_col=ddd_col, atc_ddd_col=atc_ddd_col,
+                  ddd_std_col=ddd_std_col, cutoff_naive=cutoff_naive, periodo=int(periodo), soglia=float(soglia),
+                  naive_scope=naive_scope, unit_scope=unit_scope, motore_tabellare=motore_tabellare)
+    runner = jobs.shared()
     if submitted:
-        # -------------------------------
-        # Parse e merge
-        # -------------------------------
-        df = df.copy()
-        df[date_col] = pd.to_datetime(df[date_col], errors="coerce", dayfirst=True)
-        df = df.dropna(subset=[date_col])
-
-        # Merge DDD table
-        _check_unique(tab_ddd, atc_ddd_col)
-        tab2 = tab_ddd[[atc_ddd_col, ddd_std_col]].drop_duplicates(subset=[atc_ddd_col])
-        df = df.merge(tab2, left_on=atc_col, right_on=atc_ddd_col, how="left")
-        df = df.rename(columns={ddd_std_col: "DDD_standard"})
-        if df["DDD_standard"].isna().any():
-            st.warning("⚠️ Alcuni ATC non hanno corrispondenza nella tabella DDD. Le relative righe saranno trattate come DDD=0.")
-        df["DDD_standard"] = _safe_numeric(df["DDD_standard"]).replace([float("inf"), -float("inf")], 0)
-        df[ddd_col] = _safe_numeric(df[ddd_col])
-
-        # Righe con DDD_standard <= 0 non sono utilizzabili per il computo giorni coperti
-        invalid_std = (df["DDD_standard"] <= 0).sum()
-        if invalid_std > 0:
-            st.info(f"ℹ️ {invalid_std} righe con DDD_standard ≤ 0: il contributo in giorni_coperti sarà 0.")
-
-        # -------------------------------
-        # Selezione naïve
-        # -------------------------------
-        cutoff = pd.to_datetime(cutoff_naive)
-        if naive_scope == "Per paziente":
-            first_disp = df.groupby(id_col)[date_col].min().reset_index().rename(columns={date_col: "__first_date"})
-            naive_ids = first_disp[first_disp["__first_date"] >= cutoff][id_col]
-            df = df[df[id_col].isin(naive_ids)].merge(first_disp, on=id_col, how="left")
+        job_key = ("pdc_v10",) + file_keys + tuple(sorted(params.items()))
+        job = runner.get(job_key)
+        if job is None or job.status in (jobs.FAILED, jobs.CANCELLED):
+            # archivio su disco: stesso file, mappatura, parametri e motore → nessun ricalcolo
+            motore = store.engine_version(adherence, cohort, ingestion, lazy, __file__)
+            skey = store.key("pdc_v10", job_key[1:3], params, motore)
+            with prof.stage("lettura archivio risultati"):
+                salvato = store.load(skey)
+            if salvato is not None:
+                job = runner.put(job_key, dict(salvato, fasi=[]), label="PDC su persistenza")
+            else:
+                descrizione = f"{file_disp.name} • {periodo} gg • {naive_scope} • {unit_scope}"
+                job = runner.submit(_analisi_archiviata, df, tab_ddd, params, skey, motore, descrizione,
+                                    key=job_key, label="PDC su persistenza", cost_mb=jobs.estimate_mb(*df.shape))
+        st.session_state["pdc_job"] = job_key
+
+    job = runner.get(st.session_state.get("pdc_job"))
+    if job is not None and job.status == jobs.DONE:
+        st.session_state["pdc_done"] = job.key
+    elif job is not None:
+        if job.status == jobs.FAILED:
+            st.error(f"Calcolo non riuscito: {job.error}")
+        elif job.status == jobs.CANCELLED:
+            st.warning("Calcolo annullato.")
         else:
-            first_disp = df.groupby([id_col, atc_col])[date_col].min().reset_index().rename(columns={date_col: "__first_date"})
-            df = df.merge(first_disp, on=[id_col, atc_col], how="left")
-            df = df[df["__first_date"] >= cutoff]
-
-        if df.empty:
-            st.error("Nessun paziente/ATC naïve secondo i criteri selezionati.")
+            ui.job_panel(job.key)
+    done = runner.get(st.session_state.get("pdc_done"))
+    if done is not None and done is not job:
+        st.caption("Risultati dell'ultimo calcolo completato (i nuovi parametri non sono ancora applicati).")
+
+    if done is not None:
+        res = done.result
+        if st.session_state.get("pdc_visto") != done.key:  # fasi del job una sola volta nel profilo
+            st.session_state["pdc_visto"] = done.key
+            prof.stages += [dict(r, fase=f"{r['fase']} (job)") for r in res["fasi"]]
+        for livello, testo in res["avvisi"]:
+            getattr(st, livello)(testo)
+        if "errore" in res:
+            st.error(res["errore"])
             st.stop()
-
-        # -------------------------------
-        # Prepara eventi
-        # -------------------------------
-        df["giorni_coperti"] = 0.0
-        mask_pos = df["DDD_standard"] > 0
-        df.loc[mask_pos, "giorni_coperti"] = (df.loc[mask_pos, ddd_col] / df.loc[mask_pos, "DDD_standard"]).fillna(0.0)
-        df["__date"] = df[date_col]
-
-        # -------------------------------
-        # Calcolo PDC su persistenza
-        # -------------------------------
-        risultati = []
-        if unit_scope == "Per paziente (ATC principale)":
-            for pid, s in df.sort_values("__date").groupby(id_col):
-                start = s["__date"].min()
-                pdc_pers, giorni_pers = calcola_pdc_persistenza(s[["__date", "giorni_coperti"]], start, periodo)
-                atc_principale = s[atc_col].mode().iloc[0] if not s[atc_col].mode().empty else None
-                risultati.append({id_col: pid, "ATC_unit": atc_principale, "PDC_persistenza": pdc_pers, "Persistenza_giorni": int(giorni_pers)})
-        else:
-            for (pid, atc), s in df.sort_values("__date").groupby([id_col, atc_col]):
-                start = s["__date"].min()
-                pdc_pers, giorni_pers = calcola_pdc_persistenza(s[["__date", "giorni_coperti"]], start, periodo)
-                risultati.append({id_col: pid, "ATC_unit": atc, "PDC_persistenza": pdc_pers, "Persistenza_giorni": int(giorni_pers)})
-
-        aderenza = pd.DataFrame(risultati)
-        aderenza["Aderente"] = aderenza["PDC_persistenza"] >= soglia
+        aderenza, riepilogo, soglia = res["aderenza"], res["riepilogo"], res["soglia"]
 
         # -------------------------------
         # Riepiloghi
         # -------------------------------
         st.subheader("📊 PDC su persistenza – risultati unità di analisi")
-        st.dataframe(aderenza, use_container_width=True)
+        ui.result_table(aderenza, "pdc_unita")  # solo la pagina visibile; completa nell'Excel
 
         st.subheader("📊 Riepilogo per ATC_unit (PDC su persistenza)")
-        riepilogo = aderenza.groupby("ATC_unit").agg(
-            N_unit=("PDC_persistenza", "count"),
-            N_aderenti=("Aderente", "sum"),
-            PDC_medio=("PDC_persistenza", "mean"),
-            PDC_std=("PDC_persistenza", "std"),
-            P50=("PDC_persistenza", "median"),
-            P10=("PDC_persistenza", lambda s: s.quantile(0.10)),
-            P90=("PDC_persistenza", lambda s: s.quantile(0.90)),
-            PDC_min=("PDC_persistenza", "min"),
-            PDC_max=("PDC_persistenza", "max"),
-        ).reset_index()
-        riepilogo["%_aderenti"] = (100 * riepilogo["N_aderenti"] / riepilogo["N_unit"]).round(1)
         st.dataframe(riepilogo, use_container_width=True)
 
         # -------------------------------
@@ -205,31 +203,33 @@ if file_disp and file_ddd:
         # -------------------------------
         st.subheader("📈 Distribuzione PDC su persistenza per ATC_unit")
         if not aderenza.empty:
-            order = aderenza.groupby("ATC_unit")["PDC_persistenza"].median().sort_values().index
-            fig = px.box(
-                aderenza,
-                x=pd.Categorical(aderenza["ATC_unit"], categories=order, ordered=True),
-                y="PDC_persistenza",
-                points="all",
-                title=f"Distribuzione PDC (su persistenza) per ATC_unit – soglia aderente = {soglia:.2f}",
-                labels={"x": "ATC_unit", "PDC_persistenza": "PDC su persistenza"}
-            )
-            st.plotly_chart(fig, use_container_width=True)
+            # box da statistiche precalcolate; punti solo come campione stratificato
+            mostra_punti = st.checkbox(f"Mostra punti (campione stratificato, max {plots.POINTS_BUDGET:,})", value=True)
+            with prof.stage("figura box plot", aderenza):
+                order = aderenza.groupby("ATC_unit")["PDC_persistenza"].median().sort_values().index
+                fig = plots.box_figure(aderenza, "ATC_unit", "PDC_persistenza", order=order, per_group=False,
+                                       points=mostra_punti)
+                fig.update_layout(
+                    title=f"Distribuzione PDC (su persistenza) per ATC_unit – soglia aderente = {soglia:.2f}",
+                    xaxis_title="ATC_unit", yaxis_title="PDC su persistenza",
+                )
+            with prof.stage("rendering box plot"):
+                st.plotly_chart(fig, use_container_width=True)
 
         # -------------------------------
         # Download
         # -------------------------------
         st.subheader("📥 Scarica risultati")
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            aderenza.to_excel(writer, index=False, sheet_name="PDC_persistenza_unita")
-            riepilogo.to_excel(writer, index=False, sheet_name="Riepilogo_ATC_unit")
-        st.download_button(
-            label="💾 Scarica risultati (Excel)",
-            data=buffer.getvalue(),
-            file_name="risultati_aderenza_persistenza_v10.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        ui.download_buttons({"PDC_persistenza_unita": aderenza, "Riepilogo_ATC_unit": riepilogo},
+                            "risultati_aderenza_persistenza_v10", "💾 Scarica risultati",
+                            extra={"Performance": prof.to_frame()})
 
+    # -------------------------------
+    # Performance
+    # -------------------------------
+    prof.log()
+    with st.expander("⏱️ Performance", expanded=False):
+        st.caption(f"Totale fasi misurate: {prof.total():.2f} s")
+        st.dataframe(prof.to_frame(), hide_index=True)
 else:
     st.info("Carica entrambi i file per continuare.")
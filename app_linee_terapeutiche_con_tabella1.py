@@ -1,15 +1,39 @@
-
 import streamlit as st
 import pandas as pd
-import io
+
+from core import cohort, ingestion, lazy, pathways, perf
+import ui
 
 st.set_page_config(layout="wide")
 st.title("Analisi linee terapeutiche per paziente – con Tabella 1")
+prof = perf.Profiler("linee_terapeutiche")
+
+@st.cache_data(show_spinner=False)
+def _read_excel(file_hash, _file_bytes):
+    """Legge l'Excel una sola volta per contenuto (chiave = hash del file)."""
+    return ingestion.read_excel(_file_bytes)
+
+@st.cache_data(show_spinner="Calcolo linee terapeutiche…")
+def _compute_lines(file_hash, id_col, cat_col, date_col, data_indice, engine, _df):
+    """
+    Tabella delle linee per (file, colonne, data indice): calcolata una volta,
+    poi selezione linee e Tabella 1 lavorano sul risultato in cache.
+    """
+    df = _df.copy()
+    df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
+    df = df.dropna(subset=[date_col])
+
+    # Filtra pazienti naïve, poi nuova linea a ogni cambio di categoria
+    df = lazy.select_naive(df, [id_col], date_col, data_indice, engine=engine)
+    return pathways.lines_on_change(df, id_col, cat_col, date_col)
 
 file = st.file_uploader("① Carica file Excel con dispensazioni", type=["xlsx"])
 
 if file:
-    df = pd.read_excel(file)
+    file_bytes = file.getvalue()
+    file_hash = ingestion.file_hash(file_bytes)
+    with prof.stage("lettura Excel") as fase:
+        df = fase.out(_read_excel(file_hash, file_bytes))
     st.success("File caricato.")
     st.dataframe(df.head())
 
@@ -23,47 +47,49 @@ if file:
             date_col = st.selectbox("Colonna data dispensazione", df.columns)
             age_col = st.selectbox("Colonna età", df.columns)
             data_indice = st.date_input("Data indice (pazienti naïve)")
+        motore_tabellare = ui.engine_select()
         invia = st.form_submit_button("Esegui analisi")
 
+    # i parametri restano in sessione: toccare la selezione linee non perde i risultati
     if invia:
-        df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
-        df = df.dropna(subset=[date_col])
-
-        # Filtra pazienti naïve
-        prima_disp = df.groupby(id_col)[date_col].min().reset_index()
-        naive_ids = prima_disp[prima_disp[date_col] >= pd.to_datetime(data_indice)][id_col]
-        df = df[df[id_col].isin(naive_ids)].copy()
+        st.session_state["linee_params"] = dict(
+            file_hash=file_hash, id_col=id_col, cat_col=cat_col, ex_col=ex_col,
+            date_col=date_col, age_col=age_col, data_indice=data_indice, motore_tabellare=motore_tabellare,
+        )
+    params = st.session_state.get("linee_params")
 
-        # Ordina e calcola linee terapeutiche
-        df = df.sort_values([id_col, date_col])
-        df["Linea"] = df.groupby(id_col)[cat_col].transform(lambda x: x.ne(x.shift()).cumsum())
-        df["Linea"] = df["Linea"].astype(int)
-        df["Terapia_linea"] = df[cat_col] + " (Linea " + df["Linea"].astype(str) + ")"
+    if params and params["file_hash"] == file_hash:
+        id_col, cat_col, date_col = params["id_col"], params["cat_col"], params["date_col"]
+        ex_col, age_col = params["ex_col"], params["age_col"]
+        with prof.stage("coorte naïve e linee", df) as fase:
+            df = fase.out(_compute_lines(file_hash, id_col, cat_col, date_col, params["data_indice"],
+                                         params["motore_tabellare"], _df=df))
 
         st.subheader("📊 Linee terapeutiche")
-        st.dataframe(df[[id_col, date_col, cat_col, "Linea", "Terapia_linea"]])
+        ui.result_table(df[[id_col, date_col, cat_col, "Linea", "Terapia_linea"]], "linee")  # completa nell'Excel
 
         # Selezione linee
         linee_disponibili = sorted(df["Linea"].unique())
         linee_sel = st.multiselect("Seleziona le linee da includere in Tabella 1", options=linee_disponibili, default=[1])
         df_linee = df[df["Linea"].isin(linee_sel)]
 
-        # Tabella 1
+        # Tabella 1 (per categoria e per categoria × linea)
         st.subheader("📋 Tabella 1 – Caratteristiche pazienti per categoria")
-        tab1 = df_linee.groupby(cat_col).agg(
-            N_pazienti=(id_col, "nunique"),
-            Perc_maschi=(ex_col, lambda x: round((x == 'M').mean()*100, 2)),
-            Età_media=(age_col, "mean"),
-            Età_mediana=(age_col, "median"),
-            Età_min=(age_col, "min"),
-            Età_max=(age_col, "max")
-        ).reset_index()
-        st.dataframe(tab1)
+        with prof.stage("Tabella 1", df_linee):
+            tabelle = cohort.tabella1(df_linee, id_col, [[cat_col], [cat_col, "Linea"]], ex_col, age_col)
+        for tab, (nome, tab1) in zip(st.tabs(list(tabelle)), tabelle.items()):
+            with tab:
+                st.dataframe(tab1)
 
-        # Excel export
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            df[[id_col, cat_col, date_col, "Linea", "Terapia_linea"]].to_excel(writer, index=False, sheet_name="Linee_terapeutiche")
-            tab1.to_excel(writer, index=False, sheet_name="Tabella1")
+        # export (generato al clic)
+        fogli = {"Linee_terapeutiche": df[[id_col, cat_col, date_col, "Linea", "Terapia_linea"]]}
+        for k, tab1 in enumerate(tabelle.values()):
+            fogli["Tabella1" if k == 0 else f"Tabella1_{k + 1}"] = tab1
+        ui.download_buttons(fogli, "linee_terapeutiche_tab1", "⬇️ Scarica risultati",
+                            extra={"Performance": prof.to_frame()})
 
-        st.download_button("⬇️ Scarica risultati in Excel", data=buffer.getvalue(), file_name="linee_terapeutiche_tab1.xlsx")
+    # ---------- performance ----------
+    prof.log()
+    with st.expander("⏱️ Performance", expanded=False):
+        st.caption(f"Totale fasi misurate: {prof.total():.2f} s")
+        st.dataframe(prof.to_frame(), hide_index=True)
@@ -1,200 +1,31 @@
 
 import streamlit as st
 import pandas as pd
-import numpy as np
 import plotly.graph_objects as go
 import math
-import io
+
+from core import cohort, ingestion, jobs, perf, store, survival
+from core.survival import km_curve_from_times, logrank_prism, preprocess_prism
+import ui
 
 st.set_page_config(layout="wide")
 st.title("Persistenza terapeutica – Kaplan–Meier stile Prism (Mantel–Cox log-rank, v8d)")
+prof = perf.Profiler("persistenza_km_v8d")
 
-# -------------------- Funzioni matematiche --------------------
-def _gammainc_P(a: float, x: float, eps: float = 1e-12, max_iter: int = 10000) -> float:
-    """Regularized lower incomplete gamma P(a, x)."""
-    if x <= 0:
-        return 0.0
-    if x < a + 1.0:
-        term = 1.0 / a
-        summ = term
-        n = 1
-        while n < max_iter:
-            term *= x / (a + n)
-            summ += term
-            if abs(term) < abs(summ) * eps:
-                break
-            n += 1
-        return summ * math.exp(-x + a * math.log(x) - math.lgamma(a))
-    tiny = 1e-300
-    b = x + 1.0 - a
-    c = 1.0 / tiny
-    d = 1.0 / b if b != 0 else 1.0 / tiny
-    h = d
-    for i in range(1, max_iter + 1):
-        an = -i * (i - a)
-        b += 2.0
-        d = an * d + b
-        if abs(d) < tiny:
-            d = tiny
-        c = b + an / c
-        if abs(c) < tiny:
-            c = tiny
-        d = 1.0 / d
-        delta = d * c
-        h *= delta
-        if abs(delta - 1.0) < eps:
-            break
-    Q = math.exp(-x + a * math.log(x) - math.lgamma(a)) * h
-    return 1.0 - Q
-
-def chi2_cdf(x: float, df: int) -> float:
-    if x < 0 or df <= 0:
-        return 0.0
-    return _gammainc_P(0.5 * df, 0.5 * x)
-
-# -------------------- Preprocessing stile Prism --------------------
-def preprocess_prism(df, id_col, date_col, strat_col, period, cutoff_date):
-    df = df.copy()
-    df[date_col] = pd.to_datetime(df[date_col], errors="coerce", dayfirst=True)
-    invalid_dates = df[date_col].isna().sum()
-    df = df.dropna(subset=[date_col])
-
-    rows = []
-    for pid, g in df.groupby(id_col):
-        start = g[date_col].min()
-        last  = g[date_col].max()
-        observed_last = min(last, cutoff_date)
-        observed_days = (observed_last - start).days
-
-        include = False
-        event = None
-        reason = ""
-
-        if last <= cutoff_date and observed_days < period:
-            include = True
-            event = 1
-            reason = "Evento entro cutoff"
-        elif observed_days >= period:
-            include = True
-            event = 0
-            reason = "Censura (persistente >= periodo)"
-        else:
-            include = False
-            event = 0
-            reason = "Escluso (follow-up insufficiente e nessun evento)"
-
-        time = int(min(observed_days, period))
-        strat = g[strat_col].mode().iloc[0] if not g[strat_col].mode().empty else "NA"
-
-        rows.append({
-            "paziente": pid,
-            "gruppo": strat,
-            "start": start.date(),
-            "last": last.date(),
-            "cutoff_usato": cutoff_date.date(),
-            "giorni_osservati": observed_days,
-            "time": time,
-            "event": int(event),
-            "incluso": include,
-            "motivo": reason
-        })
-
-    full = pd.DataFrame(rows)
-    included = full[full["incluso"]].copy()
-    return full, included, int(invalid_dates)
-
-# -------------------- Kaplan–Meier --------------------
-def km_curve_from_times(times, events, period):
-    df = pd.DataFrame({"time": times, "event": events}).sort_values("time")
-    df = df[df["time"] > 0]  # FIX: escludi time=0 anche dalle curve
-    S = 1.0
-    t_coords = [0]
-    s_coords = [1.0]
-    at_risk = len(df)
-    for t in df["time"].unique():
-        if t > period:
-            break
-        d = int(df[(df["time"] == t) & (df["event"] == 1)].shape[0])
-        c = int(df[(df["time"] == t) & (df["event"] == 0)].shape[0])
-        if d > 0 and at_risk > 0:
-            S *= (at_risk - d) / at_risk
-        at_risk -= (d + c)
-        t_coords.append(int(t))
-        s_coords.append(S)
-    if t_coords[-1] < period:
-        t_coords.append(int(period))
-        s_coords.append(S)
-    return t_coords, s_coords
-
-# -------------------- Log-rank Mantel–Cox --------------------
-def logrank_prism(times, events, groups, debug=False):
-    df = pd.DataFrame({"time": times, "event": events, "group": groups})
-    # FIX: escludi eventi con time=0
-    event_times = np.sort(df.loc[(df["event"] == 1) & (df["time"] > 0), "time"].unique())
-    groups_unique = sorted(df["group"].unique())
-    k = len(groups_unique)
-    if k < 2 or event_times.size == 0:
-        return math.nan, math.nan, k, pd.DataFrame()
-
-    debug_rows = []
-
-    if k == 2:
-        # Formula Mantel–Haenszel classica (come Prism)
-        O1, E1, V1 = 0.0, 0.0, 0.0
-        g1, g2 = groups_unique
-        for t in event_times:
-            R = int((df["time"] >= t).sum())
-            d = int(((df["time"] == t) & (df["event"] == 1)).sum())
-            if R <= 1 or d == 0:
-                continue
-            R1 = int(((df["group"] == g1) & (df["time"] >= t)).sum())
-            R2 = R - R1
-            d1 = int(((df["group"] == g1) & (df["time"] == t) & (df["event"] == 1)).sum())
-            E1_t = d * (R1 / R)
-            V1_t = (R1 * R2 * d * (R - d)) / (R**2 * (R - 1))
-            O1 += d1
-            E1 += E1_t
-            V1 += V1_t
-            if debug:
-                debug_rows.append({"time": t, "R": R, "d": d, "R1": R1, "R2": R2,
-                                   "d1": d1, "E1_t": E1_t, "V1_t": V1_t})
-        chi2_stat = (O1 - E1) ** 2 / V1 if V1 > 0 else math.nan
-        pval = 1.0 - chi2_cdf(chi2_stat, 1)
-        debug_df = pd.DataFrame(debug_rows)
-        return chi2_stat, pval, k, debug_df
-    else:
-        # Formula generale (matrice di varianza)
-        O = np.zeros(k)
-        E = np.zeros(k)
-        V = np.zeros((k, k))
-        for t in event_times:
-            R = int((df["time"] >= t).sum())
-            d = int(((df["time"] == t) & (df["event"] == 1)).sum())
-            if R <= 1 or d == 0:
-                continue
-            Rg = np.array([int(((df["group"] == g) & (df["time"] >= t)).sum()) for g in groups_unique])
-            dg = np.array([int(((df["group"] == g) & (df["time"] == t) & (df["event"] == 1)).sum()) for g in groups_unique])
-            Eg = d * (Rg / R)
-            common = d * (R - d) / (R**2 * (R - 1))
-            V += np.diag(Rg * (R - Rg) * common)
-            V -= np.outer(Rg, Rg) * common
-            O += dg
-            E += Eg
-        D = O - E
-        try:
-            Vinv = np.linalg.pinv(V)
-            chi2_stat = float(D.T @ Vinv @ D)
-        except Exception:
-            return math.nan, math.nan, k, pd.DataFrame()
-        dfree = k - 1
-        pval = 1.0 - chi2_cdf(chi2_stat, dfree)
-        return chi2_stat, pval, k, pd.DataFrame()
+# -------------------- Cache --------------------
+@st.cache_data(show_spinner=False)
+def _read_excel(file_hash, _file_bytes):
+    """Legge l'Excel una sola volta per contenuto (chiave = hash del file)."""
+    return ingestion.read_excel(_file_bytes)
 
 # -------------------- UI --------------------
 file_disp = st.file_uploader("📁 Carica file Excel con dispensazioni", type=["xlsx"])
 
 if file_disp:
-    df = pd.read_excel(file_disp)
+    file_bytes = file_disp.getvalue()
+    file_hash = ingestion.file_hash(file_bytes)
+    with prof.stage("lettura Excel") as fase:
+        df = fase.out(_read_excel(file_hash, file_bytes))
     st.success("✅ File caricato")
 
     with st.expander("Anteprima dati", expanded=False):
@@ -218,33 +49,59 @@ if file_disp:
 
     if submitted:
         cutoff_ts = pd.to_datetime(cutoff)
-        full, included, invalid_n = preprocess_prism(df, id_col, date_col, strat_col, int(periodo), cutoff_ts)
+        # archivio su disco: stesso file, mappatura, parametri e motore → nessun ricalcolo
+        # (motore = sorgente dei moduli core usati, anche indirettamente, e della pagina)
+        params = dict(id_col=id_col, date_col=date_col, strat_col=strat_col, periodo=int(periodo), cutoff=cutoff_ts)
+        motore = store.engine_version(cohort, ingestion, survival, __file__)
+        skey = store.key("km_v8d", [file_hash], params, motore)
+        with prof.stage("lettura archivio risultati"):
+            salvato = store.load(skey)
+        if salvato is None:
+            # coda del server (core.jobs): con altri calcoli pesanti in corso si attende il turno
+            attesa = st.empty()
+            with jobs.shared().slot(jobs.estimate_mb(*df.shape), "KM Prism",
+                                    on_wait=lambda pos: attesa.info(f"⏳ Server occupato: analisi in coda, posizione {pos}")):
+                attesa.empty()
+                with prof.stage("preprocessing Prism", df) as fase:
+                    full, included, invalid_n = preprocess_prism(df, id_col, date_col, strat_col, int(periodo), cutoff_ts)
+                    fase.out(included)
+            salvato = dict(full=full, included=included)
+            store.save(skey, salvato, "km_v8d", f"{file_disp.name} • {int(periodo)} gg • {strat_col}", params, motore)
+        st.session_state["km_res"] = dict(file_hash=file_hash, periodo=int(periodo), debug=debug_opt, **salvato)
+
+    # i risultati restano in sessione: sfogliare/filtrare le tabelle non rilancia l'analisi
+    res = st.session_state.get("km_res")
+    if res and res["file_hash"] == file_hash:
+        full, included, periodo, debug_opt = res["full"], res["included"], res["periodo"], res["debug"]
 
         st.subheader("📄 Tabella preprocessata (tutti i pazienti)")
-        st.dataframe(full)
+        ui.result_table(full, "km_full")  # solo la pagina visibile; completa nell'Excel
 
         st.subheader("✅ Pazienti inclusi (tempo/evento)")
-        st.dataframe(included[["paziente","gruppo","time","event"]])
+        ui.result_table(included[["paziente","gruppo","time","event"]], "km_inclusi")
 
         if included["gruppo"].nunique() < 2 or included.empty:
             st.info("Servono almeno 2 gruppi e almeno 1 evento per generare curve e test.")
         else:
             st.subheader("📈 Curve Kaplan–Meier")
-            fig = go.Figure()
-            for strat, g in included.groupby("gruppo"):
-                t_coords, s_coords = km_curve_from_times(g["time"].to_numpy(), g["event"].to_numpy(), int(periodo))
-                fig.add_trace(go.Scatter(x=t_coords, y=s_coords, mode="lines+markers",
-                                         line_shape="hv", name=str(strat)))
-            fig.update_layout(xaxis_title="Giorni", yaxis_title="Probabilità di persistenza", yaxis=dict(range=[0,1]))
-            st.plotly_chart(fig, use_container_width=True)
+            with prof.stage("curve KM e figura", included):
+                fig = go.Figure()
+                for strat, g in included.groupby("gruppo"):
+                    t_coords, s_coords = km_curve_from_times(g["time"].to_numpy(), g["event"].to_numpy(), int(periodo))
+                    fig.add_trace(go.Scatter(x=t_coords, y=s_coords, mode="lines+markers",
+                                             line_shape="hv", name=str(strat)))
+                fig.update_layout(xaxis_title="Giorni", yaxis_title="Probabilità di persistenza", yaxis=dict(range=[0,1]))
+            with prof.stage("rendering KM"):
+                st.plotly_chart(fig, use_container_width=True)
 
             st.subheader("📊 Test log-rank (Mantel–Cox)")
-            chi2_stat, pval, k, debug_df = logrank_prism(
-                included["time"].to_numpy(),
-                included["event"].to_numpy(),
-                included["gruppo"].to_numpy(),
-                debug=debug_opt
-            )
+            with prof.stage("log-rank", included):
+                chi2_stat, pval, k, debug_df = logrank_prism(
+                    included["time"].to_numpy(),
+                    included["event"].to_numpy(),
+                    included["gruppo"].to_numpy(),
+                    debug=debug_opt
+                )
             if math.isnan(chi2_stat):
                 st.info("Test non calcolabile.")
             else:
@@ -254,13 +111,17 @@ if file_disp:
                 st.subheader("🔎 Tabella debug log-rank")
                 st.dataframe(debug_df)
 
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-                full.to_excel(writer, index=False, sheet_name="preprocess_all")
-                included.to_excel(writer, index=False, sheet_name="tempo_evento_inclusi")
-                pd.DataFrame([{"chi2": chi2_stat, "df": k-1, "p_value": pval}]).to_excel(writer, index=False, sheet_name="logrank")
-                if not debug_df.empty:
-                    debug_df.to_excel(writer, index=False, sheet_name="debug_logrank")
-            st.download_button("💾 Scarica Excel completo", data=buffer.getvalue(), file_name="persistenza_prism_v8d.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            ui.download_buttons({
+                "preprocess_all": full,
+                "tempo_evento_inclusi": included,
+                "logrank": pd.DataFrame([{"chi2": chi2_stat, "df": k-1, "p_value": pval}]),
+                "debug_logrank": None if debug_df.empty else debug_df,
+            }, "persistenza_prism_v8d", "💾 Scarica completo", extra={"Performance": prof.to_frame()})
+
+    # ---------- performance ----------
+    prof.log()
+    with st.expander("⏱️ Performance", expanded=False):
+        st.caption(f"Totale fasi misurate: {prof.total():.2f} s")
+        st.dataframe(prof.to_frame(), hide_index=True)
 else:
     st.info("Carica un file Excel per iniziare.")
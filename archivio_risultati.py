@@ -0,0 +1,73 @@
+"""
+Gestione dell'archivio dei risultati su disco (core/store.py): dimensioni,
+età e accessi dei risultati salvati dalle app, eliminazione manuale, per età
+o per spazio; in fondo la cache dei file di export (core/export.py).
+"""
+import os
+
+import streamlit as st
+
+from core import export, store
+
+st.set_page_config(layout="wide")
+st.title("🗄️ Archivio risultati")
+st.caption("Le analisi completate sono salvate qui: rilanciarle sullo stesso file con la stessa mappatura, "
+           "gli stessi parametri e lo stesso motore rilegge il risultato invece di ricalcolarlo.")
+
+
+# ---------- azioni (callback: la tabella sotto è già aggiornata) ----------
+def _elimina(chiavi):
+    st.session_state["archivio_msg"] = f"Eliminati {store.delete(chiavi)} risultati."
+
+
+def _pulisci(max_mb=float("inf"), max_age_days=None):
+    st.session_state["archivio_msg"] = f"Eliminati {store.prune(max_mb, max_age_days)} risultati."
+
+
+def _svuota_export():
+    st.session_state["archivio_msg"] = f"Eliminati {export.clear_cache()} file di export."
+
+
+if msg := st.session_state.pop("archivio_msg", None):
+    st.success(msg)
+
+# ---------- riepilogo ----------
+e = store.entries()
+limite = float(os.environ.get(store.MB_ENV, 2048))
+c1, c2, c3 = st.columns(3)
+c1.metric("Risultati salvati", f"{len(e):,}")
+c2.metric("Spazio occupato", f"{e['MB'].sum():,.1f} MB")
+c3.metric(f"Limite ({store.MB_ENV})", f"{limite:,.0f} MB")
+st.caption(f"Cartella: `{store.root()}` ({store.DIR_ENV}). Oltre il limite si eliminano i risultati usati meno di recente.")
+
+if e.empty:
+    st.info("Nessun risultato salvato.")
+else:
+    # ---------- elenco ----------
+    tipi = st.multiselect("Filtra per tipo di analisi", sorted(e["tipo"].unique()))
+    view = e[e["tipo"].isin(tipi)] if tipi else e
+    sel = st.dataframe(view, hide_index=True, use_container_width=True, on_select="rerun",
+                       selection_mode="multi-row", key="archivio_tabella")
+    chiavi = view.iloc[sel.selection.rows]["chiave"].tolist()
+    st.button(f"🗑️ Elimina selezionati ({len(chiavi)})", disabled=not chiavi, on_click=_elimina, args=(chiavi,))
+
+    # ---------- pulizia ----------
+    st.subheader("🧹 Pulizia")
+    c4, c5, c6 = st.columns(3)
+    with c4:
+        giorni = st.number_input("Creati da più di (giorni)", min_value=1, max_value=3650, value=30)
+        st.button("Elimina i più vecchi", on_click=_pulisci, kwargs=dict(max_age_days=giorni))
+    with c5:
+        mb = st.number_input("Riduci a (MB, restano i più usati di recente)", min_value=0.0,
+                             value=float(round(e["MB"].sum() / 2, 1)), step=10.0)
+        st.button("Riduci", on_click=_pulisci, kwargs=dict(max_mb=mb))
+    with c6:
+        st.write("")
+        st.button("Svuota archivio", type="primary", on_click=_elimina, args=(e["chiave"].tolist(),))
+
+# ---------- cache export ----------
+st.subheader("📥 Cache dei file di export")
+files = export.cache_files()
+st.caption(f"{len(files):,} file • {sum(p.stat().st_size for p in files) / 2**20:,.1f} MB in `{export.cache_dir()}` "
+           f"(limite {export.CACHE_MB_ENV}). I file si rigenerano al prossimo download.")
+st.button("Svuota cache export", disabled=not files, on_click=_svuota_export)
@@ -0,0 +1,78 @@
+"""
+Analisi in batch da riga di comando, senza browser né Streamlit.
+
+    python batch.py --disp dispensazioni.xlsx --ddd tabella_ddd.xlsx --jobs jobs.yaml --out risultati/
+
+Ogni job della specifica (vedi jobs_esempio.yaml) produce una cartella
+`risultati/<nome>/` con un Parquet per tabella e `risultati.xlsx`;
+`risultati/riepilogo.json` riassume tempi, righe ed eventuali errori.
+
+Estratti mensili che aggiungono in coda le nuove dispensazioni:
+
+    python batch.py --disp estratto_2025_02.csv --jobs jobs.yaml --stato stato/ --out risultati_2025_02/
+
+con `--stato` ogni job PDC, KM e Sankey per linee salva lo stato per paziente e
+al mese successivo elabora solo le righe aggiunte; `--verifica` esegue anche
+il ricalcolo completo e confronta le tabelle, `--completo` ricostruisce lo stato.
+
+Estratti più grandi della RAM (solo CSV o Parquet):
+
+    python batch.py --disp estratto_nazionale.csv --ddd tabella_ddd.xlsx --jobs jobs.yaml --fuori-memoria --shard 128
+
+l'estratto si legge a blocchi e si ripartisce per paziente in shard Parquet
+(in `--tmp`, eliminati alla fine); i job girano uno shard alla volta per
+processo e i riepiloghi si uniscono (core/outofcore.py). Le tabelle per
+paziente/unità restano `risultati/<nome>/<tabella>/part-XXXXX.parquet`.
+"""
+import argparse
+import sys
+
+from core import batch, outofcore
+from core.ingestion import read_path
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Analisi aderenza/persistenza/Sankey in batch")
+    ap.add_argument("--disp", required=True, help="File dispensazioni (xlsx/csv/parquet)")
+    ap.add_argument("--ddd", help="Tabella DDD (xlsx/csv/parquet), richiesta dai job 'pdc'")
+    ap.add_argument("--jobs", required=True, help="Specifica dei job (yaml/json)")
+    ap.add_argument("--out", default="risultati", help="Cartella di output")
+    ap.add_argument("-j", "--workers", type=int, default=None, help="Processi paralleli (default: tutti i core)")
+    ap.add_argument("--formati", default="parquet,xlsx", help="Formati di output separati da virgola (parquet, csv.gz, xlsx)")
+    ap.add_argument("--stato", help="Cartella dello stato per il ricalcolo incrementale degli estratti mensili")
+    ap.add_argument("--completo", action="store_true", help="Con --stato: ignora lo stato salvato e lo ricostruisce")
+    ap.add_argument("--verifica", action="store_true",
+                    help="Con --stato: esegue anche il ricalcolo completo e confronta i risultati")
+    ap.add_argument("--fuori-memoria", action="store_true",
+                    help="Estratto più grande della RAM: lettura a blocchi e shard per paziente su disco (CSV/Parquet)")
+    ap.add_argument("--shard", type=int, default=outofcore.SHARDS, help="Con --fuori-memoria: numero di shard")
+    ap.add_argument("--blocco", type=int, default=outofcore.CHUNK_ROWS, help="Con --fuori-memoria: righe per blocco letto")
+    ap.add_argument("--tmp", help="Con --fuori-memoria: cartella per gli shard (default: temporanea di sistema)")
+    args = ap.parse_args(argv)
+    if (args.completo or args.verifica) and not args.stato:
+        ap.error("--completo e --verifica richiedono --stato")
+    if args.fuori_memoria and args.stato:
+        ap.error("--fuori-memoria e --stato non si combinano")
+
+    spec = batch.load_spec(args.jobs)
+    ddd = read_path(args.ddd) if args.ddd else None
+    if args.fuori_memoria:
+        if ddd is None and any(j["tipo"] == "pdc" for j in spec.get("jobs", [])):
+            ap.error("i job 'pdc' richiedono --ddd")
+        results = batch.run_sharded(args.disp, spec, ddd, args.out, args.workers, tuple(args.formati.split(",")),
+                                    n_shards=args.shard, chunk_rows=args.blocco, tmp=args.tmp)
+        return 1 if any("errore" in r for r in results) else 0
+
+    df = read_path(args.disp)
+    jobs = batch.expand_jobs(spec, df)
+    if ddd is None and any(j["tipo"] == "pdc" for j in jobs):
+        ap.error("i job 'pdc' richiedono --ddd")
+    print(f"{len(df):,} dispensazioni • {len(jobs)} job")
+
+    results = batch.run_batch(df, ddd, jobs, args.out, args.workers, tuple(args.formati.split(",")),
+                              stato=args.stato, completo=args.completo, verifica=args.verifica)
+    return 1 if any("errore" in r or r.get("verifica", "ok") != "ok" for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
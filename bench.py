@@ -0,0 +1,245 @@
+"""
+Benchmark dei motori di calcolo su dati sintetici (core/synth.py).
+
+    python bench.py --sizes 10k,100k,1M --engines pdc,adh,km
+    python bench.py --sizes 10M --no-memory --ref-max-rows 0
+
+Per ogni motore e dimensione misura tempo, righe/s e picco di memoria
+(tracemalloc, in un'esecuzione separata) della versione ottimizzata e, fino a
+`--ref-max-rows`, della versione di riferimento a ciclo. Ogni esecuzione è
+aggiunta a `bench_history.json` con commit git e versioni, e confrontata con
+l'ultima esecuzione comparabile (stesso motore, variante e righe).
+
+    python bench.py --sizes 1M --engines dedup,dedup_polars,naive,naive_polars
+
+Le operazioni del motore tabellare (`naive`, `merge_ddd`, `dedup`,
+`riepilogo_pdc`, `riepilogo_adh`) hanno una variante `_polars` (core/lazy.py),
+saltata se Polars non è installato; tracemalloc non vede la memoria allocata
+da Polars, quindi per queste varianti il picco è sottostimato.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from core import adherence, cohort, lazy, pathways, survival, synth
+
+PERIODO = 365
+DATA_INDICE = "2021-01-01"
+
+
+def parse_size(s):
+    s = s.strip().lower()
+    mult = {"k": 10**3, "m": 10**6}.get(s[-1], 1)
+    return int(float(s[:-1] if s[-1] in "km" else s) * mult)
+
+
+# ---------- input per motore (preparati fuori dal tempo misurato) ----------
+def _base(n, seed):
+    disp, ddd = synth.generate(n, seed=seed, messy_dates=False)
+    disp, _, _ = cohort.merge_ddd_standard(disp, ddd, "ATC", "ATC", "DDD_standard", "DDD")
+    disp["giorni_coperti"] = cohort.giorni_coperti(disp["DDD"], disp["DDD_standard"])
+    disp["__date"] = disp["DATA"]
+    return disp
+
+
+def _times(disp, seed):
+    """Tempi/eventi/gruppi KM: uno per riga, come un grande registro paziente."""
+    rng = np.random.default_rng(seed)
+    n = len(disp)
+    return (rng.integers(0, 2 * PERIODO, n), (rng.random(n) < 0.4).astype(int),
+            rng.choice(np.array(["A", "B", "C", "D", "E"], dtype=object), n))
+
+
+def _pdc_ref(df):
+    rows = []
+    for _, g in df.sort_values("__date").groupby(["CF", "ATC"], sort=True):
+        rows.append(adherence.calcola_pdc_persistenza(g, g["__date"].min(), PERIODO))
+    return rows
+
+
+def _lines_ref(df):
+    return df.groupby("CF", group_keys=False).apply(lambda g: pathways.assign_lines_by_first_seen(g, "ATC"))
+
+
+def _ader(d, s):
+    ader = adherence.pdc_persistenza(d, ["CF", "ATC"], PERIODO).rename(columns={"ATC": "ATC_unit"})
+    ader["Aderente"] = ader["PDC_persistenza"] >= 0.8
+    return ader
+
+
+def _adh_out(d, s):
+    df, _ = cohort.join_ddd_lookup(d, synth.ddd_table(), "ATC", "ATC", "DDD_standard", "DDD")
+    return adherence.adh_intervalli(cohort.dedup_same_day(df, ["CF", "PRINCIPIO", "__KEY__", "DATA"]),
+                                    "CF", "PRINCIPIO", "DATA", PERIODO)
+
+
+# nome: (prepara input, ottimizzato, riferimento o None)
+ENGINES = {
+    "pdc": (
+        lambda d, s: d,
+        lambda df: adherence.pdc_persistenza(df, ["CF", "ATC"], PERIODO),
+        _pdc_ref,
+    ),
+    "adh": (
+        lambda d, s: d.rename(columns={"giorni_coperti": "__giorni_coperti_disp__"}),
+        lambda df: adherence.adh_intervalli(df, "CF", "ATC", "DATA", PERIODO),
+        lambda df: adherence.adh_intervalli_reference(df, "CF", "ATC", "DATA", PERIODO),
+    ),
+    "prism": (
+        lambda d, s: d[["CF", "DATA", "ATC"]],
+        lambda df: survival.preprocess_prism(df, "CF", "DATA", "ATC", PERIODO, "2024-12-31"),
+        lambda df: survival.preprocess_prism_reference(df, "CF", "DATA", "ATC", PERIODO, pd.Timestamp("2024-12-31")),
+    ),
+    "km": (
+        _times,
+        lambda a: survival.km_curve_from_times(a[0], a[1], PERIODO),
+        lambda a: survival.km_curve_from_times_reference(a[0], a[1], PERIODO),
+    ),
+    "logrank": (
+        _times,
+        lambda a: survival.logrank_prism(*a),
+        lambda a: survival.logrank_prism_reference(*a),
+    ),
+    "linee": (
+        lambda d, s: d[["CF", "ATC"]],
+        lambda df: pathways.assign_lines_first_seen(df, "CF", "ATC"),
+        _lines_ref,
+    ),
+    "flussi": (
+        lambda d, s: d[["CF", "ATC", "DATA"]],
+        lambda df: pathways.compute_flows(df, "CF", "ATC", "DATA", "2019-01-01", "2024-12-31", True, 10, 1.5,
+                                          "Linee terapeutiche", (3, 6, 12, 24), 60, 0, 0, ()),
+        None,
+    ),
+}
+
+# motore tabellare (core/lazy.py): stessa operazione con pandas (`nome`) e con Polars (`nome_polars`)
+TABULAR = {
+    "naive": (
+        lambda d, s: d,
+        lambda df, e: lazy.select_naive(df, ["CF", "ATC"], "DATA", DATA_INDICE, "__first_date", engine=e),
+    ),
+    "merge_ddd": (
+        lambda d, s: (d.drop(columns=["DDD_standard"]), synth.ddd_table()),
+        lambda a, e: lazy.merge_ddd_standard(a[0], a[1], "ATC", "ATC", "DDD_standard", "DDD", engine=e),
+    ),
+    "dedup": (
+        lambda d, s: cohort.join_ddd_lookup(d, synth.ddd_table(), "ATC", "ATC", "DDD_standard", "DDD")[0],
+        lambda df, e: lazy.dedup_same_day(df, ["CF", "PRINCIPIO", "__KEY__", "DATA"], engine=e),
+    ),
+    "riepilogo_pdc": (_ader, lambda df, e: lazy.riepilogo_pdc(df, engine=e)),
+    "riepilogo_adh": (_adh_out, lambda df, e: lazy.riepilogo_adh(df, "PRINCIPIO", 0.8, engine=e)),
+}
+for _name, (_prep, _fn) in TABULAR.items():
+    ENGINES[_name] = (_prep, lambda a, fn=_fn: fn(a, lazy.PANDAS), None)
+    ENGINES[f"{_name}_polars"] = (_prep, lambda a, fn=_fn: fn(a, lazy.POLARS), None)
+
+
+# ---------- misure ----------
+def measure(fn, arg, repeat, memory):
+    """(secondi migliori su `repeat`, picco MB tracemalloc o None)."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn(arg)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return best, peak
+
+
+def run_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "polars": lazy.pl.__version__ if lazy.available() else None,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def previous(history, r):
+    """Ultimo risultato comparabile (stesso motore, variante e righe) nello storico."""
+    for run in reversed(history):
+        for p in run["results"]:
+            if (p["engine"], p["variant"], p["rows"]) == (r["engine"], r["variant"], r["rows"]):
+                return p
+    return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark dei motori su dati sintetici")
+    ap.add_argument("--sizes", default="10k,100k,1M", help="Dimensioni in righe, es. 10k,100k,1M,10M")
+    ap.add_argument("--engines", default=",".join(ENGINES), help=f"Motori ({', '.join(ENGINES)})")
+    ap.add_argument("--ref-max-rows", type=parse_size, default=100_000,
+                    help="Oltre questa dimensione i riferimenti a ciclo non sono eseguiti")
+    ap.add_argument("--repeat", type=int, default=1, help="Ripetizioni per misura (si tiene la migliore)")
+    ap.add_argument("--no-memory", action="store_true", help="Non misurare il picco di memoria")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--history", default="bench_history.json", help="Storico JSON dei risultati")
+    args = ap.parse_args(argv)
+
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        ap.error(f"motori sconosciuti: {', '.join(sorted(unknown))}")
+
+    hist_path = Path(args.history)
+    history = json.loads(hist_path.read_text(encoding="utf-8")) if hist_path.exists() else []
+    results = []
+    for size in map(parse_size, args.sizes.split(",")):
+        base = _base(size, args.seed)
+        n = len(base)
+        print(f"--- {size:,} righe richieste ({n:,} generate, {base['CF'].nunique():,} pazienti)")
+        for name in engines:
+            if name.endswith("_polars") and not lazy.available():
+                print(f"{name:20s} saltato: Polars non installato")
+                continue
+            prep, fast, ref = ENGINES[name]
+            arg = prep(base, args.seed)
+            variants = [("ottimizzato", fast)]
+            if ref is not None and n <= args.ref_max_rows:
+                variants.append(("riferimento", ref))
+            for variant, fn in variants:
+                sec, peak = measure(fn, arg, args.repeat, not args.no_memory)
+                r = {"engine": name, "variant": variant, "rows": size, "rows_generated": n,
+                     "seconds": round(sec, 4), "rows_per_s": round(n / sec) if sec > 0 else None,
+                     "peak_mb": None if peak is None else round(peak, 1)}
+                prev = previous(history, r)
+                delta = f" ({sec / prev['seconds'] - 1:+.0%} vs {prev['seconds']:.3f} s)" if prev else ""
+                mem = "" if peak is None else f", picco {peak:,.0f} MB"
+                print(f"{name:20s} {variant:12s} {sec:9.3f} s  {r['rows_per_s'] or 0:>12,} righe/s{mem}{delta}")
+                results.append(r)
+            del arg
+        del base
+
+    history.append({**run_info(), "results": results})
+    hist_path.write_text(json.dumps(history, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"Storico aggiornato: {hist_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
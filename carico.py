@@ -0,0 +1,291 @@
+"""
+Test di carico: N sessioni simulate in parallelo (Streamlit AppTest) sulle app
+principali, con dati sintetici (core/synth.py).
+
+    python carico.py --app sankey --sessioni 3 --righe 50k
+    python carico.py --app tutte --sessioni 5 --righe 20k --stesso-file
+
+Ogni sessione carica il proprio file (seed diverso, come analisti diversi;
+con --stesso-file tutte lo stesso) ed esegue lo scenario dell'app: apertura,
+upload, calcolo, un cambio di opzione e, dove c'è, un drill-down. Per ogni
+rerun si misura la latenza (fino al termine dei calcoli in background, vedi
+core/jobs.py); il riepilogo riporta p50/p95/max per passo,
+throughput (rerun/s) e memoria. Con i thread (default) le sessioni
+condividono processo e cache come sul server; la memoria per sessione è
+stimata come (picco RSS − base) / N. Con --processi ogni sessione gira in un
+processo separato (senza cache condivisa) e il picco è misurato per sessione.
+Le sessioni partono a `--intervallo` secondi l'una dall'altra (default 0.2):
+con partenze perfettamente simultanee la compilazione concorrente dello
+stesso script nei thread può fallire in CPython 3.11 (SystemError dell'AST).
+AppTest installa un Runtime globale al processo per ogni rerun: con i thread
+i rerun sono quindi serializzati da un lock (l'attesa è contata nella
+latenza, come la coda di un server a un core), mentre i job in background
+delle app continuano in parallelo.
+L'archivio dei risultati (core/store.py) è una cartella temporanea vuota
+per ogni esecuzione, altrimenti i calcoli verrebbero riletti dalle prove
+precedenti; per misurare l'archivio caldo passare `--archivio <cartella>`.
+I risultati sono aggiunti a `carico_storico.json`.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+from bench import parse_size, run_info
+from core import ingestion, lazy, perf, store, synth
+
+ROOT = Path(__file__).parent
+CSV_MIME = "text/csv"
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+_RUN_LOCK = threading.Lock()  # un rerun AppTest alla volta per processo (Runtime globale)
+
+
+# ---------- interazioni (widget cercati per etichetta) ----------
+def _widget(widgets, label):
+    for w in widgets:
+        if label in w.label:
+            return w
+    raise LookupError(f"widget non trovato: {label!r}")
+
+
+def _upload(at, label, name, data):
+    mime = CSV_MIME if name.endswith(".csv") else XLSX_MIME
+    _widget(at.file_uploader, label).set_value((name, data, mime))
+
+
+def _select(at, choices):
+    for label, value in choices:
+        _widget(at.selectbox, label).set_value(value)
+
+
+# ---------- scenari: ogni yield è un rerun misurato ----------
+def scenario_sankey(at, f):
+    yield "apertura"
+    _upload(at, "Carica file Excel", "disp.xlsx", f["disp.xlsx"])
+    yield "upload"
+    _select(at, [("ID paziente", "CF"), ("categoria", "ATC"), ("data erogazione", "DATA")])
+    _widget(at.button, "Avvia").click()
+    yield "calcolo"
+    _widget(at.number_input, "Altezza grafico").set_value(900)
+    yield "opzione grafica"
+    _widget(at.radio, "Seleziona").set_value("Nodo")
+    yield "drill-down"
+
+
+def scenario_km(at, f):
+    yield "apertura"
+    _upload(at, "dispensazioni", "disp.xlsx", f["disp.xlsx"])
+    yield "upload"
+    _select(at, [("identificativo paziente", "CF"), ("data dispensazione", "DATA"), ("stratificazione", "ATC")])
+    _widget(at.button, "Avvia").click()
+    yield "calcolo"
+    _widget(at.number_input, "Periodo").set_value(180)
+    _widget(at.button, "Avvia").click()
+    yield "ricalcolo periodo"
+
+
+def scenario_pdc(at, f):
+    yield "apertura"
+    _upload(at, "dispensazioni", "disp.xlsx", f["disp.xlsx"])
+    _upload(at, "tabella DDD", "ddd.xlsx", f["ddd.xlsx"])
+    yield "upload"
+    _select(at, [("identificativo paziente", "CF"), ("categoria terapeutica", "ATC"), ("data dispensazione", "DATA"),
+                 ("DDD dispensate", "DDD"), ("ATC nella tabella", "ATC"), ("DDD_standard nella", "DDD_standard")])
+    _widget(at.date_input, "Data indice").set_value(f["inizio"])
+    _widget(at.button, "Avvia").click()
+    yield "calcolo"
+    _widget(at.radio, "Unità di analisi").set_value("Per paziente+ATC")
+    _widget(at.button, "Avvia").click()
+    yield "ricalcolo unità"
+    if lazy.available():
+        _widget(at.radio, "Motore tabellare").set_value(lazy.POLARS)
+        _widget(at.button, "Avvia").click()
+        yield "motore polars"
+
+
+def scenario_adh(at, f):
+    yield "apertura"
+    _upload(at, "DISPENSAZIONI", "disp.csv", f["disp.csv"])
+    _upload(at, "LOOKUP", "ddd.csv", f["ddd.csv"])
+    yield "upload"
+    _select(at, [("codice fiscale", "CF"), ("terapia/gruppo", "PRINCIPIO"), ("CHIAVE per join", "ATC"),
+                 ("data erogazione", "DATA"), ("DDD erogate", "DDD"), ("CHIAVE nel lookup", "ATC"),
+                 ("DDD_standard_giornaliera", "DDD_standard")])
+    yield "calcolo"
+    _widget(at.slider, "Soglia").set_value(0.7)
+    yield "cambio soglia"
+
+
+APPS = {
+    "sankey": ("sankey_v10.py", scenario_sankey),
+    "km": ("app_persistenza_km_v8d.py", scenario_km),
+    "pdc": ("app_aderenza_persistenza_v10 (1).py", scenario_pdc),
+    "adh": ("adh_v17.py", scenario_adh),
+    "adh-persistenza": ("adh_v17_persistenza.py", scenario_adh),
+}
+
+
+# ---------- dati ----------
+def make_files(n_rows, seed):
+    """File di upload di una sessione: xlsx per le app che li richiedono, csv per adh."""
+    disp, ddd = synth.generate(n_rows, seed=seed)
+    files = {"inizio": ingestion.safe_dt(disp["DATA"]).min().date()}  # data indice: tutti naïve
+    for name, df in (("disp", disp), ("ddd", ddd)):
+        b = io.BytesIO()
+        df.to_excel(b, index=False)
+        files[f"{name}.xlsx"] = b.getvalue()
+        files[f"{name}.csv"] = df.to_csv(index=False).encode()
+    return files
+
+
+# ---------- sessione ----------
+def _run(at):
+    with _RUN_LOCK:
+        at.run()
+
+
+def _wait_jobs(at, timeout, every=0.2):
+    """Rerun finché la pagina mostra un job in corso (barra di avanzamento): il passo include il calcolo."""
+    t0 = time.perf_counter()
+    while at.get("progress") and time.perf_counter() - t0 < timeout:
+        time.sleep(every)
+        _run(at)
+
+
+def run_session(app, files, timeout, delay=0.0):
+    """Esegue lo scenario in una sessione AppTest; latenze per passo, errori, picco di memoria."""
+    path, scenario = APPS[app]
+    time.sleep(delay)
+    rss0 = perf.rss_mb()
+    at = AppTest.from_file(str(ROOT / path), default_timeout=timeout)
+    steps, errors = [], []
+    t_start = time.perf_counter()
+    try:
+        for step in scenario(at, files):
+            t0 = time.perf_counter()
+            _run(at)
+            _wait_jobs(at, timeout)
+            steps.append({"passo": step, "secondi": time.perf_counter() - t0})
+            errors += [f"{step}: {e.value}" for e in at.exception]
+    except Exception as e:  # widget mancante, timeout: la sessione si ferma, le altre no
+        errors.append(f"{type(e).__name__}: {e}")
+    return {"passi": steps, "errori": errors, "secondi": time.perf_counter() - t_start,
+            "rss_inizio_mb": rss0, "picco_mb": perf.peak_mb()}
+
+
+class _RssSampler(threading.Thread):
+    """Campiona l'RSS del processo durante il test (picco reale, non solo ru_maxrss)."""
+
+    def __init__(self, every=0.2):
+        super().__init__(daemon=True)
+        self.every, self.peak, self._stop_evt = every, perf.rss_mb() or 0.0, threading.Event()
+
+    def run(self):
+        while not self._stop_evt.wait(self.every):
+            self.peak = max(self.peak, perf.rss_mb() or 0.0)
+
+    def stop(self):
+        self._stop_evt.set()
+        self.join()
+        return self.peak
+
+
+def summarize(app, sessions, wall, n, mem_base, mem_peak, processes):
+    lat = pd.DataFrame([{**p, "sessione": i} for i, s in enumerate(sessions) for p in s["passi"]])
+    rows = []
+    if not lat.empty:
+        for step, g in lat.groupby("passo", sort=False):
+            v = g["secondi"].to_numpy()
+            rows.append({"passo": step, "n": len(v), "p50_s": round(float(np.percentile(v, 50)), 3),
+                         "p95_s": round(float(np.percentile(v, 95)), 3), "max_s": round(float(v.max()), 3)})
+    if processes:
+        per_session = [s["picco_mb"] - s["rss_inizio_mb"] for s in sessions
+                       if s["picco_mb"] is not None and s["rss_inizio_mb"] is not None]
+        mem = round(float(np.mean(per_session)), 1) if per_session else None
+    else:
+        mem = round((mem_peak - mem_base) / n, 1) if mem_base else None
+    return {
+        "app": app, "sessioni": n, "processi": processes, "secondi_totali": round(wall, 3),
+        "rerun": len(lat), "rerun_al_s": round(len(lat) / wall, 3) if wall > 0 else None,
+        "p50_s": round(float(lat["secondi"].quantile(0.5)), 3) if len(lat) else None,
+        "p95_s": round(float(lat["secondi"].quantile(0.95)), 3) if len(lat) else None,
+        "rss_base_mb": None if mem_base is None else round(mem_base, 1),
+        "rss_picco_mb": None if mem_peak is None else round(mem_peak, 1),
+        "memoria_per_sessione_mb": mem,
+        "errori": [e for s in sessions for e in s["errori"]],
+        "passi": rows,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Test di carico multi-sessione delle app Streamlit")
+    ap.add_argument("--app", default="sankey", help=f"App ({', '.join(APPS)}) separate da virgola, o 'tutte'")
+    ap.add_argument("--sessioni", type=int, default=3, help="Sessioni simultanee")
+    ap.add_argument("--righe", type=parse_size, default=20_000, help="Righe di dispensazioni per sessione")
+    ap.add_argument("--stesso-file", action="store_true", help="Tutte le sessioni caricano lo stesso file")
+    ap.add_argument("--processi", action="store_true", help="Una sessione per processo (memoria per sessione esatta)")
+    ap.add_argument("--intervallo", type=float, default=0.2, help="Secondi fra l'avvio di una sessione e la successiva")
+    ap.add_argument("--timeout", type=float, default=600, help="Timeout per rerun (s)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", default="carico_storico.json", help="Storico JSON dei risultati")
+    ap.add_argument("--archivio", help="Cartella dell'archivio risultati (default: temporanea, vuota)")
+    args = ap.parse_args(argv)
+    # prima dei processi figli, che ereditano l'ambiente
+    os.environ[store.DIR_ENV] = args.archivio or tempfile.mkdtemp(prefix="carico_archivio_")
+
+    apps = list(APPS) if args.app == "tutte" else [a.strip() for a in args.app.split(",")]
+    unknown = set(apps) - set(APPS)
+    if unknown:
+        ap.error(f"app sconosciute: {', '.join(sorted(unknown))}")
+
+    n = args.sessioni
+    seeds = [args.seed] * n if args.stesso_file else [args.seed + i for i in range(n)]
+    print(f"Preparazione di {len(set(seeds))} file da {args.righe:,} righe…")
+    data = {s: make_files(args.righe, s) for s in set(seeds)}
+
+    results = []
+    for app in apps:
+        sampler = _RssSampler()
+        base = perf.rss_mb()
+        sampler.start()
+        t0 = time.perf_counter()
+        pool = ProcessPoolExecutor if args.processi else ThreadPoolExecutor
+        with pool(n) as ex:
+            sessions = list(ex.map(run_session, [app] * n, [data[s] for s in seeds], [args.timeout] * n,
+                                   [i * args.intervallo for i in range(n)]))
+        wall = time.perf_counter() - t0
+        peak = sampler.stop()
+        if args.processi:  # il processo principale non esegue le sessioni
+            base = peak = None
+        r = summarize(app, sessions, wall, n, base, peak, args.processi)
+        results.append(r)
+
+        print(f"\n=== {app}: {n} sessioni, {r['rerun']} rerun in {wall:.1f} s "
+              f"({r['rerun_al_s']} rerun/s) • p50 {r['p50_s']} s • p95 {r['p95_s']} s")
+        mem = r["memoria_per_sessione_mb"]
+        print(f"memoria: base {r['rss_base_mb']} MB, picco {r['rss_picco_mb']} MB, ~{mem} MB per sessione")
+        if r["passi"]:
+            print(pd.DataFrame(r["passi"]).to_string(index=False))
+        for e in r["errori"][:10]:
+            print("ERRORE", e)
+
+    out = Path(args.out)
+    history = json.loads(out.read_text(encoding="utf-8")) if out.exists() else []
+    history.append({**run_info(), "righe": args.righe, "stesso_file": args.stesso_file, "results": results})
+    out.write_text(json.dumps(history, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nStorico aggiornato: {out}")
+    return 1 if any(r["errori"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
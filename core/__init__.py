@@ -0,0 +1,23 @@
+"""
+Motori di calcolo condivisi dalle app Streamlit (nessuna dipendenza da Streamlit).
+
+- ingestion: lettura file, hash del contenuto, parsing date/colonne
+- cohort:    coorte naïve, merge DDD, Tabella 1
+- adherence: PDC su persistenza, aderenza a intervalli, riepiloghi
+- survival:  preprocessing stile Prism, Kaplan–Meier, log-rank
+- pathways:  linee terapeutiche, regimi, esiti, flussi Sankey
+- export:    Excel in streaming, Parquet e CSV.gz, generati al download e in cache per hash
+- batch:     job senza interfaccia (batch.py)
+- synth:     dati sintetici per benchmark e verifiche (bench.py, equivalenza.py)
+- perf:      tempi/memoria/righe per fase (expander "Performance", log JSON lines)
+- jobs:      coda dei calcoli del server: background, avanzamento, annullamento, limiti
+- plots:     figure leggere per coorti grandi (box da statistiche precalcolate)
+- tables:    ricerca/filtri/ordinamento/pagina delle tabelle di risultato (componente in ui.py)
+- store:     archivio su disco dei risultati per file, parametri e motore (pagina archivio_risultati.py)
+- incremental: stato per paziente degli estratti mensili, aggiornato solo con le righe in coda (batch.py --stato)
+- outofcore: estratti più grandi della RAM a blocchi e shard per paziente, riepiloghi uniti (batch.py --fuori-memoria)
+- lazy:      motore tabellare opzionale su Polars per naïve, merge DDD, duplicati e riepiloghi (stessi risultati di pandas)
+
+Ogni motore ottimizzato vive qui una sola volta; le versioni di riferimento
+(`*_reference`) restano accanto per i confronti di equivalenza.
+"""
@@ -0,0 +1,294 @@
+"""Aderenza: PDC su persistenza reale e aderenza a intervalli (ADH_anno)."""
+import numpy as np
+import pandas as pd
+
+_DAY_NS = 86_400 * 10**9
+_NAT = np.iinfo(np.int64).min  # NaT come int64: "nessun valore" nello stato del kernel
+# stato per unità del kernel PDC (date in ns): inizio, ultimo evento, scorta, giorni coperti, ultimo giorno coperto
+STATE_COLS = ["start", "prev", "stock", "covered", "last"]
+_FLOAT_STATE = ("stock", "covered")
+
+
+# ---------- PDC su persistenza (stock con riporto) ----------
+def calcola_pdc_persistenza(ev, start, periodo):
+    """
+    ev: DataFrame con colonne [__date, 'giorni_coperti'] già ordinate per data.
+    start: inizio osservazione (Timestamp)
+    periodo: giorni (int) della finestra massima
+    Calcola il PDC pesato sugli intervalli ma con denominatore = durata della PERSISTENZA REALE
+    (dalla prima dispensazione fino all'ultimo giorno coperto), troncata alla finestra.
+    Ritorna (pdc_persistenza, giorni_persistenza).
+    Versione di riferimento (una unità per chiamata): il calcolo vettoriale è `pdc_persistenza`.
+    """
+    end = start + pd.Timedelta(days=int(periodo))
+    ev = ev[ev["__date"] < end].copy()
+
+    # Aggiungi un evento fittizio alla 'end' per chiudere l'ultimo intervallo
+    ev = pd.concat([
+        ev,
+        pd.DataFrame([{"__date": end, "giorni_coperti": 0.0}])
+    ], ignore_index=True, axis=0).sort_values("__date")
+
+    prev_date = start
+    stock = 0.0
+    covered_total = 0.0  # numeratore (giorni coperti totali)
+    last_covered = None  # ultimo istante coperto
+
+    for _, row in ev.iterrows():
+        date = row["__date"]
+        interval_len = (date - prev_date).days
+        if interval_len > 0:
+            used = min(stock, interval_len)
+            covered_total += used
+            if used > 0:
+                last_covered = prev_date + pd.Timedelta(days=int(used))
+            stock -= used
+        stock += float(row["giorni_coperti"])
+        prev_date = date
+
+    if last_covered is None:
+        # nessuna copertura
+        giorni_persistenza = 0
+        pdc_persistenza = 0.0
+    else:
+        giorni_persistenza = max((min(last_covered, end) - start).days, 0)
+        pdc_persistenza = covered_total / giorni_persistenza if giorni_persistenza > 0 else 0.0
+
+    return float(min(max(pdc_persistenza, 0.0), 1.0)), int(giorni_persistenza)
+
+
+def _pdc_kernel(ptr, dates, cov, periodo, progress=None, chunk=5_000, init=None):
+    """
+    Stesso ciclo di `calcola_pdc_persistenza` su array piatti (date in ns int64,
+    unità contigue delimitate da `ptr`): stesse operazioni in virgola mobile
+    nello stesso ordine, quindi risultati identici, senza DataFrame per unità.
+    `progress(frazione, messaggio)` è chiamata ogni `chunk` unità.
+    `init` (opzionale): stato di partenza per unità, {colonna di `STATE_COLS`:
+    array} con le date in ns (`start` NaT = unità nuova). Ritorna (pdc, giorni, stato), con
+    lo stato prima dell'evento fittizio di fine finestra: le dispensazioni
+    successive ripartono da lì come se fossero state nello stesso estratto.
+    """
+    span = int(periodo) * _DAY_NS
+    dates = dates.tolist()
+    cov = cov.tolist()
+    n_units = len(ptr) - 1
+    pdc = np.zeros(n_units)
+    days = np.zeros(n_units, dtype=np.int64)
+    state = {c: np.zeros(n_units, dtype=float if c in _FLOAT_STATE else np.int64) for c in STATE_COLS}
+    if init is not None:
+        init = {c: np.asarray(init[c]).tolist() for c in STATE_COLS}
+    for u in range(n_units):
+        if progress is not None and u % chunk == 0:
+            progress(u / max(n_units, 1), f"PDC: {u:,} / {n_units:,} unità")
+        a, b = int(ptr[u]), int(ptr[u + 1])
+        if init is not None and init["start"][u] != _NAT:
+            start, prev, stock, covered = init["start"][u], init["prev"][u], init["stock"][u], init["covered"][u]
+            last = None if init["last"][u] == _NAT else init["last"][u]
+        else:
+            start = dates[a]
+            prev = start
+            stock = 0.0
+            covered = 0.0
+            last = None
+        end = start + span
+        for i in range(a, b):
+            d = dates[i]
+            if d >= end:
+                continue
+            interval = (d - prev) // _DAY_NS
+            if interval > 0:
+                used = min(stock, interval)
+                covered += used
+                if used > 0:
+                    last = prev + int(used) * _DAY_NS
+                stock -= used
+            stock += cov[i]
+            prev = d
+        state["start"][u], state["prev"][u], state["stock"][u], state["covered"][u] = start, prev, stock, covered
+        state["last"][u] = _NAT if last is None else last
+        # evento fittizio a fine finestra
+        interval = (end - prev) // _DAY_NS
+        if interval > 0:
+            used = min(stock, interval)
+            covered += used
+            if used > 0:
+                last = prev + int(used) * _DAY_NS
+        if last is not None:
+            giorni = max((min(last, end) - start) // _DAY_NS, 0)
+            val = covered / giorni if giorni > 0 else 0.0
+            pdc[u] = min(max(val, 0.0), 1.0)
+            days[u] = giorni
+    return pdc, days, state
+
+
+def pdc_persistenza(df, keys, periodo, date_col="__date", cov_col="giorni_coperti", progress=None,
+                    init=None, with_state=False):
+    """
+    PDC su persistenza per ogni unità (chiavi `keys`, es. paziente o paziente+ATC)
+    in un solo passaggio: ordinamento unico per (unità, data), poi il kernel a
+    array. Inizio osservazione = prima dispensazione dell'unità.
+    `progress` (opzionale, vedi core/jobs.py) riceve l'avanzamento a blocchi di unità.
+    Ritorna DataFrame [keys..., PDC_persistenza, Persistenza_giorni].
+
+    Ricalcolo incrementale (core/incremental.py): `init` è lo stato salvato
+    [keys..., STATE_COLS] delle unità già viste, da cui riprendono le righe di
+    `df` (tutte non precedenti all'ultima dispensazione dell'unità); con
+    `with_state=True` le colonne di stato sono aggiunte al risultato.
+    """
+    keys = list(keys)
+    d = df[keys + [date_col, cov_col]].dropna(subset=keys)
+    codes = d.groupby(keys, sort=True).ngroup().to_numpy()
+    order = np.lexsort((d[date_col].to_numpy(), codes))
+    codes = codes[order]
+    n_units = int(codes.max()) + 1 if len(codes) else 0
+    ptr = np.zeros(n_units + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_units), out=ptr[1:])
+    dates = d[date_col].to_numpy("datetime64[ns]").view(np.int64)[order]
+    cov = d[cov_col].to_numpy(dtype=float)[order]
+    out = d.iloc[order[ptr[:-1]]][keys].reset_index(drop=True)
+    if init is not None:
+        init = out.merge(init[keys + STATE_COLS], on=keys, how="left")
+        init = {c: init[c].fillna(0.0).to_numpy(float) if c in _FLOAT_STATE
+                else init[c].to_numpy("datetime64[ns]").view(np.int64) for c in STATE_COLS}
+    pdc, days, state = _pdc_kernel(ptr, dates, cov, periodo, progress, init=init)
+    out["PDC_persistenza"] = pdc
+    out["Persistenza_giorni"] = days.astype(int)
+    if with_state:
+        for c in STATE_COLS:
+            out[c] = state[c] if c in _FLOAT_STATE else state[c].view("datetime64[ns]")
+    return out
+
+
+def riepilogo_pdc(aderenza, by="ATC_unit", value="PDC_persistenza", flag="Aderente"):
+    """N, aderenti, media/DS/quantili/min/max del PDC per gruppo (riduzioni native)."""
+    g = aderenza.groupby(by)[value]
+    out = aderenza.groupby(by).agg(
+        N_unit=(value, "count"),
+        N_aderenti=(flag, "sum"),
+        PDC_medio=(value, "mean"),
+        PDC_std=(value, "std"),
+        P50=(value, "median"),
+    )
+    q = g.quantile([0.10, 0.90]).unstack()
+    out["P10"] = q[0.10]
+    out["P90"] = q[0.90]
+    out["PDC_min"] = g.min()
+    out["PDC_max"] = g.max()
+    out = out.reset_index()
+    out["%_aderenti"] = (100 * out["N_aderenti"] / out["N_unit"]).round(1)
+    return out
+
+
+# ---------- aderenza a intervalli (ADH_anno) ----------
+def adh_intervalli_reference(disp, col_cf, col_ther, col_date, period_days, cov_col="__giorni_coperti_disp__",
+                             denominatore="periodo"):
+    """
+    Versione di riferimento (ciclo per paziente × terapia) dell'aderenza a intervalli:
+    coperti_i = min(giorni coperti, durata intervallo), ultimo intervallo troncato
+    a fine periodo. Denominatore "periodo" (ADH sul periodo) o "persistenza"
+    (dalla prima dispensazione all'ultimo giorno coperto).
+    """
+    results_rows = []
+    for (cf, ther), g in disp.sort_values(col_date).groupby([col_cf, col_ther], sort=False):
+        t0 = g[col_date].min()
+        fine = t0 + pd.Timedelta(days=int(period_days))
+        gg = g[g[col_date].between(t0, fine, inclusive="left")].sort_values(col_date).reset_index(drop=True)
+        if gg.empty:
+            continue
+
+        total_covered = 0.0
+        last_covered = None  # ultimo istante coperto (per definire la persistenza)
+        for i, r in gg.iterrows():
+            start_i = r[col_date]
+            next_date = gg.loc[i+1, col_date] if i < len(gg)-1 else fine
+            end_i = min(next_date, fine)
+            delta_i = (end_i - start_i).days
+            if delta_i <= 0:
+                continue
+            covered_i = min(float(r[cov_col]), float(delta_i))
+            total_covered += covered_i
+            if covered_i > 0:
+                lc = start_i + pd.Timedelta(days=covered_i)
+                last_covered = lc if (last_covered is None or lc > last_covered) else last_covered
+
+        if denominatore == "persistenza":
+            if last_covered is None:
+                ADH_anno = 0.0
+            else:
+                pers_end = min(last_covered, fine)
+                dur_persistenza = max((pers_end - t0).days, 0)
+                ADH_anno = max(0.0, min(total_covered / float(dur_persistenza) if dur_persistenza > 0 else 0.0, 1.0))
+        else:
+            ADH_anno = max(0.0, min(total_covered / float(period_days), 1.0))
+        results_rows.append({col_cf: cf, col_ther: ther, "ADH_anno": ADH_anno})
+    return pd.DataFrame(results_rows)
+
+
+def adh_intervalli(disp, col_cf, col_ther, col_date, period_days, cov_col="__giorni_coperti_disp__",
+                   denominatore="periodo"):
+    """
+    Aderenza a intervalli vettoriale, stesso risultato di `adh_intervalli_reference`:
+    un ordinamento per (paziente, terapia, data), shift per la data successiva,
+    somme per unità con bincount. Più dispensazioni della stessa unità nello
+    stesso giorno (senza dedup) seguono l'ordine di input: nel riferimento il
+    loro ordine, e quindi quale riga chiude l'intervallo, dipende dal sort instabile.
+    """
+    keys = [col_cf, col_ther]
+    d = disp[list(dict.fromkeys(keys + [col_date, cov_col]))].dropna(subset=keys)
+    if d.empty:
+        return pd.DataFrame(columns=keys + ["ADH_anno"])
+    # unità numerate come nel riferimento: ordine di prima comparsa sulle righe ordinate per data
+    d = d.assign(__u__=d.sort_values(col_date, kind="stable").groupby(keys, sort=False).ngroup())
+    d = d.sort_values(["__u__", col_date], kind="stable")
+    u = d["__u__"].to_numpy()
+    t = d[col_date].to_numpy("datetime64[ns]").view(np.int64)
+    first = np.ones(len(d), dtype=bool)
+    first[1:] = u[1:] != u[:-1]
+    t0 = np.maximum.accumulate(np.where(first, np.arange(len(d)), 0))
+    t0 = t[t0]
+    fine = t0 + int(period_days) * _DAY_NS
+    keep = t < fine
+    u, t, t0, fine = u[keep], t[keep], t0[keep], fine[keep]
+    cov = d[cov_col].to_numpy(dtype=float)[keep]
+
+    last = np.ones(len(u), dtype=bool)
+    last[:-1] = u[1:] != u[:-1]
+    nxt = np.where(last, fine, np.roll(t, -1))
+    delta = (np.minimum(nxt, fine) - t) // _DAY_NS
+    with np.errstate(invalid="ignore"):
+        covered = np.where(delta > 0, np.minimum(cov, delta), 0.0)
+
+    n_u = int(u.max()) + 1
+    total = np.bincount(u, weights=covered, minlength=n_u)
+    if denominatore == "persistenza":
+        has = (covered > 0) & (delta > 0)
+        lc = np.full(n_u, np.iinfo(np.int64).min)
+        # stessa conversione di pd.Timedelta(days=x): int(((x * 24) * 3600) * 1e9), troncata
+        np.maximum.at(lc, u[has], t[has] + np.trunc(covered[has] * 24 * 3600 * 1e9).astype(np.int64))
+        t0_u = np.zeros(n_u, dtype=np.int64)
+        t0_u[u] = t0
+        fine_u = t0_u + int(period_days) * _DAY_NS
+        dur = np.maximum((np.minimum(lc, fine_u) - t0_u) // _DAY_NS, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            adh = np.where((lc > np.iinfo(np.int64).min) & (dur > 0), total / dur, 0.0)
+    else:
+        adh = total / float(period_days)
+    adh = np.nan_to_num(np.clip(adh, 0.0, 1.0), nan=0.0)
+
+    present = np.bincount(u, minlength=n_u) > 0
+    head = d[~d["__u__"].duplicated()].set_index("__u__")[keys]
+    out = head.loc[np.flatnonzero(present)].reset_index(drop=True)
+    out["ADH_anno"] = adh[present]
+    return out
+
+
+def riepilogo_adh(out, group_by_col, thr):
+    """Media, DS, N e % ≥ soglia dell'ADH per gruppo, ordinato per media decrescente."""
+    grp = out.groupby(group_by_col, dropna=False)["ADH_anno"]
+    return pd.DataFrame({
+        group_by_col: grp.mean().index,
+        "Media_ADH": grp.mean().round(4).values,
+        "DS_ADH": grp.std(ddof=1).round(4).values,
+        "N_paz": grp.count().values,
+        "%_≥_soglia": (out.assign(_hit=out["ADH_anno"] >= thr).groupby(group_by_col)["_hit"].mean() * 100).round(2).values,
+    }).sort_values("Media_ADH", ascending=False)
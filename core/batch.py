@@ -0,0 +1,514 @@
+"""
+Esecuzione senza interfaccia: job di analisi (PDC, KM/log-rank, Sankey) descritti
+da una specifica YAML/JSON, in parallelo su più processi, con output Parquet ed Excel.
+Per estratti più grandi della RAM `run_sharded` esegue gli stessi job shard per
+shard (core/outofcore.py).
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import adherence, cohort, export, incremental, ingestion, lazy, outofcore, pathways, store, survival
+from .ingestion import safe_dt, safe_dt_like
+
+try:  # opzionale: senza PyYAML si usano specifiche JSON
+    import yaml
+except ImportError:
+    yaml = None
+
+# parametri di default per tipo di job (stessi default dei form delle app)
+DEFAULTS = {
+    "pdc": dict(periodo=365, soglia=0.80, naive="paziente", unita="paziente", motore=lazy.PANDAS),
+    "km": dict(periodo=365),
+    "sankey": dict(collapse=True, min_flow=10, per_src_min=1.5, mode="Linee terapeutiche",
+                   checkpoints=[3, 6, 12, 24], grace_days=60, regimen_window=0, gap_days=0,
+                   non_study=[], n_boot=0),
+}
+
+
+def load_spec(path):
+    """Specifica dei job da file .yaml/.yml o .json."""
+    text = Path(path).read_text(encoding="utf-8")
+    if str(path).lower().endswith((".yaml", ".yml")):
+        if yaml is None:
+            raise RuntimeError("PyYAML non installato: usa una specifica JSON o `pip install pyyaml`.")
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def expand_jobs(spec, df):
+    """
+    Lista piatta dei job: colonne globali + override del job, default per tipo,
+    e un job per valore della colonna `per` (es. una classe ATC per job).
+    """
+    jobs = []
+    for k, job in enumerate(spec.get("jobs", [])):
+        tipo = job["tipo"]
+        if tipo not in RUNNERS:
+            raise ValueError(f"Tipo di job sconosciuto: {tipo!r} (ammessi: {', '.join(RUNNERS)})")
+        base = {**DEFAULTS[tipo], **job}
+        base["colonne"] = {**spec.get("colonne", {}), **job.get("colonne", {})}
+        base.setdefault("nome", f"{tipo}_{k + 1}")
+        per = base.pop("per", None)
+        if per is None:
+            jobs.append(base)
+            continue
+        for val in sorted(df[per].dropna().unique(), key=str):
+            jobs.append({**base, "nome": f"{base['nome']}_{val}", "filtro": {**base.get("filtro", {}), per: [val]}})
+    return jobs
+
+
+def _apply_filter(df, filtro):
+    for col, vals in (filtro or {}).items():
+        df = df[df[col].isin(vals if isinstance(vals, (list, tuple)) else [vals])]
+    return df
+
+
+# ---------- job ----------
+def run_pdc(df, ddd, c, p):
+    """PDC su persistenza per unità (come app_aderenza_persistenza_v10)."""
+    df = df.copy()
+    df[c["data"]] = safe_dt(df[c["data"]])
+    df = df.dropna(subset=[c["data"]])
+    motore = p.get("motore", lazy.PANDAS)
+    df, _, _ = lazy.merge_ddd_standard(df, ddd, c["atc"], c["atc_ddd"], c["ddd_std"], c["ddd"], engine=motore)
+    naive_keys = [c["id"]] if p["naive"] == "paziente" else [c["id"], c["atc"]]
+    df = lazy.select_naive(df, naive_keys, c["data"], p["data_indice"], first_col="__first_date", engine=motore)
+    if df.empty:
+        return {}, "Nessun paziente/ATC naïve secondo i criteri selezionati."
+    df["giorni_coperti"] = cohort.giorni_coperti(df[c["ddd"]], df["DDD_standard"])
+    df["__date"] = df[c["data"]]
+    if p["unita"] == "paziente":
+        ader = adherence.pdc_persistenza(df, [c["id"]], p["periodo"])
+        ader.insert(1, "ATC_unit", cohort.group_mode(df, [c["id"]], c["atc"]).reindex(ader[c["id"]]).to_numpy())
+    else:
+        ader = adherence.pdc_persistenza(df, [c["id"], c["atc"]], p["periodo"]).rename(columns={c["atc"]: "ATC_unit"})
+    return _pdc_tables(ader, p)
+
+
+def _pdc_tables(ader, p):
+    ader["Aderente"] = ader["PDC_persistenza"] >= p["soglia"]
+    riepilogo = lazy.riepilogo_pdc(ader, engine=p.get("motore", lazy.PANDAS))
+    return {"PDC_persistenza_unita": ader, "Riepilogo_ATC_unit": riepilogo}, None
+
+
+def run_km(df, ddd, c, p):
+    """Tempo/evento stile Prism, curve KM per gruppo e log-rank (come app_persistenza_km_v8d)."""
+    cutoff = pd.Timestamp(p["cutoff"]) if p.get("cutoff") else safe_dt(df[c["data"]]).max()
+    full, included, _ = survival.preprocess_prism(df, c["id"], c["data"], c["strat"], int(p["periodo"]), cutoff)
+    return _km_tables(full, included, p)
+
+
+def _km_tables(full, included, p):
+    return {
+        "preprocess_all": full,
+        "tempo_evento_inclusi": included,
+        **_km_stats(included["gruppo"], included["time"], included["event"], p),
+    }, None
+
+
+def _km_stats(gruppo, time, event, p, weights=None):
+    """Curve KM per gruppo e log-rank; `weights`: pazienti per riga, per righe già aggregate (fuori memoria)."""
+    d = pd.DataFrame({"gruppo": np.asarray(gruppo), "time": np.asarray(time), "event": np.asarray(event),
+                      "n": np.ones(len(gruppo), np.int64) if weights is None else np.asarray(weights)})
+    curves = []
+    for strat, g in d.groupby("gruppo"):
+        t, s = survival.km_curve_from_times(g["time"].to_numpy(), g["event"].to_numpy(), int(p["periodo"]),
+                                            g["n"].to_numpy())
+        curves.append(pd.DataFrame({"gruppo": strat, "time": t, "S": s}))
+    chi2, pval, k, _ = survival.logrank_prism(
+        d["time"].to_numpy(), d["event"].to_numpy(), d["gruppo"].to_numpy(), weights=d["n"].to_numpy()
+    )
+    return {
+        "km_curve": pd.concat(curves, ignore_index=True) if curves else None,
+        "logrank": pd.DataFrame([{"chi2": chi2, "df": k - 1, "p_value": pval}]),
+    }
+
+
+def run_sankey(df, ddd, c, p):
+    """Flussi Sankey, tempo allo switch e matrici di transizione (come sankey_v10)."""
+    dates = safe_dt(df[c["data"]])
+    res, msg = pathways.compute_flows(
+        df, c["id"], c["atc"], c["data"],
+        p.get("cutoff_naive") or dates.min(), p.get("cutoff_fu") or dates.max(),
+        bool(p["collapse"]), int(p["min_flow"]), float(p["per_src_min"]), p["mode"],
+        tuple(sorted(p["checkpoints"])), int(p["grace_days"]), int(p["regimen_window"]),
+        int(p["gap_days"]), tuple(p["non_study"]),
+    )
+    if res is None:
+        return {}, msg
+    return _sankey_tables(res, p)
+
+
+def _sankey_tables(res, p):
+    out = {"links": res["links"], "km_switch": res["km"]}
+    if int(p["n_boot"]) > 0 and res["line_trans"] is not None and not res["line_trans"].empty:
+        # fuori memoria: switch già contati per (categorie, data), colonna n
+        out["transizioni_anno"] = pathways.transition_matrices(res["line_trans"], int(p["n_boot"]),
+                                                               res["line_trans"].get("n"))
+    return out, None
+
+
+RUNNERS = {"pdc": run_pdc, "km": run_km, "sankey": run_sankey}
+# tabelle di output dal risultato del ricalcolo incrementale (stesse code dei job completi)
+_TABLES = {"pdc": _pdc_tables, "km": lambda r, p: _km_tables(*r, p), "sankey": _sankey_tables}
+
+
+# ---------- ricalcolo incrementale ----------
+def _signature(job, ddd):
+    """Lo stato vale solo per gli stessi parametri, la stessa tabella DDD (PDC) e lo stesso motore."""
+    inputs = [incremental.frame_hash(ddd)] if job["tipo"] == "pdc" else []
+    engine = store.engine_version(incremental, adherence, cohort, ingestion, lazy, outofcore, pathways, survival, __file__)
+    return store.key("incrementale", inputs, job, engine)
+
+
+def run_incremental(job, df, ddd, state_dir, hashes, rebuild=False):
+    """
+    Come `RUNNERS[tipo]`, ma aggiornando lo stato salvato in `state_dir` con le
+    sole righe oltre quelle dell'estratto precedente (core/incremental.py).
+    `df` è l'estratto filtrato per il job con l'indice di riga dell'estratto
+    intero, `hashes` gli hash per riga dell'estratto intero. Lo stato si
+    ricostruisce da zero se manca, se parametri/DDD/motore sono cambiati, se le
+    righe già viste non coincidono o con `rebuild`. Ritorna (tabelle, messaggio, info).
+    """
+    update, result = incremental.ENGINES[job["tipo"]]
+    firma = _signature(job, ddd)
+    state, meta = (None, None) if rebuild else incremental.load(state_dir)
+    n_old = 0
+    if (meta is not None and meta.get("firma") == firma and meta["n_righe"] <= len(hashes)
+            and meta["prefisso"] == incremental.prefix_digest(hashes, meta["n_righe"])):
+        n_old = meta["n_righe"]
+    else:
+        state = None
+    state, info = update(state, df, ddd, df.index.to_numpy() >= n_old, job["colonne"], job)
+    incremental.save(state_dir, state, dict(firma=firma, n_righe=len(hashes),
+                                            prefisso=incremental.prefix_digest(hashes, len(hashes))))
+    info["modo"] = "incrementale" if n_old else "completo"
+    res, msg = result(state, job["colonne"], job)
+    if res is None:
+        return {}, msg, info
+    tables, _ = _TABLES[job["tipo"]](res, job)
+    return tables, None, info
+
+
+def compare_tables(a, b):
+    """Differenze fra le tabelle di due esecuzioni dello stesso job ([] se identiche)."""
+    if set(a) != set(b):
+        return [f"tabelle {sorted(a)} ≠ {sorted(b)}"]
+    diff = []
+    for name in a:
+        if (a[name] is None) != (b[name] is None):
+            diff.append(f"{name}: presente in una sola esecuzione")
+            continue
+        try:
+            if a[name] is not None:
+                pd.testing.assert_frame_equal(a[name], b[name], check_exact=True)
+        except AssertionError as e:
+            diff.append(f"{name}: {' '.join(str(e).split())[:300]}")
+    return diff
+
+
+# ---------- esecuzione ----------
+def write_outputs(tables, out_dir, formats=("parquet", "xlsx")):
+    """Un file Parquet (o CSV.gz) per tabella e un Excel con un foglio per tabella, scritto in streaming."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tables = {k: v for k, v in tables.items() if v is not None}
+    if "parquet" in formats:
+        for name, t in tables.items():
+            t.to_parquet(out_dir / f"{name}.parquet", index=False)
+    if "csv.gz" in formats:
+        for name, t in tables.items():
+            export.write_csv_gz(t, out_dir / f"{name}.csv.gz")
+    if "xlsx" in formats and tables:
+        export.write_xlsx(tables, out_dir / "risultati.xlsx")
+
+
+_DATA = {}
+
+
+def _init_worker(df, ddd, incr=None):
+    """Dati condivisi dal processo: arrivano una volta per worker, non per job."""
+    _DATA["df"], _DATA["ddd"], _DATA["incr"] = df, ddd, incr or {}
+
+
+def _hashes():
+    if "hashes" not in _DATA:  # una volta per worker, solo se serve
+        _DATA["hashes"] = incremental.row_hashes(_DATA["df"])
+    return _DATA["hashes"]
+
+
+def _run_job(job, out_root, formats):
+    t0 = time.perf_counter()
+    summary = {"nome": job["nome"], "tipo": job["tipo"]}
+    try:
+        df = _apply_filter(_DATA["df"], job.get("filtro"))
+        incr = _DATA["incr"]
+        motivo = incremental.unsupported(job) if incr.get("stato") else None
+        if incr.get("stato") and motivo is None:
+            tables, msg, summary["incrementale"] = run_incremental(
+                job, df, _DATA["ddd"], Path(incr["stato"]) / job["nome"], _hashes(), incr.get("completo", False))
+            if incr.get("verifica"):
+                full, _ = RUNNERS[job["tipo"]](df, _DATA["ddd"], job["colonne"], job)
+                summary["verifica"] = compare_tables(full, tables) or "ok"
+        else:
+            tables, msg = RUNNERS[job["tipo"]](df, _DATA["ddd"], job["colonne"], job)
+            if motivo:
+                summary["incrementale"] = {"modo": "completo", "motivo": motivo}
+        write_outputs(tables, Path(out_root) / job["nome"], formats)
+        summary.update(righe_input=len(df), tabelle={k: len(v) for k, v in tables.items() if v is not None},
+                       messaggio=msg)
+    except Exception as e:  # un job fallito non ferma gli altri
+        summary["errore"] = f"{type(e).__name__}: {e}"
+    summary["secondi"] = round(time.perf_counter() - t0, 3)
+    return summary
+
+
+def run_batch(df, ddd, jobs, out_root, workers=None, formats=("parquet", "xlsx"), log=print,
+              stato=None, completo=False, verifica=False):
+    """
+    Esegue i job (in parallelo su `workers` processi, default = tutti i core) e
+    scrive `riepilogo.json` in `out_root`. Ritorna la lista dei riepiloghi per job.
+    Con `stato` (cartella) i job PDC, KM e Sankey per linee ripartono dallo
+    stato del mese precedente (core/incremental.py): `completo` lo ricostruisce
+    da zero, `verifica` esegue anche il ricalcolo completo e confronta le tabelle.
+    """
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    incr = dict(stato=stato, completo=completo, verifica=verifica) if stato else {}
+    if stato:
+        df = df.reset_index(drop=True)  # indice = posizione nell'estratto
+    results = []
+    if workers == 1:
+        _init_worker(df, ddd, incr)
+        for job in jobs:
+            results.append(_run_job(job, out_root, formats))
+            log(_fmt(results[-1]))
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(df, ddd, incr)) as ex:
+            futs = [ex.submit(_run_job, job, out_root, formats) for job in jobs]
+            for f in as_completed(futs):
+                results.append(f.result())
+                log(_fmt(results[-1]))
+    order = {j["nome"]: i for i, j in enumerate(jobs)}
+    results.sort(key=lambda r: order[r["nome"]])
+    _write_summary(results, out_root)
+    return results
+
+
+def _write_summary(results, out_root):
+    Path(out_root).mkdir(parents=True, exist_ok=True)
+    (Path(out_root) / "riepilogo.json").write_text(json.dumps(results, indent=2, ensure_ascii=False, default=str),
+                                                   encoding="utf-8")
+
+
+def _fmt(r):
+    stato = f"ERRORE {r['errore']}" if "errore" in r else (r.get("messaggio") or "ok")
+    inc = r.get("incrementale")
+    if inc and inc["modo"] == "incrementale":
+        stato += (f" [incrementale: {inc['righe']:,} righe nuove, {inc['pazienti_aggiornati']:,} pazienti aggiornati, "
+                  f"{inc['pazienti_ricostruiti']:,} ricostruiti]")
+    elif inc:
+        stato += f" [ricalcolo completo{': ' + inc['motivo'] if inc.get('motivo') else ''}]"
+    if "verifica" in r:
+        stato += " [verifica: " + ("ok" if r["verifica"] == "ok" else "DIFFERENZE " + "; ".join(r["verifica"])) + "]"
+    return f"[{r['tipo']}] {r['nome']}: {stato} ({r['secondi']} s)"
+
+
+# ---------- fuori memoria ----------
+def _shard_pdc(df, ddd, c, p):
+    tables, msg = run_pdc(df, ddd, c, p)
+    if not tables:
+        return None, {}, msg
+    ader = tables["PDC_persistenza_unita"]
+    return outofcore.pdc_partial(ader), {"PDC_persistenza_unita": ader}, None
+
+
+def _shard_km(df, ddd, c, p):
+    full, included, _ = survival.preprocess_prism(df, c["id"], c["data"], c["strat"], int(p["periodo"]), p["cutoff"])
+    return outofcore.km_partial(included), {"preprocess_all": full, "tempo_evento_inclusi": included}, None
+
+
+def _shard_sankey(df, ddd, c, p):
+    out, msg = pathways.flow_transitions(
+        df, c["id"], c["atc"], c["data"], p["cutoff_naive"], p["cutoff_fu"], bool(p["collapse"]), p["mode"],
+        tuple(sorted(p["checkpoints"])), int(p["grace_days"]), int(p["regimen_window"]), int(p["gap_days"]),
+        tuple(p["non_study"]), data_end=p.get("data_end"),
+    )
+    if out is None:
+        return None, {}, msg
+    return outofcore.sankey_partial(out["trans"], out["surv"]), {}, None
+
+
+def _merge_km(parts, p):
+    t = outofcore.merge_counts(parts, ["gruppo", "time", "event"])
+    if t is None:
+        t = pd.DataFrame({"gruppo": [], "time": [], "event": [], "n": []})
+    return _km_stats(t["gruppo"], t["time"], t["event"], p, t["n"]), None
+
+
+def _merge_sankey(parts, p):
+    res, msg = outofcore.sankey_result(parts, p["min_flow"], p["per_src_min"])
+    return ({}, msg) if res is None else _sankey_tables(res, p)
+
+
+# tipo → (parziale di uno shard: (parziale, tabelle per unità, messaggio), unione dei parziali: (tabelle, messaggio))
+SHARDED = {
+    "pdc": (_shard_pdc, lambda parts, p: ({"Riepilogo_ATC_unit": outofcore.pdc_summary(parts)}, None)),
+    "km": (_shard_km, _merge_km),
+    "sankey": (_shard_sankey, _merge_sankey),
+}
+# tabelle per paziente/unità: una parte per shard, mai unite in memoria
+UNIT_TABLES = {"pdc": ["PDC_persistenza_unita"], "km": ["preprocess_all", "tempo_evento_inclusi"], "sankey": []}
+
+
+def _shard_frame(df, job, anchor):
+    """Righe dello shard per il job, con le date convertite nel formato dedotto sull'estratto filtrato."""
+    c = job["colonne"]
+    df = _apply_filter(df, job.get("filtro"))
+    return df.assign(**{c["data"]: safe_dt_like(df[c["data"]], anchor)})
+
+
+def _shard_anchors(path, jobs):
+    df = pd.read_parquet(path)
+    return [outofcore.first_date(_apply_filter(df, j.get("filtro")), j["colonne"]["data"]) for j in jobs]
+
+
+def _shard_bounds(path, jobs, anchors):
+    df = pd.read_parquet(path)
+    out = []
+    for job, anchor in zip(jobs, anchors):
+        d = _shard_frame(df, job, anchor)[job["colonne"]["data"]]
+        out.append((d.min(), d.max()))
+    return out
+
+
+def _needs_bounds(job):
+    if job["tipo"] == "km":
+        return not job.get("cutoff")
+    # esiti con gap_days: serve la fine dell'estratto intero, non quella dello shard
+    return job["tipo"] == "sankey" and not (job.get("cutoff_naive") and job.get("cutoff_fu") and not job.get("gap_days"))
+
+
+def _with_bounds(job, lo, hi):
+    """Cutoff di default (e fine dei dati per gli esiti) come i job in memoria: min/max delle date dell'estratto filtrato."""
+    if job["tipo"] == "km":
+        return {**job, "cutoff": job.get("cutoff") or hi}
+    if job["tipo"] == "sankey":
+        return {**job, "cutoff_naive": job.get("cutoff_naive") or lo, "cutoff_fu": job.get("cutoff_fu") or hi,
+                "data_end": hi}
+    return job
+
+
+def _run_shard(job, k, path, anchor, out_root):
+    t0 = time.perf_counter()
+    out = {"parziale": None, "messaggio": None, "righe": 0, "tabelle": {}}
+    try:
+        df = _shard_frame(pd.read_parquet(path), job, anchor).drop(columns=outofcore.ROW_COL)
+        out["righe"] = len(df)
+        if df.empty:
+            out["messaggio"] = "Nessun record dopo i filtri."
+        else:
+            out["parziale"], units, out["messaggio"] = SHARDED[job["tipo"]][0](df, _DATA["ddd"], job["colonne"], job)
+            for name, t in units.items():
+                d = Path(out_root) / job["nome"] / name
+                d.mkdir(parents=True, exist_ok=True)
+                t.to_parquet(d / f"part-{k:05d}.parquet", index=False)
+                out["tabelle"][name] = len(t)
+    except Exception as e:  # l'errore arriva al job, gli altri shard proseguono
+        out["errore"] = f"{type(e).__name__}: {e}"
+    out["secondi"] = time.perf_counter() - t0
+    return out
+
+
+def _merge_job(job, shard_results, out_root, formats):
+    t0 = time.perf_counter()
+    summary = {"nome": job["nome"], "tipo": job["tipo"], "shard": len(shard_results)}
+    try:
+        errors = [r["errore"] for r in shard_results if "errore" in r]
+        if errors:
+            raise RuntimeError(errors[0])
+        parts = [r["parziale"] for r in shard_results if r["parziale"] is not None]
+        if parts:
+            tables, msg = SHARDED[job["tipo"]][1](parts, job)
+        else:
+            tables, msg = {}, next((r["messaggio"] for r in shard_results if r["messaggio"]), None)
+        write_outputs(tables, Path(out_root) / job["nome"], formats)
+        units = {}
+        for r in shard_results:
+            for name, n in r["tabelle"].items():
+                units[name] = units.get(name, 0) + n
+        summary.update(righe_input=sum(r["righe"] for r in shard_results),
+                       tabelle={**units, **{k: len(v) for k, v in tables.items() if v is not None}}, messaggio=msg)
+    except Exception as e:
+        summary["errore"] = f"{type(e).__name__}: {e}"
+    summary["secondi"] = round(sum(r["secondi"] for r in shard_results) + time.perf_counter() - t0, 3)
+    return summary
+
+
+def _pool_map(ex, fn, calls):
+    """`fn(*args)` per ogni chiamata, nel pool `ex` (o qui se None); risultati nell'ordine delle chiamate."""
+    if ex is None:
+        return [fn(*args) for args in calls]
+    return [f.result() for f in [ex.submit(fn, *args) for args in calls]]
+
+
+def run_sharded(path, spec, ddd, out_root, workers=None, formats=("parquet", "xlsx"), log=print,
+                n_shards=outofcore.SHARDS, chunk_rows=outofcore.CHUNK_ROWS, tmp=None):
+    """
+    Come `run_batch` per estratti più grandi della RAM (core/outofcore.py):
+    `path` (CSV o Parquet) si legge a blocchi e si ripartisce per paziente in
+    `n_shards` shard Parquet in `tmp` (default cartella temporanea, eliminati
+    alla fine); ogni job gira shard per shard su `workers` processi, uno
+    shard in memoria per processo, e i riepiloghi parziali si uniscono. Le
+    tabelle per paziente/unità restano `<job>/<tabella>/part-XXXXX.parquet`.
+    Ritorna la lista dei riepiloghi per job.
+    """
+    columns, numeric, id_col = outofcore.spec_columns(spec)
+    if tmp:
+        Path(tmp).mkdir(parents=True, exist_ok=True)
+    work = Path(tempfile.mkdtemp(prefix="shard-", dir=tmp))
+    try:
+        t0 = time.perf_counter()
+        part = outofcore.partition(path, work, id_col, columns, numeric, n_shards, chunk_rows,
+                                   [j["per"] for j in spec.get("jobs", []) if j.get("per")])
+        shards = part["shards"]
+        jobs = expand_jobs(spec, part["valori"])
+        log(f"{part['righe']:,} dispensazioni in {len(shards)} shard ({time.perf_counter() - t0:.1f} s) • {len(jobs)} job")
+        for job in jobs:
+            for name in UNIT_TABLES[job["tipo"]]:
+                shutil.rmtree(Path(out_root) / job["nome"] / name, ignore_errors=True)
+
+        workers = min(workers or os.cpu_count() or 1, max(len(shards), 1))
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(None, ddd)) if workers > 1 else None
+        with pool or nullcontext():
+            if pool is None:
+                _init_worker(None, ddd)
+            # formato delle date dedotto dal primo valore non vuoto dell'estratto filtrato, come in memoria
+            firsts = _pool_map(pool, _shard_anchors, [(s, jobs) for s in shards])
+            anchors = [min((f[i] for f in firsts if f[i] is not None), default=(0, None))[1] for i in range(len(jobs))]
+            need = [i for i, j in enumerate(jobs) if _needs_bounds(j)]
+            if need:
+                bounds = _pool_map(pool, _shard_bounds, [(s, [jobs[i] for i in need], [anchors[i] for i in need])
+                                                        for s in shards])
+                for k, i in enumerate(need):
+                    lo, hi = (pd.Series([b[k][m] for b in bounds]) for m in (0, 1))
+                    jobs[i] = _with_bounds(jobs[i], lo.min(), hi.max())
+            calls = [(job, k, s, anchors[i], out_root) for i, job in enumerate(jobs) for k, s in enumerate(shards)]
+            shard_results = _pool_map(pool, _run_shard, calls)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    results = []
+    for i, job in enumerate(jobs):
+        results.append(_merge_job(job, shard_results[i * len(shards):(i + 1) * len(shards)], out_root, formats))
+        log(_fmt(results[-1]))
+    _write_summary(results, out_root)
+    return results
@@ -0,0 +1,165 @@
+"""Coorte naïve, tabelle DDD e Tabella 1."""
+import numpy as np
+import pandas as pd
+
+from .ingestion import as_str_col, cap_positive, safe_numeric
+
+
+def first_dispensation(df, keys, date_col, name="__first_date"):
+    """Prima dispensazione per chiave (paziente o paziente+ATC)."""
+    return df.groupby(keys)[date_col].min().reset_index().rename(columns={date_col: name})
+
+
+def select_naive(df, keys, date_col, cutoff, first_col=None):
+    """
+    Righe delle chiavi (paziente o paziente+ATC) la cui prima dispensazione è
+    ≥ `cutoff`. Un solo transform, nessun merge; con `first_col` la data di
+    prima dispensazione viene aggiunta come colonna.
+    """
+    first = df.groupby(keys)[date_col].transform("min")
+    keep = first >= pd.to_datetime(cutoff)
+    out = df[keep].copy()
+    if first_col:
+        out[first_col] = first[keep]
+    return out.reset_index(drop=True)
+
+
+def group_mode(df, keys, col, default=None):
+    """
+    Valore più frequente di `col` per chiave, come `Series.mode().iloc[0]`
+    (a parità vince il valore minore; NaN ignorati). Le chiavi senza valori
+    validi ricevono `default`. Ritorna una Series indicizzata dalle chiavi.
+    """
+    keys = list(keys)
+    idx = df.groupby(keys).size().index
+    cnt = df.dropna(subset=[col]).groupby(keys + [col]).size().rename("__n__").reset_index()
+    cnt = cnt.sort_values("__n__", ascending=False, kind="stable").drop_duplicates(keys)
+    s = cnt.set_index(keys)[col]
+    if len(keys) == 1:
+        s.index = s.index.get_level_values(0)
+    s = s.reindex(idx)
+    return s.where(s.notna(), default) if default is not None else s
+
+
+def duplicate_keys(tab, col):
+    """Chiavi presenti più volte in una tabella di lookup (duplicherebbero righe in merge)."""
+    dup = tab[col].value_counts()
+    return dup[dup > 1].index
+
+
+def merge_ddd_standard(df, tab_ddd, atc_col, atc_ddd_col, ddd_std_col, ddd_col):
+    """
+    Aggiunge `DDD_standard` (prima occorrenza per ATC) e rende numeriche DDD
+    dispensate e standard (non validi/infiniti → 0).
+    Ritorna (df, n righe senza corrispondenza, n righe con DDD_standard ≤ 0).
+    """
+    tab2 = tab_ddd[[atc_ddd_col, ddd_std_col]].drop_duplicates(subset=[atc_ddd_col])
+    df = df.merge(tab2, left_on=atc_col, right_on=atc_ddd_col, how="left")
+    return ddd_numeric(df.rename(columns={ddd_std_col: "DDD_standard"}), ddd_col)
+
+
+def ddd_numeric(df, ddd_col):
+    """Seconda metà di `merge_ddd_standard`, dopo il merge: conteggi e colonne DDD numeriche."""
+    n_missing = int(df["DDD_standard"].isna().sum())
+    df["DDD_standard"] = safe_numeric(df["DDD_standard"]).replace([np.inf, -np.inf], 0)
+    df[ddd_col] = safe_numeric(df[ddd_col])
+    return df, n_missing, int((df["DDD_standard"] <= 0).sum())
+
+
+def giorni_coperti(ddd, ddd_std):
+    """Giorni coperti = DDD dispensate / DDD standard (0 dove lo standard è ≤ 0)."""
+    ddd = np.asarray(ddd, dtype=float)
+    std = np.asarray(ddd_std, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.where(std > 0, ddd / std, 0.0)
+    return np.where(np.isnan(out), 0.0, out)
+
+
+def join_ddd_lookup(disp, ddd, key_disp, key_lookup, std_col, ddd_col):
+    """
+    Join con il lookup DDD su chiave testuale normalizzata (colonna `__KEY__`),
+    `__DDD_STD__` e DDD erogate limitate a ≥ 0, righe senza standard escluse,
+    `__giorni_coperti_disp__` = DDD erogate / DDD standard.
+    Ritorna (disp, n righe escluse).
+    """
+    disp = disp.copy()
+    disp[key_disp] = as_str_col(disp[key_disp])
+    disp[ddd_col] = cap_positive(disp[ddd_col])
+    slim = ddd[[key_lookup, std_col]].rename(columns={key_lookup: "__KEY__", std_col: "__DDD_STD__"})
+    slim["__KEY__"] = as_str_col(slim["__KEY__"])
+    slim["__DDD_STD__"] = cap_positive(slim["__DDD_STD__"])
+    disp = disp.rename(columns={key_disp: "__KEY__"}).merge(slim, on="__KEY__", how="left")
+
+    miss = int(disp["__DDD_STD__"].isna().sum())
+    if miss:
+        disp = disp.dropna(subset=["__DDD_STD__"])
+    disp["__giorni_coperti_disp__"] = (disp[ddd_col] / disp["__DDD_STD__"]).clip(lower=0)
+    return disp, miss
+
+
+def dedup_same_day(disp, keys, value="__giorni_coperti_disp__"):
+    """Somma i giorni coperti delle righe con le stesse chiavi (es. stesso giorno/paziente/terapia)."""
+    keys = list(dict.fromkeys(keys))
+    return disp.groupby(keys, dropna=False)[value].sum().reset_index()
+
+
+def tabella1(df, id_col, groupings, sex_col, age_col, male="M"):
+    """
+    Tabella 1 per più raggruppamenti in una volta (es. categoria, categoria × linea):
+    N pazienti, % per sesso, età media/DS/mediana/IQR/min/max e SMD (età, % maschi)
+    di ogni categoria rispetto alle altre dello stesso strato (stesse chiavi
+    successive alla prima). Una riga per paziente per gruppo; solo riduzioni
+    groupby native, niente lambda.
+    Ritorna {nome raggruppamento: DataFrame}.
+    """
+    all_keys = list(dict.fromkeys(k for keys in groupings for k in keys))
+    base = df[list(dict.fromkeys([id_col, sex_col, age_col] + all_keys))].copy()
+    base["__eta__"] = pd.to_numeric(base[age_col], errors="coerce")
+    base["__eta2__"] = base["__eta__"] ** 2
+    base["__sesso__"] = base[sex_col].astype(str).str.strip().str.upper()
+    base["__m__"] = (base["__sesso__"] == male).astype(float)
+
+    out = {}
+    for keys in groupings:
+        keys = list(keys)
+        pts = base.drop_duplicates(keys + [id_col])
+        g = pts.groupby(keys, dropna=False)
+        t = g.agg(
+            N_pazienti=(id_col, "size"),
+            Età_media=("__eta__", "mean"),
+            Età_DS=("__eta__", "std"),
+            Età_mediana=("__eta__", "median"),
+            Età_min=("__eta__", "min"),
+            Età_max=("__eta__", "max"),
+            _n_eta=("__eta__", "count"),
+            _s1=("__eta__", "sum"),
+            _s2=("__eta2__", "sum"),
+            _m=("__m__", "sum"),
+        )
+        q = g["__eta__"].quantile([0.25, 0.75]).unstack()
+        t.insert(t.columns.get_loc("Età_mediana") + 1, "Età_Q1", q[0.25])
+        t.insert(t.columns.get_loc("Età_Q1") + 1, "Età_Q3", q[0.75])
+
+        sex = pts.groupby(keys + ["__sesso__"], dropna=False).size().unstack(fill_value=0)
+        for c in sex.columns:
+            t[f"%_{c}"] = (sex[c] / t["N_pazienti"] * 100).round(2)
+
+        # SMD vs resto dello strato: totali di strato meno il gruppo (somme e somme dei quadrati)
+        sums = t[["N_pazienti", "_n_eta", "_s1", "_s2", "_m"]]
+        strata = keys[1:]
+        tot = sums.groupby(level=strata, dropna=False).transform("sum") if strata else sums.sum()
+        rest = tot - sums
+        with np.errstate(divide="ignore", invalid="ignore"):
+            m1 = t["_s1"] / t["_n_eta"]
+            m0 = rest["_s1"] / rest["_n_eta"]
+            v1 = (t["_s2"] - t["_n_eta"] * m1 ** 2) / (t["_n_eta"] - 1)
+            v0 = (rest["_s2"] - rest["_n_eta"] * m0 ** 2) / (rest["_n_eta"] - 1)
+            t["SMD_età"] = ((m1 - m0) / np.sqrt((v1 + v0) / 2)).round(3)
+            p1 = t["_m"] / t["N_pazienti"]
+            p0 = rest["_m"] / rest["N_pazienti"]
+            t["SMD_maschi"] = ((p1 - p0) / np.sqrt((p1 * (1 - p1) + p0 * (1 - p0)) / 2)).round(3)
+
+        t = t.drop(columns=["_n_eta", "_s1", "_s2", "_m"])
+        t[["Età_media", "Età_DS"]] = t[["Età_media", "Età_DS"]].round(2)
+        out[" × ".join(map(str, keys))] = t.reset_index()
+    return out
@@ -0,0 +1,192 @@
+"""
+Export dei risultati. Nelle pagine i file si generano solo al clic sul
+download (callable differito di `st.download_button`, eseguito fuori dallo
+script) e restano in una cache su disco indicizzata dall'hash del contenuto:
+un secondo clic, anche da un'altra sessione, rilegge il file.
+
+L'Excel è scritto in streaming (openpyxl `write_only`, a blocchi di righe)
+direttamente su file, senza tenere in memoria il workbook. Parquet e CSV
+compresso gzip sono molto più rapidi per fogli grandi; con più fogli
+arrivano come zip con un file per foglio.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import uuid
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+XLSX, PARQUET, CSV_GZ = "xlsx", "parquet", "csv.gz"
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_MIME = "application/zip"
+# formato → (mime del file singolo, etichetta)
+FORMATS = {
+    XLSX: (XLSX_MIME, "Excel"),
+    PARQUET: ("application/vnd.apache.parquet", "Parquet"),
+    CSV_GZ: ("application/gzip", "CSV.gz"),
+}
+
+# cache su disco (variabili d'ambiente)
+CACHE_DIR_ENV, CACHE_MB_ENV = "EXPORT_CACHE_DIR", "EXPORT_CACHE_MB"
+CHUNK_ROWS = 50_000
+# gzip veloce: a livelli alti il CSV costa più del foglio Excel
+CSV_GZ_LEVEL = 1
+
+
+def _sheets(sheets):
+    return {name: df for name, df in sheets.items() if df is not None}
+
+
+# ---------- scrittori ----------
+def _rows(df, chunk=CHUNK_ROWS):
+    """Righe come liste di valori Python, a blocchi: mancanti → cella vuota, ±inf → testo come pandas."""
+    for start in range(0, len(df), chunk):
+        block = df.iloc[start:start + chunk]
+        cells = block.astype(object).where(block.notna().to_numpy(), None)
+        for c in block.columns[[pd.api.types.is_float_dtype(t) for t in block.dtypes]]:
+            v = block[c].to_numpy(dtype=float)
+            if np.isinf(v).any():
+                cells[c] = np.where(np.isinf(v), np.where(v > 0, "inf", "-inf"), cells[c].to_numpy())
+        yield from cells.itertuples(index=False, name=None)
+
+
+def write_xlsx(sheets, path):
+    """Excel a più fogli da {nome foglio: DataFrame} (fogli None saltati), scritto in streaming."""
+    wb = Workbook(write_only=True)
+    bold = Font(bold=True)
+    for name, df in _sheets(sheets).items():
+        ws = wb.create_sheet(title=str(name)[:31])
+        header = []
+        for c in df.columns:
+            cell = WriteOnlyCell(ws, value=str(c))
+            cell.font = bold
+            header.append(cell)
+        ws.append(header)
+        for row in _rows(df):
+            ws.append(row)
+    if not wb.worksheets:
+        wb.create_sheet(title="vuoto")
+    wb.save(path)
+
+
+def write_parquet(df, path):
+    df.rename(columns=str).to_parquet(path, index=False)  # parquet vuole nomi di colonna testuali
+
+
+def write_csv_gz(df, path):
+    df.to_csv(path, index=False, chunksize=CHUNK_ROWS,
+              compression={"method": "gzip", "compresslevel": CSV_GZ_LEVEL, "mtime": 0})
+
+
+_WRITERS = {PARQUET: write_parquet, CSV_GZ: write_csv_gz}
+
+
+def write(sheets, fmt, path):
+    """Scrive `sheets` nel formato `fmt`: Excel multi-foglio, oppure un file (un foglio) o uno zip (più fogli)."""
+    sheets = _sheets(sheets)
+    if fmt == XLSX:
+        write_xlsx(sheets, path)
+    elif len(sheets) == 1:
+        _WRITERS[fmt](next(iter(sheets.values())), path)
+    else:
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as z:  # già compressi
+            for name, df in sheets.items():
+                with tempfile.NamedTemporaryFile(suffix=f".{fmt}") as tmp:
+                    _WRITERS[fmt](df, tmp.name)
+                    z.write(tmp.name, f"{name}.{fmt}")
+
+
+def file_name(stem, fmt, sheets):
+    """Nome del download: `stem.xlsx`, `stem.parquet` / `stem.csv.gz` per un foglio, `stem_<formato>.zip` per più."""
+    if fmt == XLSX or len(_sheets(sheets)) == 1:
+        return f"{stem}.{fmt}"
+    return f"{stem}_{fmt.replace('.', '_')}.zip"
+
+
+def mime(fmt, sheets):
+    return FORMATS[fmt][0] if fmt == XLSX or len(_sheets(sheets)) == 1 else ZIP_MIME
+
+
+# ---------- cache per hash del contenuto ----------
+def content_hash(sheets, extra_names=()):
+    """Hash dei fogli: nomi, colonne, tipi e valori (hash_pandas_object, senza indice), più i nomi dei fogli extra."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([str(n) for n in extra_names]).encode())
+    for name, df in _sheets(sheets).items():
+        h.update(repr((str(name), [str(c) for c in df.columns], [str(t) for t in df.dtypes], len(df))).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def cache_dir():
+    d = Path(os.environ.get(CACHE_DIR_ENV) or Path(tempfile.gettempdir()) / "streamlit_export")
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock(key):
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _prune(d, keep):
+    """Tiene i file più recenti entro EXPORT_CACHE_MB (default 1024); `keep` non si tocca."""
+    budget = float(os.environ.get(CACHE_MB_ENV, 1024)) * 2**20
+    files = sorted((p for p in d.iterdir() if p.is_file() and not p.name.endswith(".tmp")),
+                   key=lambda p: p.stat().st_mtime, reverse=True)
+    used = 0
+    for p in files:
+        used += p.stat().st_size
+        if used > budget and p != keep:
+            p.unlink(missing_ok=True)
+
+
+def cache_files():
+    return [p for p in cache_dir().iterdir() if p.is_file() and not p.name.endswith(".tmp")]
+
+
+def clear_cache():
+    """Elimina i file di export in cache; ritorna quanti ne ha eliminati."""
+    files = cache_files()
+    for p in files:
+        p.unlink(missing_ok=True)
+    return len(files)
+
+
+def cached_file(sheets, fmt=XLSX, extra=None):
+    """
+    Percorso del file di export per `sheets` nel formato `fmt`, generato solo
+    se non è già in cache. `extra`: fogli di servizio (es. Performance)
+    aggiunti al file ma esclusi dall'hash, altrimenti ogni rerun
+    invaliderebbe la cache; nel file restano quelli della prima generazione.
+    """
+    d = cache_dir()
+    path = d / f"{content_hash(sheets, list(extra or ()))}.{fmt}"
+    with _lock(path.name):
+        if path.exists():
+            os.utime(path)
+            return path
+        tmp = d / f"{path.name}.{uuid.uuid4().hex}.tmp"
+        try:
+            write({**sheets, **(extra or {})}, fmt, tmp)
+            os.replace(tmp, path)  # atomico: un altro processo vede il file intero o niente
+        finally:
+            tmp.unlink(missing_ok=True)
+    _prune(d, path)
+    return path
+
+
+def deferred(sheets, fmt=XLSX, extra=None):
+    """Callable per `st.download_button(data=...)`: il file si genera (o si rilegge dalla cache) al clic."""
+    return lambda: cached_file(sheets, fmt, extra).read_bytes()
@@ -0,0 +1,326 @@
+"""
+Ricalcolo incrementale per gli estratti mensili che aggiungono in coda le
+dispensazioni recenti. Dopo ogni calcolo si salva uno stato per paziente:
+
+- PDC: scorta riportata, ultimo evento e ultimo giorno coperto per unità
+  (stato del kernel, `adherence.STATE_COLS`), prima dispensazione per chiave naïve;
+- KM/Prism: prima e ultima dispensazione, conteggi per gruppo (moda);
+- Sankey: prima/ultima dispensazione, categorie già viste con la loro linea,
+  linea corrente e ultima categoria.
+
+All'estratto successivo si elaborano solo le righe oltre le `n_righe` già
+viste (dopo aver verificato con un hash per riga che le precedenti non siano
+cambiate) e si aggiornano solo i pazienti toccati; i risultati si ricostruiscono
+dallo stato con le stesse funzioni dei motori completi, quindi sono identici.
+Un paziente con una riga nuova precedente alla sua ultima dispensazione già
+vista (retrodatata) è ricostruito da tutta la sua storia nell'estratto.
+
+Il ricalcolo completo resta il riferimento: `batch.py --verifica` esegue
+entrambi e confronta le tabelle, `--completo` ricostruisce lo stato da zero.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import adherence, cohort, pathways, survival
+from .ingestion import date_anchor, safe_dt_like
+
+META, VALUES = "meta.json", "valori.pkl"
+
+
+# ---------- estratto: righe già viste e righe nuove ----------
+def row_hashes(df):
+    """Hash per riga (contenuto, senza indice): confronta il prefisso con l'estratto precedente."""
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def prefix_digest(hashes, n):
+    return hashlib.blake2b(np.ascontiguousarray(hashes[:n]).tobytes(), digest_size=16).hexdigest()
+
+
+def frame_hash(df):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([str(c) for c in df.columns]).encode())
+    h.update(row_hashes(df).tobytes())
+    return h.hexdigest()
+
+
+def _rows(df, new, id_col, date_col, last=None):
+    """
+    Righe da elaborare con la data convertita (NaT se non valida): le nuove e,
+    se `last` (ultima dispensazione nota per paziente) è dato, tutta la storia
+    dei pazienti con una riga nuova retrodatata. Ritorna (righe, pazienti da ricostruire).
+    """
+    anchor = date_anchor(df[date_col])
+    rows = df[new]
+    dates = safe_dt_like(rows[date_col], anchor)
+    rebuilt = []
+    if last is not None and len(last):
+        back = (dates < rows[id_col].map(last)).to_numpy()
+        rebuilt = pd.unique(rows[id_col].to_numpy()[back])
+        if len(rebuilt):
+            rows = df[new | df[id_col].isin(rebuilt).to_numpy()]
+            dates = safe_dt_like(rows[date_col], anchor)
+    return rows.assign(**{date_col: dates}), list(rebuilt)
+
+
+def _drop(state, id_col, ids):
+    """Stato senza i pazienti `ids` (da ricostruire)."""
+    if not len(ids):
+        return state
+    return {k: v[~v[id_col].isin(ids)] if isinstance(v, pd.DataFrame) and id_col in v else v
+            for k, v in state.items()}
+
+
+def _hit(old, new, keys):
+    """Righe di `old` con chiavi presenti in `new`."""
+    return pd.MultiIndex.from_frame(old[keys]).isin(pd.MultiIndex.from_frame(new[keys]))
+
+
+def _replace(old, new, keys):
+    """Righe di `old` con le chiavi di `new` sostituite da quelle di `new`."""
+    return new if old is None else pd.concat([old[~_hit(old, new, keys)], new], ignore_index=True)
+
+
+def _merge(old, new, keys, **agg):
+    """Stato `old` aggiornato con le righe `new`: si riaggregano (named agg) solo le chiavi toccate."""
+    if old is None:
+        return new
+    hit = _hit(old, new, keys)
+    upd = pd.concat([old[hit], new]).groupby(keys, as_index=False, sort=False).agg(**agg)
+    return pd.concat([old[~hit], upd], ignore_index=True)
+
+
+def _counts(old, rows, keys):
+    """Conteggi [keys..., n] aggiornati con le righe nuove (valori mancanti esclusi, come `group_mode`)."""
+    cnt = rows.dropna(subset=keys).groupby(keys).size().rename("n").reset_index()
+    return _merge(old, cnt, keys, n=("n", "sum"))
+
+
+def _mode(counts, key, col):
+    """Come `cohort.group_mode` ma dai conteggi [key, col, n]: a parità vince il valore minore."""
+    cnt = counts.sort_values([key, col], kind="stable").sort_values("n", ascending=False, kind="stable")
+    return cnt.drop_duplicates(key).set_index(key)[col]
+
+
+def _bounds(state, dates):
+    """Prima e ultima data valida dell'estratto (default dei cutoff)."""
+    for k, v, fn in (("data_min", dates.min(), min), ("data_max", dates.max(), max)):
+        if pd.notna(v):
+            state[k] = v if pd.isna(state[k]) else fn(state[k], v)
+
+
+# ---------- PDC su persistenza ----------
+def _pdc_keys(c, p):
+    naive = [c["id"]] if p["naive"] == "paziente" else [c["id"], c["atc"]]
+    units = [c["id"]] if p["unita"] == "paziente" else [c["id"], c["atc"]]
+    return naive, units
+
+
+def pdc_update(state, df, ddd, new, c, p):
+    """Aggiorna lo stato PDC con le righe `new` di `df` (stessa preparazione di `batch.run_pdc`)."""
+    naive_keys, unit_keys = _pdc_keys(c, p)
+    if state is None:
+        state = dict(pazienti=None, naive=None, unita=None, atc=None)
+    last = state["pazienti"].set_index(c["id"])["ultima"] if state["pazienti"] is not None else None
+    rows, rebuilt = _rows(df, new, c["id"], c["data"], last)
+    state = _drop(state, c["id"], rebuilt)
+    rows = rows.dropna(subset=[c["data"]])
+    n_pat = rows[c["id"]].nunique()
+    last = rows.groupby(c["id"])[c["data"]].max().rename("ultima").reset_index()
+    state["pazienti"] = _merge(state["pazienti"], last, [c["id"]], ultima=("ultima", "max"))
+
+    rows, _, _ = cohort.merge_ddd_standard(rows, ddd, c["atc"], c["atc_ddd"], c["ddd_std"], c["ddd"])
+    # prima dispensazione per chiave naïve (le righe nuove la cambiano solo per i pazienti ricostruiti)
+    first = rows.groupby(naive_keys)[c["data"]].min().rename("__first_date").reset_index()
+    state["naive"] = _merge(state["naive"], first, naive_keys, __first_date=("__first_date", "min"))
+    rows = rows.merge(state["naive"], on=naive_keys, how="left")
+    rows = rows[rows["__first_date"] >= pd.to_datetime(p["data_indice"])].copy()
+    rows["giorni_coperti"] = cohort.giorni_coperti(rows[c["ddd"]], rows["DDD_standard"])
+    rows["__date"] = rows[c["data"]]
+
+    units = adherence.pdc_persistenza(rows, unit_keys, p["periodo"], init=state["unita"], with_state=True)
+    state["unita"] = _replace(state["unita"], units, unit_keys)
+    if p["unita"] == "paziente":
+        state["atc"] = _counts(state["atc"], rows[[c["id"], c["atc"]]], [c["id"], c["atc"]])
+    return state, dict(righe=int(new.sum()), pazienti_aggiornati=int(n_pat), pazienti_ricostruiti=len(rebuilt))
+
+
+def pdc_result(state, c, p):
+    """Tabella per unità come `batch.run_pdc` (prima di soglia e riepilogo); (None, messaggio) se vuota."""
+    _, unit_keys = _pdc_keys(c, p)
+    units = state["unita"]
+    if units is None or units.empty:
+        return None, "Nessun paziente/ATC naïve secondo i criteri selezionati."
+    ader = units.sort_values(unit_keys, ignore_index=True)[unit_keys + ["PDC_persistenza", "Persistenza_giorni"]]
+    if p["unita"] == "paziente":
+        ader.insert(1, "ATC_unit", _mode(state["atc"], c["id"], c["atc"]).reindex(ader[c["id"]]).to_numpy())
+    else:
+        ader = ader.rename(columns={c["atc"]: "ATC_unit"})
+    return ader, None
+
+
+# ---------- KM (preprocessing stile Prism) ----------
+def km_update(state, df, ddd, new, c, p):
+    """Prima/ultima dispensazione e conteggi per gruppo: min, max e somme, nessuna ricostruzione necessaria."""
+    rows, _ = _rows(df, new, c["id"], c["data"])
+    if state is None:
+        state = dict(pazienti=None, gruppi=None, date_non_valide=0, data_min=pd.NaT, data_max=pd.NaT)
+    state["date_non_valide"] += int(rows[c["data"]].isna().sum())
+    rows = rows.dropna(subset=[c["data"]])
+    _bounds(state, rows[c["data"]])
+    g = rows.groupby(c["id"])[c["data"]]
+    pats = pd.DataFrame({"start": g.min(), "last": g.max()}).reset_index()
+    state["pazienti"] = _merge(state["pazienti"], pats, [c["id"]], start=("start", "min"), last=("last", "max"))
+    state["gruppi"] = _counts(state["gruppi"], rows[[c["id"], c["strat"]]], [c["id"], c["strat"]])
+    return state, dict(righe=int(new.sum()), pazienti_aggiornati=int(g.ngroups), pazienti_ricostruiti=0)
+
+
+def km_result(state, c, p):
+    """((tutti, inclusi), None) come `survival.preprocess_prism` sull'estratto intero."""
+    cutoff = pd.Timestamp(p["cutoff"]) if p.get("cutoff") else state["data_max"]
+    pats = state["pazienti"].sort_values(c["id"]).set_index(c["id"])
+    start, last = pats["start"], pats["last"]
+    gruppo = _mode(state["gruppi"], c["id"], c["strat"]).reindex(start.index)
+    gruppo = gruppo.where(gruppo.notna(), "NA").to_numpy()
+    return survival.prism_table(start, last, gruppo, int(p["periodo"]), cutoff), None
+
+
+# ---------- Sankey (linee per prima comparsa) ----------
+_PAT_AGG = dict(prima=("prima", "min"), ultima=("ultima", "max"), s_first=("s_first", "min"),
+                s_last=("s_last", "max"), s_n=("s_n", "sum"), other_last=("other_last", "max"),
+                last_cat=("last_cat", "last"))
+
+
+def sankey_update(state, df, ddd, new, c, p):
+    """Stato per paziente e ingressi in linea: le righe nuove aprono una linea solo per categorie mai viste."""
+    idc, cat = c["id"], c["atc"]
+    if state is None:
+        state = dict(pazienti=None, linee=None, data_min=pd.NaT, data_max=pd.NaT)
+    last = state["pazienti"].set_index(idc)["ultima"] if state["pazienti"] is not None else None
+    rows, rebuilt = _rows(df, new, idc, c["data"], last)
+    state = _drop(state, idc, rebuilt)
+    rows = rows.dropna(subset=[c["data"]])
+    _bounds(state, rows[c["data"]])
+    rows = rows.assign(**{cat: rows[cat].astype(str).str.strip()}).sort_values([idc, c["data"]])
+    is_other = rows[cat].isin(p["non_study"]).to_numpy()
+    study = rows[~is_other]
+
+    g_all, g_st = rows.groupby(idc)[c["data"]], study.groupby(idc)
+    pats = pd.DataFrame({"prima": g_all.min(), "ultima": g_all.max()})
+    pats["s_first"] = g_st[c["data"]].min()
+    pats["s_last"] = g_st[c["data"]].max()
+    pats["s_n"] = g_st.size().reindex(pats.index, fill_value=0)
+    pats["other_last"] = rows[is_other].groupby(idc)[c["data"]].max()
+    pats["last_cat"] = g_st[cat].last()
+    state["pazienti"] = _merge(state["pazienti"], pats.reset_index(), [idc], **_PAT_AGG)
+
+    # nuove linee: prima comparsa fra le righe nuove delle categorie mai viste dal paziente
+    lines = study[[idc, cat, c["data"]]].drop_duplicates([idc, cat]).rename(
+        columns={cat: "cat", c["data"]: "entry_date"})
+    old = state["linee"]
+    n_old = pd.Series(dtype=np.int64)
+    if old is not None:
+        old = old[old[idc].isin(lines[idc])]
+        lines = lines[~_hit(lines, old, [idc, "cat"])]
+        n_old = old.groupby(idc)["Linea"].max()
+    lines.insert(1, "Linea", lines.groupby(idc).cumcount().to_numpy() + 1
+                 + lines[idc].map(n_old).fillna(0).to_numpy(np.int64))
+    state["linee"] = pd.concat([state["linee"], lines], ignore_index=True)
+    info = dict(righe=int(new.sum()), pazienti_aggiornati=int(g_all.ngroups), pazienti_ricostruiti=len(rebuilt))
+    return state, info
+
+
+def sankey_result(state, c, p):
+    """Link, KM allo switch e transizioni per anno come `pathways.compute_flows` (modalità linee, senza regimi)."""
+    idc = c["id"]
+    cutoff_naive = pd.Timestamp(p.get("cutoff_naive") or state["data_min"])
+    cutoff_fu = pd.Timestamp(p.get("cutoff_fu") or state["data_max"])
+    pats = state["pazienti"]
+    pats = pats[pats["prima"] >= cutoff_naive].sort_values(idc, ignore_index=True)
+    if not (pats["s_n"] > 0).any():
+        return None, "Nessun record dopo i filtri."
+    code = pd.Series(np.arange(len(pats), dtype=np.int32), index=pats[idc])
+    summary = dict(first=pats["s_first"].to_numpy(), last=pats["s_last"].to_numpy(), n_disp=pats["s_n"].to_numpy(),
+                   other_last=pats["other_last"].to_numpy())
+    outcomes = pathways.assign_outcomes(summary, {"cutoff_fu": np.datetime64(cutoff_fu, "ns"), "gap_days": int(p["gap_days"]),
+                                                  "data_end": np.datetime64(state["data_max"], "ns")})
+
+    lines = state["linee"][state["linee"][idc].isin(code.index)]
+    lines = lines.assign(___PID___=lines[idc].map(code).to_numpy(np.int32)).sort_values(["___PID___", "Linea"])
+    terapia = lines["cat"] + " (Linea " + lines["Linea"].astype(str) + ")"
+    entry = pd.DataFrame({"___PID___": lines["___PID___"].to_numpy(), "Linea": lines["Linea"].to_numpy(np.int64),
+                          "Terapia": terapia.to_numpy(), "source_cat": lines["cat"].to_numpy(),
+                          "entry_date": lines["entry_date"].to_numpy()})
+    # ultima terapia: ultima categoria con la linea corrente (come l'ultima riga nel calcolo completo)
+    ends = pats[pats["s_n"] > 0]
+    current = lines.groupby(idc)["Linea"].max().reindex(ends[idc])
+    last_step = pd.DataFrame({
+        "___PID___": code.reindex(ends[idc]).to_numpy(np.int32),
+        "source": (ends["last_cat"] + " (Linea " + current.astype(str).to_numpy() + ")").to_numpy(),
+    })
+    trans, surv = pathways.entry_transitions(entry, last_step, outcomes, summary["last"], cutoff_fu)
+    km = survival.km_by_group(surv["Terapia"], surv["time"], surv["event"])
+    links, labels, msg = pathways.flow_links(trans, p["min_flow"], p["per_src_min"])
+    if links is None:
+        return None, msg
+    return dict(links=links, labels=labels, km=km, line_trans=trans[trans["switch_date"].notna()]), None
+
+
+ENGINES = {"pdc": (pdc_update, pdc_result), "km": (km_update, km_result), "sankey": (sankey_update, sankey_result)}
+
+
+def unsupported(job):
+    """Motivo per cui il job non ha un ricalcolo incrementale (None se lo ha)."""
+    if job["tipo"] not in ENGINES:
+        return f"tipo {job['tipo']!r} senza stato incrementale"
+    if job["tipo"] == "sankey" and job["mode"] != "Linee terapeutiche":
+        return "Sankey ai checkpoint"
+    if job["tipo"] == "sankey" and int(job["regimen_window"]) > 0:
+        return "regimi di combinazione: una finestra può attraversare il confine dell'estratto"
+    return None
+
+
+# ---------- stato su disco ----------
+def save(path, state, meta):
+    """Stato in `path` (DataFrame in Parquet, il resto in pickle), sostituito per intero in modo atomico."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent / f".tmp-{uuid.uuid4().hex}"
+    tmp.mkdir()
+    frames, values = [], {}
+    for name, v in state.items():
+        if isinstance(v, pd.DataFrame):
+            v.to_parquet(tmp / f"{name}.parquet")
+            frames.append(name)
+        else:
+            values[name] = v
+    (tmp / VALUES).write_bytes(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL))
+    (tmp / META).write_text(json.dumps(dict(meta, frames=frames, salvato=time.time()), ensure_ascii=False),
+                            encoding="utf-8")
+    old = path.parent / f".old-{uuid.uuid4().hex}"
+    if path.exists():
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def load(path):
+    """(stato, meta) salvati in `path`, (None, None) se assenti o illeggibili."""
+    path = Path(path)
+    try:
+        meta = json.loads((path / META).read_text(encoding="utf-8"))
+        state = pickle.loads((path / VALUES).read_bytes())
+        for name in meta["frames"]:
+            state[name] = pd.read_parquet(path / f"{name}.parquet")
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError):
+        return None, None
+    return state, meta
@@ -0,0 +1,95 @@
+"""Lettura dei file di input e normalizzazione di colonne/date."""
+import hashlib
+import io
+
+import numpy as np
+import pandas as pd
+
+
+def file_hash(file_bytes: bytes) -> str:
+    """Hash SHA-256 del contenuto: chiave di cache indipendente dal nome file."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def read_excel(file_bytes: bytes) -> pd.DataFrame:
+    return pd.read_excel(io.BytesIO(file_bytes))
+
+
+def read_any(file_bytes: bytes, name: str) -> pd.DataFrame:
+    """Legge CSV (auto-sep, fallback ;), Parquet o XLSX."""
+    if name.lower().endswith(".parquet"):
+        return pd.read_parquet(io.BytesIO(file_bytes))
+    if name.lower().endswith(".csv"):
+        try:
+            return pd.read_csv(io.BytesIO(file_bytes), sep=None, engine="python")
+        except Exception:
+            return pd.read_csv(io.BytesIO(file_bytes), sep=";", engine="python", decimal=",")
+    return read_excel(file_bytes)
+
+
+def read_path(path) -> pd.DataFrame:
+    """Come `read_any`, da percorso su disco."""
+    with open(path, "rb") as f:
+        return read_any(f.read(), str(path))
+
+
+def safe_dt(s):
+    """Date in formato italiano (giorno prima), valori non validi → NaT."""
+    return pd.to_datetime(s, errors="coerce", dayfirst=True)
+
+
+# testi che pandas salta come "vuoti" deducendo il formato delle date
+NAT_STRINGS = ("", "NaT", "nat", "NAT")
+
+
+def date_anchor(s):
+    """Primo valore non vuoto della colonna data: pandas ne deduce il formato per tutta la colonna."""
+    for v in s:  # di solito il primo
+        if not pd.isna(v) and not (isinstance(v, str) and v in NAT_STRINGS):
+            return v
+    return None
+
+
+def safe_dt_like(s, anchor):
+    """`safe_dt` su una parte delle righe con lo stesso formato dedotto sulla colonna intera (`date_anchor`)."""
+    if anchor is None:
+        return safe_dt(s)
+    out = safe_dt(pd.concat([pd.Series([anchor]), s], ignore_index=True)).iloc[1:]
+    out.index = s.index
+    return out
+
+
+def parse_dates(df: pd.DataFrame, col: str) -> pd.DataFrame:
+    """Copia con `col` convertita in data e righe senza data scartate."""
+    out = df.copy()
+    out[col] = safe_dt(out[col])
+    return out.dropna(subset=[col])
+
+
+def as_str_col(s: pd.Series) -> pd.Series:
+    """Chiavi testuali normalizzate (spazi in testa/coda e multipli)."""
+    return s.astype(str).str.strip().str.replace(r"\s+", " ", regex=True)
+
+
+def safe_numeric(s: pd.Series) -> pd.Series:
+    """Numerico con non validi → 0."""
+    s = pd.to_numeric(s, errors="coerce")
+    return s.where(pd.notnull(s), 0)
+
+
+def cap_positive(s: pd.Series) -> pd.Series:
+    """Numerico con negativi → 0 e non validi → NaN (vettoriale)."""
+    return pd.to_numeric(s, errors="coerce").clip(lower=0.0).astype(float)
+
+
+def date_bounds(s: pd.Series):
+    """Min/max di una colonna data (None, None se vuota)."""
+    tmp = safe_dt(s).dropna()
+    if tmp.empty:
+        return None, None
+    return tmp.min(), tmp.max()
+
+
+def day_numbers(s: pd.Series) -> np.ndarray:
+    """Date come nanosecondi int64 (per i kernel a array)."""
+    return s.to_numpy("datetime64[ns]").view(np.int64)
@@ -0,0 +1,250 @@
+"""
+Esecuzione in background dei calcoli pesanti: un pool di thread (tenuto in
+`st.cache_resource` dalle app) esegue i job mentre lo script Streamlit
+continua a rispondere. I motori ricevono `progress(frazione, messaggio)`:
+aggiorna la barra e, se il job è stato annullato, interrompe il calcolo
+(eccezione `Cancelled`) al blocco successivo.
+
+I thread condividono il GIL con il server: il calcolo non diventa più
+veloce, ma la pagina resta navigabile e i risultati precedenti consultabili.
+
+Il runner è unico per processo (`shared()`): tutte le app e le sessioni
+passano dalla stessa coda FIFO, che ammette un job solo se i job in corso
+sono meno di JOBS_MAX_RUNNING e la memoria stimata (righe × colonne) sta nel
+budget JOBS_MEM_MB; un job più grande del budget parte comunque, ma da solo.
+Job con la stessa chiave (hash del file + parametri) condividono il
+risultato. Le pagine sincrone usano `slot()`: stessa coda, nel loro thread.
+
+L'ammissione è guidata dalla coda: un job passa al pool solo quando è
+ammesso (mai thread del pool fermi in attesa del turno), uno slot in testa
+parte dal proprio thread e ferma i job del pool accodati dopo di lui.
+"""
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "in coda", "in esecuzione", "completato", "errore", "annullato"
+
+# limiti del server (variabili d'ambiente)
+MAX_RUNNING_ENV, MEM_ENV = "JOBS_MAX_RUNNING", "JOBS_MEM_MB"
+# ~8 byte per valore per le copie di lavoro dei motori (merge, ordinamenti, indici)
+BYTES_PER_CELL = 64
+
+
+def estimate_mb(rows, cols, bytes_per_cell=BYTES_PER_CELL):
+    """Memoria di picco stimata di un job: righe × colonne × byte per cella (MB)."""
+    return rows * cols * bytes_per_cell / 2**20
+
+
+class Cancelled(Exception):
+    """Job annullato dall'utente."""
+
+
+class Job:
+    """Stato di un job: avanzamento, messaggio, risultato o errore."""
+
+    def __init__(self, key, label, cost_mb=0.0):
+        self.key, self.label, self.cost_mb = key, label, float(cost_mb)
+        self.status, self.progress, self.message = QUEUED, 0.0, ""
+        self.result = self.error = None
+        self.created, self.started, self.finished = time.time(), None, None
+        self._cancel = threading.Event()
+        self._on_cancel = None  # il runner libera la coda se il job annullato era in testa
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def cancelling(self):
+        return self._cancel.is_set() and not self.done
+
+    def report(self, frac, message=None):
+        """Callback di avanzamento per i motori; interrompe il calcolo se il job è annullato."""
+        if self._cancel.is_set():
+            raise Cancelled()
+        self.progress = min(max(float(frac), 0.0), 1.0)
+        if message:
+            self.message = message
+
+    def cancel(self):
+        self._cancel.set()
+        if self.status == QUEUED:
+            self.status, self.finished = CANCELLED, time.time()
+            if self._on_cancel is not None:
+                self._on_cancel()
+
+    def elapsed(self):
+        return (self.finished or time.time()) - (self.started or self.created)
+
+
+class JobRunner:
+    """
+    Pool di thread con coda di ammissione e job indicizzati per chiave. Un job
+    con la stessa chiave di uno ancora valido non viene rilanciato; dei job
+    conclusi restano solo gli ultimi `keep_done` (come `max_entries` di una cache).
+    """
+
+    def __init__(self, max_running=2, mem_budget_mb=2048.0, keep_done=16):
+        self.max_running, self.mem_budget_mb, self.keep_done = int(max_running), float(mem_budget_mb), keep_done
+        self._pool = ThreadPoolExecutor(self.max_running, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._waiting = []  # FIFO dei job non ancora ammessi (anche gli slot sincroni)
+        self._running = []
+        self._tasks = {}  # job del pool in coda → (fn, args, kwargs)
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+
+    def submit(self, fn, *args, key=None, label="", cost_mb=0.0, **kwargs):
+        """Accoda `fn(*args, progress=job.report, **kwargs)`; ritorna il Job (esistente se la chiave è già nota)."""
+        with self._cond:
+            key = key if key is not None else f"job-{next(self._ids)}"
+            job = self._jobs.get(key)
+            if job is not None and job.status not in (FAILED, CANCELLED):
+                return job
+            job = self._jobs[key] = Job(key, label, cost_mb)
+            job._on_cancel = self._wake
+            self._tasks[job] = (fn, args, kwargs)
+            self._waiting.append(job)
+            self._evict()
+            self._dispatch()
+        return job
+
+    def put(self, key, result, label=""):
+        """Registra come già completato un risultato disponibile senza calcolo (es. dall'archivio su disco)."""
+        with self._cond:
+            job = self._jobs[key] = Job(key, label)
+            job.result, job.status, job.progress = result, DONE, 1.0
+            job.started = job.finished = job.created
+            self._evict()
+        return job
+
+    @contextmanager
+    def slot(self, cost_mb=0.0, label="", on_wait=None, every=0.5):
+        """
+        Esegue il blocco nel thread chiamante quando la coda lo ammette
+        (pagine sincrone); `on_wait(posizione)` è chiamata durante l'attesa.
+        Se l'attesa si interrompe (eccezione di `on_wait`, es. rerun di
+        Streamlit) lo slot esce comunque dalla coda; annullato → `Cancelled`.
+        """
+        job = Job(f"slot-{next(self._ids)}", label, cost_mb)
+        with self._cond:
+            self._waiting.append(job)
+        try:
+            if not self._acquire(job, on_wait, every):
+                raise Cancelled()
+            yield job
+        finally:
+            self._release(job)
+
+    def get(self, key):
+        return self._jobs.get(key)
+
+    def jobs(self):
+        return list(self._jobs.values())
+
+    def position(self, job):
+        """Posizione in coda (1 = prossimo a partire), 0 se il job non è in attesa."""
+        with self._cond:
+            return self._waiting.index(job) + 1 if job in self._waiting else 0
+
+    def load(self):
+        """(job in esecuzione, MB stimati in uso, job in coda)."""
+        with self._cond:
+            return len(self._running), sum(j.cost_mb for j in self._running), len(self._waiting)
+
+    # ---------- ammissione ----------
+    def _fits(self, job):
+        if not self._waiting or self._waiting[0] is not job:
+            return False
+        if not self._running:
+            return True
+        used = sum(j.cost_mb for j in self._running)
+        return len(self._running) < self.max_running and used + job.cost_mb <= self.mem_budget_mb
+
+    def _start(self, job):
+        self._waiting.pop(0)
+        self._running.append(job)
+        job.status, job.started = RUNNING, time.time()
+
+    def _dispatch(self):
+        """
+        Con il lock: toglie dalla coda i job annullati e passa al pool i job in
+        testa finché sono ammessi. Uno slot in testa si ammette dal suo thread.
+        """
+        self._waiting = [j for j in self._waiting if j.status != CANCELLED]
+        for job in [j for j in self._tasks if j.status == CANCELLED]:
+            del self._tasks[job]
+        while self._waiting and self._waiting[0] in self._tasks and self._fits(self._waiting[0]):
+            job = self._waiting[0]
+            self._start(job)
+            self._pool.submit(self._run, job, *self._tasks.pop(job))
+        self._cond.notify_all()
+
+    def _wake(self):
+        with self._cond:
+            self._dispatch()
+
+    def _acquire(self, job, on_wait=None, every=0.5):
+        """Attende il turno dello slot; False se è stato annullato mentre era in coda."""
+        with self._cond:
+            while True:
+                self._dispatch()
+                if job.status == CANCELLED:
+                    return False
+                if self._fits(job):
+                    self._start(job)
+                    self._dispatch()
+                    return True
+                if on_wait is not None:
+                    self._cond.release()
+                    try:
+                        on_wait(self._waiting.index(job) + 1)
+                    finally:
+                        self._cond.acquire()
+                self._cond.wait(every)
+
+    def _release(self, job):
+        """Toglie il job dalla coda o dai job in corso e ammette i successivi."""
+        with self._cond:
+            if job in self._waiting:
+                self._waiting.remove(job)
+            if job in self._running:
+                self._running.remove(job)
+            self._dispatch()
+
+    def _run(self, job, fn, args, kwargs):
+        try:
+            if job._cancel.is_set():  # annullato mentre passava al pool
+                raise Cancelled()
+            job.result = fn(*args, progress=job.report, **kwargs)
+            job.status, job.progress = DONE, 1.0
+        except Cancelled:
+            job.status = CANCELLED
+        except Exception as e:  # l'errore resta sul job e si mostra nella pagina
+            job.status, job.error = FAILED, f"{type(e).__name__}: {e}"
+        finally:
+            job.finished = time.time()
+            self._release(job)
+
+    def _evict(self):
+        done = [k for k, j in self._jobs.items() if j.done]
+        for k in done[:max(len(done) - self.keep_done, 0)]:
+            del self._jobs[k]
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    """Runner unico del processo, comune a tutte le app e sessioni (limiti da JOBS_MAX_RUNNING / JOBS_MEM_MB)."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = JobRunner(int(os.environ.get(MAX_RUNNING_ENV, 2)), float(os.environ.get(MEM_ENV, 2048)))
+        return _shared
@@ -0,0 +1,188 @@
+"""
+Motore tabellare opzionale su Polars per la parte relazionale della pipeline:
+selezione naïve, merge con la tabella DDD, somma dei duplicati e riepiloghi
+per gruppo. Ogni funzione ha la firma della versione pandas (core.cohort,
+core.adherence) più `engine`; con `engine="pandas"`, senza Polars installato
+o con colonne che Polars non rappresenta (es. object con tipi misti) si usa
+la versione pandas.
+
+Polars riceve solo le colonne che servono (chiavi e date, non l'intero
+estratto) e lavora su una query lazy (filtri e proiezioni spinti a monte,
+group by e join multithread); restituisce array NumPy di posizioni di riga,
+codici di gruppo o indici nel lookup. Le righe e i valori del risultato si
+ricompongono in pandas da quegli array e le riduzioni numeriche (somme,
+medie, quantili) restano a pandas su codici interi: il risultato è identico
+alla versione pandas, tipi delle colonne e ordine delle righe compresi.
+
+    pip install polars
+"""
+import numpy as np
+import pandas as pd
+
+from . import adherence, cohort
+
+try:  # dipendenza opzionale
+    import polars as pl
+except ImportError:
+    pl = None
+
+PANDAS, POLARS = "pandas", "polars"
+ENGINES = (PANDAS, POLARS)
+ROW = "__riga"
+
+
+def available():
+    return pl is not None
+
+
+def engines():
+    """Motori utilizzabili in questo ambiente."""
+    return ENGINES if available() else (PANDAS,)
+
+
+def _polars(engine):
+    return engine == POLARS and pl is not None
+
+
+def _lazy(df, cols):
+    """
+    Colonne `cols` come LazyFrame con nomi posizionali (`c0`, `c1`, …) e
+    indice di riga `ROW`, o None se Polars non le rappresenta.
+    """
+    cols = list(dict.fromkeys(cols))
+    try:
+        frame = pl.from_pandas(df[cols].set_axis([f"c{i}" for i in range(len(cols))], axis=1))
+    except (TypeError, ValueError, NotImplementedError, pl.exceptions.PolarsError):  # anche errori pyarrow
+        return None
+    return frame.lazy().with_row_index(ROW)
+
+
+def _take(values, idx):
+    """Valori di `values` alle posizioni `idx` (-1 → mancante), con le promozioni di tipo di un merge pandas."""
+    arr = values.to_numpy() if isinstance(values.dtype, np.dtype) else values.array
+    return pd.api.extensions.take(arr, idx, allow_fill=True)
+
+
+def _column(arr, index):
+    """Colonna come la produce un merge: il tipo resta quello di `arr` (object non diventa testo)."""
+    return pd.Series(arr, index=index, dtype=arr.dtype)
+
+
+def _group_index(arr):
+    """Chiavi di gruppo come le produce un groupby: Index costruito dai valori (object di testo → str)."""
+    return pd.Index(arr)
+
+
+def group_codes(df, keys):
+    """
+    Codici di gruppo delle righe per le chiavi `keys`: 0, 1, … nell'ordine di
+    `groupby(keys, dropna=False)` (chiavi crescenti, mancanti in fondo a ogni
+    livello). Ritorna (codici, posizione della prima riga di ogni gruppo) o
+    None se le colonne non sono convertibili.
+    """
+    lf = _lazy(df, keys)
+    if lf is None:
+        return None
+    # rank denso sulle chiavi, ciascuna preceduta da "mancante?" perché i mancanti vadano in fondo
+    key = pl.struct([e for c in lf.collect_schema().names() if c != ROW
+                     for e in (pl.col(c).is_null().alias(f"{c}_na"), pl.col(c))])
+    codes = lf.select(key.rank("dense").cast(pl.Int64) - 1).collect().to_series().to_numpy()
+    first = np.full(codes.max() + 1 if len(codes) else 0, len(codes), dtype=np.int64)
+    np.minimum.at(first, codes, np.arange(len(codes)))
+    return codes, first
+
+
+def _coded(df, col):
+    """
+    `df` con `col` sostituita da codici di gruppo float (NaN dove la chiave
+    manca, come le chiavi escluse da `groupby(dropna=True)`) e decodifica dei
+    codici, oppure None.
+    """
+    gc = group_codes(df, [col])
+    if gc is None:
+        return None
+    codes, first = gc
+    codes = codes.astype(float)
+    codes[df[col].isna().to_numpy()] = np.nan
+    keys = df[col].iloc[first]
+
+    def decode(c):
+        v = c.to_numpy(dtype=float)
+        return pd.Series(_group_index(_take(keys, np.where(np.isnan(v), -1, v).astype(np.int64))), index=c.index)
+    return df.assign(**{col: codes}), decode
+
+
+# ---------- coorte ----------
+def select_naive(df, keys, date_col, cutoff, first_col=None, engine=PANDAS):
+    """`cohort.select_naive`: minimo per chiave (finestra), filtro sul cutoff, righe per posizione."""
+    if not _polars(engine) or not pd.api.types.is_datetime64_dtype(df[date_col]):
+        return cohort.select_naive(df, keys, date_col, cutoff, first_col)
+    keys = list(keys)
+    lf = _lazy(df, keys + [date_col])
+    if lf is None:
+        return cohort.select_naive(df, keys, date_col, cutoff, first_col)
+    names = [f"c{i}" for i in range(len(dict.fromkeys(keys)))]
+    d = f"c{list(dict.fromkeys(keys + [date_col])).index(date_col)}"
+    cutoff = pd.to_datetime(cutoff).to_pydatetime()
+    res = (lf.with_columns(pl.col(d).min().over(names).alias("prima"))
+             .filter(pl.all_horizontal([pl.col(k).is_not_null() for k in names]) & (pl.col("prima") >= cutoff))
+             .select(ROW, "prima")
+             .collect())
+    out = df.iloc[res[ROW].to_numpy()].copy()
+    if first_col:
+        out[first_col] = res["prima"].to_numpy().astype(df[date_col].dtype)
+    return out.reset_index(drop=True)
+
+
+def merge_ddd_standard(df, tab_ddd, atc_col, atc_ddd_col, ddd_std_col, ddd_col, engine=PANDAS):
+    """`cohort.merge_ddd_standard`: join sulle sole chiavi ATC, colonne del lookup riportate per indice."""
+    added = {atc_ddd_col, ddd_std_col, "DDD_standard"} - {atc_col}
+    if (not _polars(engine) or added & set(df.columns) or atc_ddd_col == ddd_std_col
+            or df[atc_col].dtype != tab_ddd[atc_ddd_col].dtype):
+        return cohort.merge_ddd_standard(df, tab_ddd, atc_col, atc_ddd_col, ddd_std_col, ddd_col)
+    tab2 = tab_ddd[[atc_ddd_col, ddd_std_col]].drop_duplicates(subset=[atc_ddd_col])
+    left, right = _lazy(df, [atc_col]), _lazy(tab2, [atc_ddd_col])
+    if left is None or right is None:
+        return cohort.merge_ddd_standard(df, tab_ddd, atc_col, atc_ddd_col, ddd_std_col, ddd_col)
+    idx = (left.join(right.rename({ROW: "lookup"}), on="c0", how="left", nulls_equal=True, maintain_order="left")
+               .select(pl.col("lookup").fill_null(-1).cast(pl.Int64))
+               .collect()["lookup"].to_numpy())
+    out = df.reset_index(drop=True)
+    for c in [atc_ddd_col, ddd_std_col] if atc_ddd_col != atc_col else [ddd_std_col]:
+        out[c] = _column(_take(tab2[c], idx), out.index)
+    return cohort.ddd_numeric(out.rename(columns={ddd_std_col: "DDD_standard"}), ddd_col)
+
+
+def dedup_same_day(disp, keys, value="__giorni_coperti_disp__", engine=PANDAS):
+    """`cohort.dedup_same_day`: gruppi da Polars, somma (stesso algoritmo di pandas) sui codici."""
+    keys = list(dict.fromkeys(keys))
+    gc = group_codes(disp, keys) if _polars(engine) else None
+    if gc is None:
+        return cohort.dedup_same_day(disp, keys, value)
+    codes, first = gc
+    out = pd.DataFrame({k: _group_index(disp[k].array[first]) for k in keys})
+    out[value] = disp[value].groupby(codes).sum().to_numpy()
+    return out
+
+
+# ---------- riepiloghi ----------
+def riepilogo_pdc(aderenza, by="ATC_unit", value="PDC_persistenza", flag="Aderente", engine=PANDAS):
+    """`adherence.riepilogo_pdc` sui codici di gruppo."""
+    coded = _coded(aderenza, by) if _polars(engine) else None
+    if coded is None:
+        return adherence.riepilogo_pdc(aderenza, by, value, flag)
+    frame, decode = coded
+    out = adherence.riepilogo_pdc(frame, by, value, flag)
+    out[by] = decode(out[by])
+    return out
+
+
+def riepilogo_adh(out, group_by_col, thr, engine=PANDAS):
+    """`adherence.riepilogo_adh` sui codici di gruppo."""
+    coded = _coded(out, group_by_col) if _polars(engine) else None
+    if coded is None:
+        return adherence.riepilogo_adh(out, group_by_col, thr)
+    frame, decode = coded
+    res = adherence.riepilogo_adh(frame, group_by_col, thr)
+    res[group_by_col] = decode(res[group_by_col])
+    return res
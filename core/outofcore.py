@@ -0,0 +1,237 @@
+"""
+Elaborazione fuori memoria per estratti più grandi della RAM (batch.py
+--fuori-memoria): l'input CSV o Parquet si legge a blocchi di righe e si
+ripartisce per paziente (hash dell'identificativo) in shard Parquet su disco;
+i job di core/batch.py girano uno shard alla volta per processo, e ogni
+shard restituisce solo riepiloghi parziali che si uniscono in modo esatto:
+
+- PDC: conteggi, aderenti, min/max, media e DS (formula di Chan sui momenti);
+  P10/P50/P90 da uno sketch a istogramma di passo 1/SKETCH_BINS, unibile per
+  somma (errore ≤ mezzo passo).
+- KM/log-rank e KM allo switch: pazienti per (gruppo, tempo, evento), i
+  motori di core/survival.py accettano righe pesate.
+- Sankey: transizioni per (step, sorgente, destinazione, giorni) e switch
+  per (categorie, data): conteggi e quartili dei giorni esatti (giorni interi).
+
+Le tabelle per paziente/unità restano una parte per shard
+(`<job>/<tabella>/part-XXXXX.parquet`): stesse righe del calcolo in memoria,
+nell'ordine degli shard. Nei CSV le colonne usate si leggono come testo,
+tranne le DDD (numeriche, non valide → NaN come `safe_numeric` → 0).
+"""
+import csv
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .ingestion import NAT_STRINGS
+from .pathways import filter_links
+from .survival import km_by_group
+
+CHUNK_ROWS = 1_000_000
+SHARDS = 64
+# passo dello sketch dei quantili del PDC (valori in [0, 1])
+SKETCH_BINS = 2**16
+# posizione della riga nell'estratto: ordine del file per il formato delle date
+ROW_COL = "__riga"
+_COLUMN_KEYS = ("id", "atc", "data", "ddd", "strat")
+
+
+# ---------- lettura a blocchi e shard ----------
+def spec_columns(spec):
+    """Colonne dell'estratto usate dai job (mappatura, filtri, `per`): le sole lette e scritte negli shard."""
+    cols, numeric, ids = {}, set(), set()
+    for job in spec.get("jobs", []):
+        c = {**spec.get("colonne", {}), **job.get("colonne", {})}
+        cols.update(dict.fromkeys(c[k] for k in _COLUMN_KEYS if k in c))
+        cols.update(dict.fromkeys(job.get("filtro", {})))
+        if job.get("per"):
+            cols[job["per"]] = None
+        numeric.add(c.get("ddd"))
+        ids.add(c.get("id"))
+    if len(ids) != 1:
+        raise ValueError("Fuori memoria: tutti i job devono usare la stessa colonna identificativo (colonne.id).")
+    return list(cols), numeric & set(cols), ids.pop()
+
+
+def _csv_options(path):
+    """Separatore come `read_any`: dedotto dalla prima riga, altrimenti `;` con decimale `,`."""
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        line = f.readline()
+    try:
+        return dict(sep=csv.Sniffer().sniff(line).delimiter)
+    except csv.Error:
+        return dict(sep=";", decimal=",")
+
+
+def iter_chunks(path, columns, numeric=(), chunk_rows=CHUNK_ROWS):
+    """Blocchi di righe (DataFrame) con le sole `columns`. Ritorna (schema Arrow, iteratore dei blocchi)."""
+    name = str(path).lower()
+    if name.endswith(".parquet"):
+        pf = pq.ParquetFile(path)
+        schema = pa.schema([pf.schema_arrow.field(c) for c in columns])
+        chunks = (b.to_pandas() for b in pf.iter_batches(batch_size=chunk_rows, columns=columns))
+    elif name.endswith(".csv"):
+        dtype = {c: str for c in columns if c not in numeric}
+        schema = pa.schema([(c, pa.float64() if c in numeric else pa.large_string()) for c in columns])
+        chunks = pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunk_rows, **_csv_options(path))
+    else:
+        raise ValueError("Fuori memoria: solo CSV o Parquet (un file Excel sta comunque in memoria).")
+
+    def blocks():
+        for chunk in chunks:
+            for c in numeric:
+                if not pd.api.types.is_numeric_dtype(chunk[c]):
+                    chunk[c] = pd.to_numeric(chunk[c], errors="coerce")
+            yield chunk
+    return schema, blocks()
+
+
+def partition(path, out_dir, id_col, columns, numeric=(), n_shards=SHARDS, chunk_rows=CHUNK_ROWS, uniques=(),
+              log=None):
+    """
+    Ripartisce l'estratto in `n_shards` file Parquet per hash di `id_col`:
+    tutte le righe di un paziente nello stesso shard, nell'ordine del file
+    (colonna ROW_COL = posizione nell'estratto). Un blocco alla volta in
+    memoria; ogni shard riceve un row group per blocco. Ritorna
+    dict(shards=[percorsi], righe=n, valori={colonna: valori distinti} per `uniques`).
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    schema, chunks = iter_chunks(path, columns, numeric, chunk_rows)
+    schema = schema.append(pa.field(ROW_COL, pa.int64()))
+    writers, valori, n = {}, {c: pd.Index([]) for c in uniques}, 0
+    try:
+        for chunk in chunks:
+            chunk[ROW_COL] = np.arange(n, n + len(chunk), dtype=np.int64)
+            n += len(chunk)
+            for c in uniques:
+                valori[c] = valori[c].union(pd.Index(chunk[c].dropna().unique()))
+            shard = pd.util.hash_pandas_object(chunk[id_col], index=False).to_numpy() % np.uint64(n_shards)
+            order = np.argsort(shard, kind="stable")
+            bounds = np.searchsorted(shard[order], np.arange(n_shards + 1))
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            for k in np.flatnonzero(np.diff(bounds)):
+                if k not in writers:
+                    writers[k] = pq.ParquetWriter(out_dir / f"shard-{k:05d}.parquet", schema)
+                writers[k].write_table(table.take(order[bounds[k]:bounds[k + 1]]))
+            if log:
+                log(f"  {n:,} righe lette")
+    finally:
+        for w in writers.values():
+            w.close()
+    return dict(shards=[out_dir / f"shard-{k:05d}.parquet" for k in sorted(writers)], righe=n,
+                valori={c: pd.Series(v) for c, v in valori.items()})
+
+
+def first_date(df, date_col):
+    """(posizione nell'estratto, valore) della prima data non vuota dello shard, o None: vedi `date_anchor`."""
+    s = df[date_col]
+    ok = s.notna()
+    if pd.api.types.is_string_dtype(s) or s.dtype == object:
+        ok &= ~s.astype(object).isin(NAT_STRINGS)
+    if not ok.any():
+        return None
+    i = int(np.argmax(ok.to_numpy()))
+    return int(df[ROW_COL].iloc[i]), s.iloc[i]
+
+
+# ---------- riepiloghi parziali e unione ----------
+def merge_counts(parts, keys, dropna=True):
+    """Somma per chiave delle tabelle di conteggio degli shard (colonna `n`)."""
+    parts = [p for p in parts if p is not None and not p.empty]
+    if not parts:
+        return None
+    t = pd.concat(parts, ignore_index=True)
+    return t.groupby(keys, sort=True, dropna=dropna)["n"].sum().reset_index()
+
+
+def _counts(df, keys, dropna=True):
+    return df.groupby(keys, sort=True, dropna=dropna).size().rename("n").reset_index()
+
+
+def quantiles_from_counts(values, counts, qs):
+    """Quantili con interpolazione lineare come pandas, da valori distinti ordinati e numero di ripetizioni."""
+    cum = np.cumsum(counts)
+    if not len(cum) or cum[-1] == 0:
+        return [np.nan] * len(qs)
+    n = int(cum[-1])
+    out = []
+    for q in qs:
+        h = (n - 1) * q
+        lo = int(np.floor(h))
+        a = values[np.searchsorted(cum, lo, side="right")]
+        b = values[np.searchsorted(cum, min(lo + 1, n - 1), side="right")]
+        out.append(a + (b - a) * (h - lo))
+    return out
+
+
+def pdc_partial(ader, by="ATC_unit", value="PDC_persistenza", flag="Aderente"):
+    """Momenti per gruppo (n, aderenti, media, M2, min, max) e sketch dei quantili di uno shard."""
+    g = ader.groupby(by)
+    mom = g.agg(n=(value, "count"), aderenti=(flag, "sum"), media=(value, "mean"),
+                minimo=(value, "min"), massimo=(value, "max"))
+    mom["m2"] = ((ader[value] - g[value].transform("mean")) ** 2).groupby(ader[by]).sum()
+    ok = ader[value].notna() & ader[by].notna()
+    sketch = pd.DataFrame({by: ader.loc[ok, by].to_numpy(),
+                           "classe": np.rint(ader.loc[ok, value].to_numpy(float) * SKETCH_BINS).astype(np.int64)})
+    return mom.reset_index(), _counts(sketch, [by, "classe"])
+
+
+def pdc_summary(parts, by="ATC_unit"):
+    """`adherence.riepilogo_pdc` dall'unione dei parziali degli shard (quantili dallo sketch)."""
+    mom = pd.concat([m for m, _ in parts], ignore_index=True)
+    g = mom.groupby(by)
+    n = g["n"].sum()
+    media = (mom["n"] * mom["media"].fillna(0)).groupby(mom[by]).sum() / n
+    delta = mom["media"] - media.reindex(mom[by]).to_numpy()
+    m2 = g["m2"].sum() + (mom["n"] * delta**2).fillna(0).groupby(mom[by]).sum()
+    out = pd.DataFrame({"N_unit": n, "N_aderenti": g["aderenti"].sum(), "PDC_medio": media,
+                        "PDC_std": np.sqrt(m2 / (n - 1)).where(n > 1)})
+    q = {}
+    sketch = merge_counts([s for _, s in parts], [by, "classe"])
+    for key, s in ([] if sketch is None else sketch.groupby(by)):
+        q[key] = quantiles_from_counts(s["classe"].to_numpy() / SKETCH_BINS, s["n"].to_numpy(), [0.5, 0.1, 0.9])
+    q = pd.DataFrame.from_dict(q, orient="index", columns=["P50", "P10", "P90"]).reindex(out.index)
+    out[["P50", "P10", "P90"]] = q.to_numpy()
+    out["PDC_min"] = g["minimo"].min()
+    out["PDC_max"] = g["massimo"].max()
+    out = out.reset_index()
+    out["%_aderenti"] = (100 * out["N_aderenti"] / out["N_unit"]).round(1)
+    return out
+
+
+def km_partial(included):
+    """Pazienti inclusi per (gruppo, tempo, evento) di uno shard."""
+    return _counts(included, ["gruppo", "time", "event"])
+
+
+def sankey_partial(trans, surv):
+    """Transizioni per (step, sorgente, destinazione, giorni), switch per (categorie, data) e tempi allo switch."""
+    flows = _counts(trans, ["step", "source", "target", "days"], dropna=False)
+    if surv is None:
+        return flows, None, None
+    switches = _counts(trans[trans["switch_date"].notna()], ["source_cat", "target_cat", "switch_date"])
+    return flows, switches, _counts(surv, ["Terapia", "time", "event"])
+
+
+def sankey_result(parts, min_flow, per_src_min):
+    """Link, KM allo switch e switch per anno come `pathways.compute_flows`, dai parziali degli shard."""
+    flows = merge_counts([f for f, _, _ in parts], ["step", "source", "target", "days"], dropna=False)
+    g_flow = flows.groupby(["step", "source", "target"], sort=True)
+    rows = []
+    for key, g in g_flow:
+        g = g[g["days"].notna()].sort_values("days")
+        rows.append((*key, *quantiles_from_counts(g["days"].to_numpy(float), g["n"].to_numpy(), [0.25, 0.5, 0.75])))
+    links = pd.DataFrame(rows, columns=["step", "source", "target", "Giorni_switch_Q1", "Giorni_switch_mediana",
+                                        "Giorni_switch_Q3"])
+    links.insert(3, "Count", g_flow["n"].sum().to_numpy())
+    links, labels, msg = filter_links(links, min_flow, per_src_min)
+    if links is None:
+        return None, msg
+    surv = merge_counts([k for _, _, k in parts], ["Terapia", "time", "event"])
+    km = None if surv is None else km_by_group(surv["Terapia"], surv["time"], surv["event"], surv["n"])
+    switches = merge_counts([s for _, s, _ in parts], ["source_cat", "target_cat", "switch_date"])
+    return dict(links=links, labels=labels, km=km, line_trans=switches), None
@@ -0,0 +1,506 @@
+"""Percorsi terapeutici: linee, regimi di combinazione, esiti e flussi Sankey."""
+import re
+
+import numpy as np
+import pandas as pd
+
+from .cohort import select_naive
+from .ingestion import safe_dt
+from .survival import km_by_group
+
+
+def collapse_consecutive(df, id_col, cat_col):
+    """Rimuove ripetizioni consecutive della stessa categoria per paziente."""
+    g = df.sort_values([id_col, "___DATE___"]).copy()
+    keep = g[cat_col] != g.groupby(id_col)[cat_col].shift(1)
+    return g[keep]
+
+
+def assign_lines_by_first_seen(grp, cat_col):
+    """Linea = +1 alla prima NUOVA categoria (mai vista prima nel paziente)."""
+    seen, out = set(), []
+    k = 0
+    for v in grp[cat_col]:
+        if v not in seen:
+            k += 1
+            seen.add(v)
+        out.append(k)
+    return pd.Series(out, index=grp.index)
+
+
+def assign_lines_first_seen(df, id_col, cat_col):
+    """
+    Come `assign_lines_by_first_seen` su tutti i pazienti insieme: la linea cresce
+    alla prima comparsa di ogni (paziente, categoria), in ordine di riga.
+    """
+    first = ~df.duplicated([id_col, cat_col])
+    return first.groupby(df[id_col]).cumsum().astype(int)
+
+
+def lines_on_change(df, id_col, cat_col, date_col):
+    """Linea = +1 a ogni cambio di categoria rispetto alla dispensazione precedente."""
+    df = df.sort_values([id_col, date_col])
+    cambio = df[cat_col].ne(df.groupby(id_col)[cat_col].shift())
+    df["Linea"] = cambio.groupby(df[id_col]).cumsum().astype(int)
+    df["Terapia_linea"] = df[cat_col] + " (Linea " + df["Linea"].astype(str) + ")"
+    return df
+
+
+def stage_from_label(label: str) -> int:
+    """Estrae N da '(Linea N)' o '(Mese N)'; usa 10000 per gli Esiti (così vanno a destra)."""
+    m = re.search(r"\((?:Linea|Mese)\s+(\d+)\)$", str(label))
+    return int(m.group(1)) if m else 10_000
+
+
+def pretty_label(s: str, maxlen: int = 28) -> str:
+    """Etichette in Title Case, a capo su '+' e prima di '(Linea N)' / '(Mese N)'. """
+    s = str(s).strip()
+    s = s.replace(" + ", "<br>+ ").replace(" (Linea", "<br>(Linea").replace(" (Mese", "<br>(Mese")
+    plain = re.sub(r"<br>", " ", s).title()
+    if len(plain) > maxlen:
+        plain = plain[:maxlen] + "…"
+    return plain.replace(" + ", "<br>+ ").replace(" (Linea", "<br>(Linea").replace(" (Mese", "<br>(Mese")
+
+
+def csr_from_pairs(keys, values, n_keys):
+    """Indice invertito compatto (CSR): offsets int64 + valori int32 ordinati per chiave."""
+    keys = np.asarray(keys, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n_keys), out=offsets[1:])
+    return offsets, np.asarray(values)[order].astype(np.int32)
+
+
+def expand_ranges(starts, ends):
+    """Concatena gli intervalli [start, end) senza loop Python."""
+    lens = ends - starts
+    total = int(lens.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    shift = np.repeat(starts - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens)
+    return shift + np.arange(total, dtype=np.int64)
+
+
+def build_regimens(df, cat_col, window_days):
+    """
+    Regimi di combinazione: dispensazioni di categorie diverse allo stesso paziente
+    a non più di `window_days` giorni l'una dall'altra (sweep sulla timeline ordinata)
+    formano un episodio, etichettato con la combinazione ordinata "A + B".
+    Vettoriale: episodi da cumsum sui salti di paziente/finestra; ogni categoria è
+    una maschera di bit sui componenti, l'episodio è l'OR (reduceat) delle maschere.
+    I loop Python girano solo sulle categorie e sulle combinazioni distinte.
+    """
+    d = df.sort_values(["___PID___", "___DATE___"], kind="stable")
+    pid = d["___PID___"].to_numpy()
+    dt = d["___DATE___"].to_numpy()
+    new_ep = np.ones(len(d), dtype=bool)
+    new_ep[1:] = (pid[1:] != pid[:-1]) | ((dt[1:] - dt[:-1]) > np.timedelta64(int(window_days), "D"))
+    if len(d) == 0:
+        return d
+
+    # componenti canoniche (anche le etichette già combinate "B + A" vengono riordinate)
+    cat_codes, cat_uniques = pd.factorize(d[cat_col])
+    comps = [set(str(u).split(" + ")) for u in cat_uniques]
+    vocab = sorted(set().union(*comps))
+    pos = {c: i for i, c in enumerate(vocab)}
+    masks = np.zeros((len(cat_uniques), len(vocab) // 64 + 1), dtype=np.uint64)
+    for i, cs in enumerate(comps):
+        for c in cs:
+            masks[i, pos[c] // 64] |= np.uint64(1) << np.uint64(pos[c] % 64)
+
+    starts = np.flatnonzero(new_ep)
+    ep_mask = np.bitwise_or.reduceat(masks[cat_codes], starts, axis=0)
+    if ep_mask.shape[1] == 1:  # caso tipico (≤ 64 componenti): unique 1-D, molto più rapido
+        uniq, inv = np.unique(ep_mask[:, 0], return_inverse=True)
+        uniq_mask = uniq[:, None]
+    else:
+        uniq_mask, inv = np.unique(ep_mask, axis=0, return_inverse=True)
+    labels = np.array([
+        " + ".join(vocab[w * 64 + b] for w in range(row.size) for b in range(64) if (int(row[w]) >> b) & 1)
+        for row in uniq_mask
+    ], dtype=object)
+    d[cat_col] = labels[inv.ravel()][np.cumsum(new_ep) - 1]
+    return d
+
+
+def transition_tensor(src, tgt, year, weights=None):
+    """
+    Conteggi anno × sorgente × destinazione in un solo passaggio (bincount su
+    indice piatto; `weights`: transizioni per riga, per righe già aggregate).
+    Ritorna (anni, categorie, COO sparso con solo le celle > 0).
+    """
+    y_codes, years = pd.factorize(np.asarray(year), sort=True)
+    cats = np.union1d(pd.unique(np.asarray(src)), pd.unique(np.asarray(tgt)))
+    s_codes = np.searchsorted(cats, src)
+    t_codes = np.searchsorted(cats, tgt)
+    k = len(cats)
+    flat = (y_codes.astype(np.int64) * k + s_codes) * k + t_codes
+    counts = np.bincount(flat, weights=weights, minlength=len(years) * k * k).astype(np.int64)
+    nz = np.flatnonzero(counts)
+    coo = pd.DataFrame({
+        "y": nz // (k * k), "s": (nz // k) % k, "t": nz % k, "n": counts[nz],
+    })
+    return np.asarray(years), cats, coo
+
+
+def bootstrap_rows(n_rows, p_rows, n_boot, seed=0, level=0.95, max_cells=4_000_000):
+    """
+    IC bootstrap delle probabilità di riga: ricampionamento multinomiale a blocchi
+    di righe (un'unica chiamata NumPy per blocco, B × righe × destinazioni).
+    """
+    rng = np.random.default_rng(seed)
+    r, k = p_rows.shape
+    lo = np.empty_like(p_rows)
+    hi = np.empty_like(p_rows)
+    alpha = (1.0 - level) / 2.0 * 100
+    step = max(1, max_cells // max(1, n_boot * k))
+    for a in range(0, r, step):
+        b = min(r, a + step)
+        draws = rng.multinomial(n_rows[a:b], p_rows[a:b], size=(n_boot, b - a))
+        boot = draws / n_rows[a:b, None]
+        lo[a:b], hi[a:b] = np.percentile(boot, [alpha, 100 - alpha], axis=0)
+    return lo, hi
+
+
+# ---------- esiti (motore a regole) ----------
+# regole valutate in ordine sul riepilogo per paziente: vince la prima vera.
+# Ogni regola è (etichetta, funzione(riepilogo, parametri) -> array bool).
+# Parametri: cutoff_fu, gap_days (copertura attesa dopo l'ultima dispensazione,
+# 0 = regola del solo cut-off) e data_end (ultima data dell'estratto: oltre
+# non c'è osservazione).
+def _coverage_end(s, p):
+    """Fine della copertura attesa: ultima dispensazione + gap_days."""
+    return s["last"] + np.timedelta64(int(p["gap_days"]), "D")
+
+
+def _observed_until(p):
+    """Fine dell'osservazione: cut-off, o fine dei dati se l'estratto finisce prima."""
+    end = p.get("data_end")
+    return p["cutoff_fu"] if end is None or np.isnat(end) else min(p["cutoff_fu"], end)
+
+
+OUTCOME_RULES = [
+    # copertura attesa che arriva al cut-off (con gap_days = 0: dispensazione al/dopo il cut-off)
+    ("In trattamento",
+     lambda s, p: _coverage_end(s, p) >= p["cutoff_fu"]),
+    ("Switch a farmaco non in studio",
+     lambda s, p: s["other_last"] > s["last"]),
+    # copertura scaduta mentre il paziente era ancora osservato (gap dopo la fine attesa)
+    ("Interrotto",
+     lambda s, p: (p["gap_days"] > 0) & (_coverage_end(s, p) < _observed_until(p))),
+]
+# nessuna regola vera: il paziente esce dall'osservazione (fine dei dati prima
+# che la copertura scada) o, con gap_days = 0, non è più dispensato al cut-off
+OUTCOME_DEFAULT = "Perso al follow-up"
+
+
+def patient_summary(df, n_pat, other=None):
+    """
+    Riepilogo per paziente come array NumPy indicizzati dal codice ___PID___:
+    prima/ultima dispensazione, n. dispensazioni e ultima dispensazione di
+    farmaci non in studio (NaT se assente).
+    """
+    g = df.groupby("___PID___")["___DATE___"]
+    idx = np.arange(n_pat)
+    out = {
+        "first": g.min().reindex(idx).to_numpy(),
+        "last": g.max().reindex(idx).to_numpy(),
+        "n_disp": g.size().reindex(idx, fill_value=0).to_numpy(),
+    }
+    if other is not None and not other.empty:
+        out["other_last"] = other.groupby("___PID___")["___DATE___"].max().reindex(idx).to_numpy()
+    else:
+        out["other_last"] = np.full(n_pat, np.datetime64("NaT"), dtype="datetime64[ns]")
+    return out
+
+
+def assign_outcomes(summary, params, rules=OUTCOME_RULES, default=OUTCOME_DEFAULT):
+    """Esito per paziente (array indicizzato dal codice) con regole vettoriali, senza apply per riga."""
+    conds = [np.asarray(fn(summary, params), dtype=bool) for _, fn in rules]
+    return np.select(conds, [lab for lab, _ in rules], default=default).astype(object)
+
+
+def line_transitions(df, id_col, cat_col, collapse, outcomes, last_seen, cutoff_fu):
+    """
+    Transizioni per linee terapeutiche: una riga per paziente×passaggio
+    (Linea i → i+1, poi Terapia finale → Esito) con i giorni allo switch,
+    più il tempo allo switch per ingresso in linea (vedi `entry_transitions`).
+    `outcomes` e `last_seen` sono array per paziente (indice = codice ___PID___).
+    Ritorna (trans, surv, messaggio).
+    """
+    if collapse:
+        df = collapse_consecutive(df, id_col, cat_col)
+    if df.empty:
+        return None, None, "Nessun record dopo i filtri."
+
+    # linee terapeutiche = prima comparsa di nuova categoria
+    df["Linea"] = assign_lines_first_seen(df, id_col, cat_col)
+    df["Terapia"] = df[cat_col] + " (Linea " + df["Linea"].astype(int).astype(str) + ")"
+
+    max_line = int(df["Linea"].max())
+    if max_line < 1:
+        return None, None, "Dati insufficienti per il Sankey."
+
+    # ---------- flussi (no aggregazione) ----------
+    # una riga per paziente×linea: terapia e data d'ingresso in linea
+    entry = df.groupby(["___PID___", "Linea"], sort=True).agg(
+        Terapia=("Terapia", "first"), source_cat=(cat_col, "first"), entry_date=("___DATE___", "first")
+    ).reset_index()
+    last_step = df.groupby("___PID___").agg(source=("Terapia", "last")).reset_index()
+    trans, surv = entry_transitions(entry, last_step, outcomes, last_seen, cutoff_fu)
+    return trans, surv, None
+
+
+def entry_transitions(entry, last_step, outcomes, last_seen, cutoff_fu):
+    """
+    Seconda metà di `line_transitions`, dagli ingressi in linea
+    [___PID___, Linea, Terapia, source_cat, entry_date] ordinati per paziente e
+    linea e dall'ultima terapia per paziente [___PID___, source]: la usa anche
+    il ricalcolo incrementale (core/incremental.py). Ritorna (trans, surv):
+    surv è il tempo allo switch per ingresso in linea [Terapia, time, event].
+    """
+    g_entry = entry.groupby("___PID___")
+    entry["target"] = g_entry["Terapia"].shift(-1)
+    entry["target_cat"] = g_entry["source_cat"].shift(-1)
+    entry["switch_date"] = g_entry["entry_date"].shift(-1)
+    entry["days"] = (entry["switch_date"] - entry["entry_date"]).dt.days
+
+    # tempo allo switch con censura: chi non cambia linea è censurato a
+    # min(ultima dispensazione, cut-off FU)
+    obs_end = pd.Series(last_seen[entry["___PID___"].to_numpy()], index=entry.index).clip(
+        upper=pd.Timestamp(cutoff_fu))
+    switched = entry["target"].notna()
+    surv = pd.DataFrame({
+        "Terapia": entry["Terapia"],
+        "time": entry["days"].where(switched, (obs_end - entry["entry_date"]).dt.days).clip(lower=0),
+        "event": switched,
+    })
+
+    # transizioni Linea i -> i+1
+    trans = entry[switched].rename(columns={"Linea": "step", "Terapia": "source"})
+
+    # Terapia finale -> Esito (esiti in fondo, come prima)
+    last_step = last_step.copy()
+    last_step["target"] = outcomes[last_step["___PID___"].to_numpy()]
+    last_step["step"] = 10_000
+    trans = pd.concat([trans, last_step], ignore_index=True)[
+        ["___PID___", "step", "source", "target", "days", "source_cat", "target_cat", "switch_date"]
+    ]
+    return trans, surv
+
+
+def checkpoint_transitions(df, cat_col, checkpoints, grace_days, cutoff_fu):
+    """
+    Stato ai checkpoint (mesi dall'inizio terapia): per ogni paziente×checkpoint
+    un solo merge_asof trova l'ultima dispensazione ≤ checkpoint; la terapia è
+    attiva se dispensata entro `grace_days` prima del checkpoint, altrimenti
+    "Interrotto". I checkpoint oltre il cut-off FU sono "Non osservabile".
+    Ritorna le transizioni checkpoint k → k+1 (una riga per paziente).
+    """
+    cps = sorted(int(m) for m in checkpoints)
+    start = df.groupby("___PID___")["___DATE___"].min()
+    q = pd.concat(
+        [pd.DataFrame({"___PID___": start.index, "Mese": m, "cp_date": (start + pd.DateOffset(months=m)).to_numpy()})
+         for m in cps],
+        ignore_index=True,
+    ).sort_values("cp_date", kind="stable")
+    right = df[["___PID___", "___DATE___", cat_col]].sort_values("___DATE___", kind="stable")
+    st_cp = pd.merge_asof(q, right, left_on="cp_date", right_on="___DATE___", by="___PID___", direction="backward")
+
+    st_cp["Stato"] = np.where(
+        st_cp["cp_date"] > pd.Timestamp(cutoff_fu), "Non osservabile",
+        np.where(st_cp["cp_date"] - st_cp["___DATE___"] > pd.Timedelta(days=int(grace_days)),
+                 "Interrotto", st_cp[cat_col].astype(str)),
+    )
+    st_cp["Terapia"] = st_cp["Stato"] + " (Mese " + st_cp["Mese"].astype(str) + ")"
+    st_cp = st_cp.sort_values(["___PID___", "Mese"])
+    st_cp["target"] = st_cp.groupby("___PID___")["Terapia"].shift(-1)
+
+    # chi non è più osservabile non genera altri flussi
+    trans = st_cp[st_cp["target"].notna() & (st_cp["Stato"] != "Non osservabile")]
+    trans = trans.rename(columns={"Mese": "step", "Terapia": "source"})
+    trans["days"] = np.nan
+    return trans[["___PID___", "step", "source", "target", "days"]]
+
+
+def flow_links(trans, min_flow, per_src_min):
+    """
+    Link del Sankey dalle transizioni: conteggi e quartili dei giorni allo
+    switch, filtri per N assoluto e per % della sorgente, id dei nodi.
+    Ritorna (link, etichette, messaggio): link è None se non resta nulla.
+    """
+    # conteggi e distribuzione dei giorni allo switch nello stesso groupby
+    g_flow = trans.groupby(["step", "source", "target"])
+    sankey_df = g_flow.size().to_frame("Count")
+    q = g_flow["days"].quantile([0.25, 0.5, 0.75]).unstack()
+    sankey_df["Giorni_switch_Q1"] = q[0.25]
+    sankey_df["Giorni_switch_mediana"] = q[0.5]
+    sankey_df["Giorni_switch_Q3"] = q[0.75]
+    return filter_links(sankey_df.reset_index(), min_flow, per_src_min)
+
+
+def filter_links(sankey_df, min_flow, per_src_min):
+    """
+    Seconda metà di `flow_links`, dai conteggi per (step, source, target)
+    ordinati: la usa anche l'elaborazione a shard (core/outofcore.py).
+    """
+    sankey_df = sankey_df.drop(columns="step")
+    # filtro assoluto
+    sankey_df = sankey_df[sankey_df["Count"] >= int(min_flow)].copy()
+    if sankey_df.empty:
+        return None, None, "Tutti i flussi sono sotto la soglia selezionata (N)."
+
+    # filtro per % della sorgente
+    tot_src_tmp = sankey_df.groupby("source")["Count"].transform("sum")
+    sankey_df["Perc_source_%"] = (sankey_df["Count"] / tot_src_tmp * 100)
+    sankey_df = sankey_df[sankey_df["Perc_source_%"] >= float(per_src_min)].reset_index(drop=True)
+    if sankey_df.empty:
+        return None, None, "Tutti i flussi sono sotto la soglia percentuale impostata."
+
+    # id mapping (l'indice di riga di sankey_df è l'id del link)
+    all_labels = pd.unique(sankey_df[["source", "target"]].values.ravel()).tolist()
+    id_map = {lab: i for i, lab in enumerate(all_labels)}
+    sankey_df["source_id"] = sankey_df["source"].map(id_map)
+    sankey_df["target_id"] = sankey_df["target"].map(id_map)
+
+    return sankey_df, all_labels, None
+
+
+def flow_transitions(df, id_col, cat_col, date_col, cutoff_naive, cutoff_fu, collapse, mode, checkpoints,
+                     grace_days, regimen_window, gap_days, non_study, progress=None, data_end=None):
+    """
+    Prima metà di `compute_flows`: coorte naïve e transizioni per paziente,
+    senza aggregarle (l'elaborazione a shard, core/outofcore.py, aggrega
+    dopo aver unito gli shard). Ritorna (dict(trans, surv, patients, disp,
+    disp_ptr), messaggio); surv è None nella modalità a checkpoint.
+    `data_end` è la fine dell'estratto per gli esiti (default: ultima data di `df`).
+    """
+    progress = progress or (lambda frac, msg=None: None)
+    progress(0.0, "Parsing date")
+    df = df.copy()
+    df[date_col] = safe_dt(df[date_col])
+    df = df.dropna(subset=[date_col])
+    df["___DATE___"] = df[date_col]
+    df[cat_col] = df[cat_col].astype(str).str.strip()
+    data_end = df[date_col].max() if data_end is None else data_end
+
+    # coorte NAÏVE
+    progress(0.15, "Coorte naïve")
+    df = select_naive(df, [id_col], "___DATE___", cutoff_naive).sort_values([id_col, "___DATE___"])
+
+    # codici paziente compatti (int32) e dispensazioni ordinate per codice
+    pid_codes, patients = pd.factorize(df[id_col], sort=True)
+    df["___PID___"] = pid_codes.astype(np.int32)
+    disp = df.drop(columns=["___DATE___"]).reset_index(drop=True)
+    disp_ptr = np.searchsorted(disp["___PID___"].to_numpy(), np.arange(len(patients) + 1))
+
+    # farmaci non in studio: esclusi da linee/flussi, usati solo per l'esito "switch"
+    is_other = df[cat_col].isin(non_study)
+    other, df = df[is_other], df[~is_other]
+    if df.empty:
+        return None, "Nessun record dopo i filtri."
+
+    # regimi di combinazione (prima di linee/checkpoint)
+    if regimen_window > 0:
+        df = build_regimens(df, cat_col, regimen_window)
+
+    progress(0.3, "Transizioni")
+    surv = None
+    if mode == "Stato ai checkpoint":
+        if len(checkpoints) < 2:
+            return None, "Seleziona almeno due checkpoint."
+        trans = checkpoint_transitions(df, cat_col, checkpoints, grace_days, cutoff_fu)
+    else:
+        summary = patient_summary(df, len(patients), other)
+        outcomes = assign_outcomes(summary, {"cutoff_fu": np.datetime64(pd.Timestamp(cutoff_fu), "ns"),
+                                              "gap_days": int(gap_days),
+                                              "data_end": np.datetime64(pd.Timestamp(data_end), "ns")})
+        trans, surv, msg = line_transitions(df, id_col, cat_col, collapse, outcomes, summary["last"], cutoff_fu)
+        if trans is None:
+            return None, msg
+    return dict(trans=trans, surv=surv, patients=patients, disp=disp, disp_ptr=disp_ptr), None
+
+
+def compute_flows(df, id_col, cat_col, date_col, cutoff_naive, cutoff_fu,
+                  collapse, min_flow, per_src_min, mode, checkpoints, grace_days,
+                  regimen_window, gap_days, non_study, progress=None):
+    """
+    Parte "pesante" della pipeline: coorte naïve, transizioni, flussi e filtri.
+    `progress(frazione, messaggio)` (opzionale, vedi core/jobs.py) è chiamata fra le fasi.
+    Oltre ai link produce l'indice invertito (CSR) link → pazienti e nodo → pazienti
+    (codici int32 su `patients`) e le dispensazioni ordinate per paziente con i
+    puntatori di riga, per il drill-down senza riscansionare la tabella.
+    Ritorna (risultato, messaggio): risultato è None se non c'è nulla da disegnare.
+    """
+    progress = progress or (lambda frac, msg=None: None)
+    out, msg = flow_transitions(df, id_col, cat_col, date_col, cutoff_naive, cutoff_fu, collapse, mode, checkpoints,
+                                grace_days, regimen_window, gap_days, non_study, progress)
+    if out is None:
+        return None, msg
+    trans, surv, patients = out["trans"], out["surv"], out["patients"]
+    km = None if surv is None else km_by_group(surv["Terapia"], surv["time"], surv["event"])
+
+    progress(0.7, "Flussi")
+    sankey_df, all_labels, msg = flow_links(trans, min_flow, per_src_min)
+    if sankey_df is None:
+        return None, msg
+
+    # ---------- indice invertito (CSR) ----------
+    progress(0.85, "Indice per il drill-down")
+    link_rows = trans.merge(
+        sankey_df[["source", "target"]].reset_index(names="link_id"), on=["source", "target"], how="inner"
+    )
+    link_id = link_rows["link_id"].to_numpy()
+    pids = link_rows["___PID___"].to_numpy(np.int64)
+    link_ptr, link_pids = csr_from_pairs(link_id, pids, len(sankey_df))
+
+    n_pat = max(len(patients), 1)
+    node_key = np.concatenate([
+        sankey_df["source_id"].to_numpy(np.int64)[link_id] * n_pat + pids,
+        sankey_df["target_id"].to_numpy(np.int64)[link_id] * n_pat + pids,
+    ])
+    node_key = np.unique(node_key)
+    node_ptr, node_pids = csr_from_pairs(node_key // n_pat, node_key % n_pat, len(all_labels))
+
+    return dict(
+        links=sankey_df, labels=all_labels, patients=np.asarray(patients),
+        link_ptr=link_ptr, link_pids=link_pids, node_ptr=node_ptr, node_pids=node_pids,
+        disp=out["disp"], disp_ptr=out["disp_ptr"], km=km,
+        line_trans=trans[trans["switch_date"].notna()] if km is not None else None,
+    ), None
+
+
+def drilldown_rows(res, pids):
+    """Dispensazioni dei pazienti (codici int32) via puntatori di riga: nessuna scansione."""
+    ptr = res["disp_ptr"]
+    rows = expand_ranges(ptr[pids], ptr[pids + 1])
+    return res["disp"].iloc[rows].drop(columns=["___PID___"])
+
+
+def transition_matrices(line_trans, n_boot, weights=None):
+    """
+    Matrici di transizione terapia → terapia per anno dello switch: probabilità
+    normalizzate per riga e IC bootstrap al 95%. Solo celle osservate (> 0).
+    `weights`: transizioni per riga, per righe già aggregate.
+    """
+    lt = line_trans
+    years, cats, coo = transition_tensor(
+        lt["source_cat"].to_numpy(), lt["target_cat"].to_numpy(), lt["switch_date"].dt.year.to_numpy(), weights
+    )
+    row_n = coo.groupby(["y", "s"])["n"].sum()
+    row_of = pd.Series(np.arange(len(row_n)), index=row_n.index)
+    r = row_of.loc[list(zip(coo["y"], coo["s"]))].to_numpy()
+    P = np.zeros((len(row_n), len(cats)))
+    P[r, coo["t"].to_numpy()] = coo["n"].to_numpy() / row_n.to_numpy()[r]
+    lo, hi = bootstrap_rows(row_n.to_numpy(), P, int(n_boot))
+
+    return pd.DataFrame({
+        "Anno": years[coo["y"]],
+        "source": cats[coo["s"]],
+        "target": cats[coo["t"]],
+        "N": coo["n"].to_numpy(),
+        "N_sorgente": row_n.to_numpy()[r],
+        "P": P[r, coo["t"]],
+        "IC95_inf": lo[r, coo["t"]],
+        "IC95_sup": hi[r, coo["t"]],
+    })
@@ -0,0 +1,110 @@
+"""
+Strumentazione leggera per fase: tempo, memoria del processo (RSS e picco) e
+righe in ingresso/uscita, con tabella per l'expander "Performance", foglio
+per gli export Excel e log JSON lines per l'analisi nel tempo.
+
+    prof = perf.Profiler("sankey_v10")
+    with prof.stage("lettura Excel") as s:
+        df = s.out(read_excel(...))
+    prof.to_frame(); prof.log()
+
+Le misure di memoria sono dell'intero processo (su un server Streamlit anche
+delle altre sessioni): RSS da /proc (Linux), picco da `resource` (Unix);
+dove non disponibili restano vuote.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+try:  # non disponibile su Windows
+    import resource
+except ImportError:
+    resource = None
+
+# file JSON lines su cui registrare le esecuzioni (vuoto = nessun log)
+LOG_ENV = "PERF_LOG"
+
+
+def rss_mb():
+    """Memoria residente attuale del processo (MB) o None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_mb():
+    """Picco di memoria residente del processo dall'avvio (MB) o None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # byte su macOS, KB su Linux
+
+
+def _rows(obj):
+    return None if obj is None else (obj if isinstance(obj, int) else len(obj))
+
+
+def _delta(a, b):
+    return None if a is None or b is None else b - a
+
+
+class _Stage:
+    def __init__(self, name, rows_in):
+        self.rec = {"fase": name, "righe_in": _rows(rows_in), "righe_out": None}
+
+    def out(self, obj):
+        """Registra le righe in uscita (len dell'oggetto) e lo restituisce."""
+        self.rec["righe_out"] = _rows(obj)
+        return obj
+
+
+class Profiler:
+    """Fasi di un'esecuzione di una pagina, nell'ordine in cui sono state misurate."""
+
+    def __init__(self, app):
+        self.app = app
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        s = _Stage(name, rows_in)
+        rss0, peak0 = rss_mb(), peak_mb()
+        t0 = time.perf_counter()
+        try:
+            yield s
+        finally:
+            rss1, peak1 = rss_mb(), peak_mb()
+            s.rec.update(secondi=time.perf_counter() - t0, rss_mb=rss1, delta_rss_mb=_delta(rss0, rss1),
+                         picco_mb=peak1, delta_picco_mb=_delta(peak0, peak1))
+            self.stages.append(s.rec)
+
+    def total(self):
+        return sum(r["secondi"] for r in self.stages)
+
+    def to_frame(self):
+        """Una riga per fase (per l'expander e il foglio Excel "Performance")."""
+        cols = {"fase": "Fase", "secondi": "Secondi", "righe_in": "Righe_in", "righe_out": "Righe_out",
+                "rss_mb": "RSS_MB", "delta_rss_mb": "ΔRSS_MB", "picco_mb": "Picco_MB", "delta_picco_mb": "ΔPicco_MB"}
+        out = pd.DataFrame(self.stages, columns=list(cols)).rename(columns=cols)
+        num = ["Secondi", "RSS_MB", "ΔRSS_MB", "Picco_MB", "ΔPicco_MB"]
+        out[num] = out[num].astype(float).round(3)
+        return out
+
+    def log(self, path=None, **extra):
+        """Aggiunge l'esecuzione al file JSON lines `path` (default: variabile d'ambiente PERF_LOG)."""
+        path = path or os.environ.get(LOG_ENV)
+        if not path or not self.stages:
+            return
+        rec = {"timestamp": datetime.now().isoformat(timespec="seconds"), "app": self.app,
+               "totale_s": round(self.total(), 4), **extra, "fasi": self.stages}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
@@ -0,0 +1,135 @@
+"""
+Figure leggere per coorti grandi: box plot da statistiche precalcolate
+(quartili, baffi, media, DS in un solo passaggio groupby) invece di inviare
+al browser ogni punto; i punti, se richiesti, sono un campione casuale
+stratificato per gruppo entro un budget di rendering.
+
+Convenzioni di plotly per l'aspetto identico a `boxpoints="all"`: quartili
+lineari, baffi all'ultimo punto entro 1.5 × IQR, DS di popolazione.
+"""
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# punti disegnati al massimo (somma sui gruppi)
+POINTS_BUDGET = 5_000
+
+
+def box_stats(df, by, value):
+    """
+    Statistiche del box per gruppo (ordine di groupby, NaN incluso come gruppo):
+    N, q1, mediana, q3, baffi (lowerfence/upperfence), media, DS.
+    """
+    d = df[[by, value]].dropna(subset=[value])
+    g = d.groupby(by, dropna=False, sort=True)[value]
+    n = g.size()
+    out = g.quantile([0.25, 0.5, 0.75]).unstack().reindex(n.index)  # unstack sposterebbe NaN in testa
+    out.columns = ["q1", "median", "q3"]
+    out["n"] = n
+    out["mean"] = g.mean()
+    out["sd"] = g.std(ddof=0)
+
+    # baffi: ultimo valore osservato entro 1.5 IQR dai quartili
+    iqr = out["q3"] - out["q1"]
+    lo = (out["q1"] - 1.5 * iqr).reindex(d[by]).to_numpy()
+    hi = (out["q3"] + 1.5 * iqr).reindex(d[by]).to_numpy()
+    v = d[value].to_numpy(dtype=float)
+    keys = d[by].to_numpy()
+    out["lowerfence"] = pd.Series(np.where(v >= lo, v, np.nan)).groupby(keys, dropna=False).min().reindex(out.index)
+    out["upperfence"] = pd.Series(np.where(v <= hi, v, np.nan)).groupby(keys, dropna=False).max().reindex(out.index)
+    return out
+
+
+def stratified_sample(df, by, budget=POINTS_BUDGET, min_per_group=20, seed=0):
+    """Campione casuale stratificato per `by` di circa `budget` righe (proporzionale, con un minimo per gruppo)."""
+    if len(df) <= budget:
+        return df
+    codes, _ = pd.factorize(df[by], use_na_sentinel=False)
+    n_g = np.bincount(codes)
+    k_g = np.minimum(n_g, np.maximum(min_per_group, np.floor(budget * n_g / len(df)))).astype(int)
+    rank = pd.Series(np.random.default_rng(seed).random(len(df))).groupby(codes).rank(method="first").to_numpy()
+    return df[rank <= k_g[codes]]
+
+
+def box_figure(df, by, value, order=None, per_group=True, points=True, budget=POINTS_BUDGET, boxmean=None):
+    """
+    Box plot di `value` per `by` con le statistiche calcolate lato server.
+    per_group=True: una traccia (un colore) per gruppo, come un ciclo di go.Box;
+    False: una sola traccia con le categorie in asse x, come px.box.
+    `order`: ordine delle categorie (default: quello di groupby).
+    points: campione stratificato dei punti, passato a plotly come una lista
+    di valori per box (con statistiche precalcolate plotly li disegna tutti).
+    boxmean: None, True (media) o "sd" (media ± DS).
+    """
+    stats = box_stats(df, by, value)
+    if order is not None:
+        stats = stats.reindex(pd.Index(order).intersection(stats.index, sort=False))
+    names = [str(k) for k in stats.index]
+    pts = [[] for _ in names]
+    if points:
+        sample = stratified_sample(df[[by, value]].dropna(subset=[value]), by, budget)
+        pos = pd.Series(range(len(stats)), index=stats.index)
+        for key, v in sample.groupby(by, dropna=False, sort=False)[value]:
+            if key in pos.index:
+                pts[pos[key]] = v.tolist()
+
+    def _box(idx, name=None):
+        s = stats.iloc[idx]
+        extra = {} if not boxmean else {"mean": s["mean"].tolist(), "sd": s["sd"].tolist(), "boxmean": boxmean}
+        return go.Box(
+            x=[names[i] for i in idx], y=[pts[i] for i in idx],
+            q1=s["q1"].tolist(), median=s["median"].tolist(), q3=s["q3"].tolist(),
+            lowerfence=s["lowerfence"].tolist(), upperfence=s["upperfence"].tolist(),
+            boxpoints="all" if points else False, jitter=0.4, pointpos=0, name=name, **extra,
+        )
+
+    fig = go.Figure()
+    if per_group:
+        for i in range(len(stats)):
+            fig.add_trace(_box([i], names[i]))
+    else:
+        fig.add_trace(_box(list(range(len(stats)))))
+    fig.update_layout(xaxis=dict(type="category", categoryorder="array", categoryarray=names))
+    return fig
+
+
+# ---------- dispersione complessiva ----------
+DENSITY, HISTOGRAM, ECDF, POINTS = "Densità (indice × valore)", "Istogramma", "ECDF", "Punti (WebGL)"
+DISPERSION_MODES = (DENSITY, HISTOGRAM, ECDF, POINTS)
+
+
+def dispersion_figure(values, mode=DENSITY, bins=50, index_bins=200, name="Pazienti"):
+    """
+    Distribuzione di un valore per paziente con il valore sempre in asse y
+    (le linee di riferimento della pagina restano `add_hline`). I conteggi
+    sono calcolati qui; solo POINTS invia i singoli valori (Scattergl).
+    - DENSITY: heatmap di np.histogram2d su indice paziente × valore
+    - HISTOGRAM: istogramma orizzontale del valore
+    - ECDF: quota cumulata di pazienti ≤ valore, su una griglia di `bins * 10` livelli
+    """
+    v = np.asarray(values, dtype=float)
+    idx = np.flatnonzero(~np.isnan(v))
+    v = v[idx]
+    fig = go.Figure()
+    if mode == POINTS:
+        fig.add_trace(go.Scattergl(x=idx, y=v, mode="markers", name=name))
+        fig.update_layout(xaxis_title="Indice paziente")
+    elif not len(v):
+        pass
+    elif mode == HISTOGRAM:
+        counts, edges = np.histogram(v, bins=bins)
+        fig.add_trace(go.Bar(x=counts, y=(edges[:-1] + edges[1:]) / 2, width=np.diff(edges), orientation="h",
+                             name=name))
+        fig.update_layout(xaxis_title="N pazienti", bargap=0)
+    elif mode == ECDF:
+        grid = np.linspace(v.min(), v.max(), bins * 10)
+        frac = np.searchsorted(np.sort(v), grid, side="right") / len(v)
+        fig.add_trace(go.Scatter(x=frac, y=grid, mode="lines", line_shape="vh", name=name))
+        fig.update_layout(xaxis_title="Quota cumulata di pazienti", xaxis_range=[0, 1])
+    else:
+        counts, xe, ye = np.histogram2d(idx, v, bins=(min(index_bins, len(v)), bins))
+        z = np.where(counts.T > 0, counts.T, np.nan)  # celle vuote trasparenti
+        fig.add_trace(go.Heatmap(x=(xe[:-1] + xe[1:]) / 2, y=(ye[:-1] + ye[1:]) / 2, z=z, colorscale="Blues",
+                                 colorbar=dict(title="N"), name=name))
+        fig.update_layout(xaxis_title="Indice paziente")
+    return fig
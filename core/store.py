@@ -0,0 +1,211 @@
+"""
+Archivio dei risultati su disco: un'analisi già eseguita sullo stesso file
+con la stessa mappatura delle colonne, gli stessi parametri e la stessa
+versione dei motori si rilegge invece di ricalcolarla, anche da un'altra
+sessione o dopo un riavvio del server.
+
+Ogni risultato è una cartella `<RESULT_STORE_DIR>/<chiave>/` con i
+DataFrame di primo livello in Parquet, gli altri valori in `valori.pkl` e
+`meta.json` (tipo, descrizione, date di creazione e ultimo uso, accessi).
+La chiave è l'hash di (tipo, hash dei file, parametri, versione dei motori);
+la versione è l'hash del sorgente dei motori usati, quindi una modifica al
+codice invalida da sola i risultati vecchi. Oltre RESULT_STORE_MB (default
+2048) si eliminano i risultati usati meno di recente; la pagina
+`archivio_risultati.py` mostra dimensioni ed età e permette di eliminarli.
+"""
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DIR_ENV, MB_ENV = "RESULT_STORE_DIR", "RESULT_STORE_MB"
+META, VALUES = "meta.json", "valori.pkl"
+# risultati tenuti anche in memoria (pagine che rileggono a ogni rerun)
+MEMORY_ENTRIES = 8
+# ultimo uso e accessi aggiornati su disco al massimo ogni TOUCH_S secondi per risultato e processo
+TOUCH_S = 60
+
+
+def root():
+    d = Path(os.environ.get(DIR_ENV) or Path.home() / ".cache" / "streamlit_agent" / "risultati")
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def engine_version(*parts):
+    """Hash del sorgente di moduli/funzioni (o file, se percorso) e delle versioni di pandas e numpy."""
+    h = hashlib.blake2b(digest_size=6)
+    h.update(f"pandas {pd.__version__} numpy {np.__version__}".encode())
+    for p in parts:
+        src = Path(p).read_bytes() if isinstance(p, (str, Path)) else inspect.getsource(p).encode()
+        h.update(src)
+    return h.hexdigest()
+
+
+def key(kind, inputs, params, engine):
+    """Chiave del risultato: tipo di analisi, hash dei file in ingresso, parametri (mappatura colonne inclusa), motore."""
+    params = sorted((str(k), repr(v)) for k, v in dict(params).items())
+    raw = repr((kind, tuple(inputs), params, engine)).encode()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+# ---------- lettura / scrittura ----------
+_memory = OrderedDict()
+_touched = {}
+_lock = threading.Lock()
+
+
+def _read_meta(d):
+    try:
+        return json.loads((d / META).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(d, meta):
+    tmp = d / f"{META}.{uuid.uuid4().hex}.tmp"
+    tmp.write_text(json.dumps(meta, ensure_ascii=False, default=str), encoding="utf-8")
+    os.replace(tmp, d / META)
+
+
+def _touch(d, meta):
+    now = time.time()
+    if now - _touched.get(d.name, 0) >= TOUCH_S:
+        _touched[d.name] = now
+        try:
+            _write_meta(d, dict(meta, ultimo_uso=now, accessi=meta.get("accessi", 0) + 1))
+        except OSError:  # cartella eliminata nel frattempo dalla pagina di gestione
+            pass
+
+
+def load(k):
+    """Risultato salvato con chiave `k` ({nome: valore}) o None. Gli oggetti restituiti vanno trattati in sola lettura."""
+    d = root() / k
+    meta = _read_meta(d)
+    if meta is None:
+        with _lock:
+            _memory.pop(k, None)
+        return None
+    with _lock:
+        if k in _memory:
+            _memory.move_to_end(k)
+            _touch(d, meta)
+            return _memory[k]
+    try:
+        out = pickle.loads((d / VALUES).read_bytes()) if (d / VALUES).exists() else {}
+        for name in meta["frames"]:
+            out[name] = pd.read_parquet(d / f"{name}.parquet")
+    except (OSError, KeyError, ValueError, pickle.UnpicklingError):
+        return None  # scrittura incompleta o file rimossi: si ricalcola
+    out = {name: out[name] for name in meta["ordine"]}
+    _remember(k, out)
+    _touch(d, meta)
+    return out
+
+
+def _remember(k, out):
+    with _lock:
+        _memory[k] = out
+        _memory.move_to_end(k)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def save(k, result, kind, label="", params=None, engine=""):
+    """
+    Salva `result` ({nome: valore}) con chiave `k`: DataFrame in Parquet
+    (in pickle se Parquet non li rappresenta), il resto in `valori.pkl`.
+    Scrittura in una cartella temporanea poi rinominata: chi legge vede il
+    risultato intero o niente.
+    """
+    base = root()
+    tmp = base / f".tmp-{uuid.uuid4().hex}"
+    tmp.mkdir()
+    try:
+        frames, values = [], {}
+        for name, v in result.items():
+            if isinstance(v, pd.DataFrame):
+                try:
+                    v.to_parquet(tmp / f"{name}.parquet")
+                    frames.append(name)
+                    continue
+                except (ValueError, TypeError, ImportError, OSError):  # es. colonne object miste
+                    (tmp / f"{name}.parquet").unlink(missing_ok=True)
+            values[name] = v
+        if values:
+            (tmp / VALUES).write_bytes(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL))
+        now = time.time()
+        _write_meta(tmp, dict(
+            chiave=k, tipo=kind, descrizione=label, motore=engine, creato=now, ultimo_uso=now, accessi=0,
+            parametri={str(p): repr(v) for p, v in (params or {}).items()},
+            ordine=list(result), frames=frames,
+        ))
+        try:
+            os.replace(tmp, base / k)
+        except OSError:  # già salvato da un'altra sessione
+            shutil.rmtree(tmp, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    _remember(k, result)
+    prune()
+
+
+# ---------- gestione ----------
+def _size(d):
+    return sum(f.stat().st_size for f in d.iterdir() if f.is_file())
+
+
+def entries():
+    """Una riga per risultato salvato, dal più recente per ultimo uso."""
+    rows = []
+    for d in root().iterdir():
+        meta = _read_meta(d) if d.is_dir() and not d.name.startswith(".") else None
+        if meta is None:
+            continue
+        rows.append(dict(
+            chiave=d.name, tipo=meta["tipo"], descrizione=meta.get("descrizione", ""),
+            creato=pd.Timestamp(meta["creato"], unit="s"), ultimo_uso=pd.Timestamp(meta["ultimo_uso"], unit="s"),
+            eta_giorni=round((time.time() - meta["creato"]) / 86400, 1), MB=round(_size(d) / 2**20, 3),
+            accessi=meta.get("accessi", 0), motore=meta.get("motore", ""),
+        ))
+    cols = ["chiave", "tipo", "descrizione", "creato", "ultimo_uso", "eta_giorni", "MB", "accessi", "motore"]
+    return pd.DataFrame(rows, columns=cols).sort_values("ultimo_uso", ascending=False, ignore_index=True)
+
+
+def delete(keys):
+    """Elimina i risultati indicati; ritorna quanti ne ha eliminati."""
+    n = 0
+    for k in keys:
+        d = root() / k
+        with _lock:
+            _memory.pop(k, None)
+        if d.is_dir():
+            shutil.rmtree(d, ignore_errors=True)
+            n += 1
+    return n
+
+
+def prune(max_mb=None, max_age_days=None):
+    """
+    Elimina i risultati più vecchi di `max_age_days` (per creazione) e poi i
+    meno usati di recente finché il totale sta in `max_mb` (default RESULT_STORE_MB).
+    """
+    max_mb = float(os.environ.get(MB_ENV, 2048)) if max_mb is None else float(max_mb)
+    e = entries()
+    drop = set()
+    if max_age_days is not None:
+        drop |= set(e.loc[e["eta_giorni"] > max_age_days, "chiave"])
+    keep = e[~e["chiave"].isin(drop)]
+    drop |= set(keep.loc[keep["MB"].cumsum() > max_mb, "chiave"])
+    return delete(drop)
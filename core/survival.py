@@ -0,0 +1,368 @@
+"""Persistenza: preprocessing stile Prism, Kaplan–Meier e log-rank (Mantel–Cox)."""
+import math
+
+import numpy as np
+import pandas as pd
+
+from .cohort import group_mode
+
+_DAY_NS = 86_400 * 10**9
+
+
+# -------------------- Funzioni matematiche --------------------
+def _gammainc_P(a: float, x: float, eps: float = 1e-12, max_iter: int = 10000) -> float:
+    """Regularized lower incomplete gamma P(a, x)."""
+    if x <= 0:
+        return 0.0
+    if x < a + 1.0:
+        term = 1.0 / a
+        summ = term
+        n = 1
+        while n < max_iter:
+            term *= x / (a + n)
+            summ += term
+            if abs(term) < abs(summ) * eps:
+                break
+            n += 1
+        return summ * math.exp(-x + a * math.log(x) - math.lgamma(a))
+    tiny = 1e-300
+    b = x + 1.0 - a
+    c = 1.0 / tiny
+    d = 1.0 / b if b != 0 else 1.0 / tiny
+    h = d
+    for i in range(1, max_iter + 1):
+        an = -i * (i - a)
+        b += 2.0
+        d = an * d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < eps:
+            break
+    Q = math.exp(-x + a * math.log(x) - math.lgamma(a)) * h
+    return 1.0 - Q
+
+
+def chi2_cdf(x: float, df: int) -> float:
+    if x < 0 or df <= 0:
+        return 0.0
+    return _gammainc_P(0.5 * df, 0.5 * x)
+
+
+# -------------------- Preprocessing stile Prism --------------------
+def preprocess_prism_reference(df, id_col, date_col, strat_col, period, cutoff_date):
+    """Versione di riferimento (ciclo per paziente) di `preprocess_prism`."""
+    df = df.copy()
+    df[date_col] = pd.to_datetime(df[date_col], errors="coerce", dayfirst=True)
+    invalid_dates = df[date_col].isna().sum()
+    df = df.dropna(subset=[date_col])
+
+    rows = []
+    for pid, g in df.groupby(id_col):
+        start = g[date_col].min()
+        last  = g[date_col].max()
+        observed_last = min(last, cutoff_date)
+        observed_days = (observed_last - start).days
+
+        include = False
+        event = None
+        reason = ""
+
+        if last <= cutoff_date and observed_days < period:
+            include = True
+            event = 1
+            reason = "Evento entro cutoff"
+        elif observed_days >= period:
+            include = True
+            event = 0
+            reason = "Censura (persistente >= periodo)"
+        else:
+            include = False
+            event = 0
+            reason = "Escluso (follow-up insufficiente e nessun evento)"
+
+        time = int(min(observed_days, period))
+        strat = g[strat_col].mode().iloc[0] if not g[strat_col].mode().empty else "NA"
+
+        rows.append({
+            "paziente": pid,
+            "gruppo": strat,
+            "start": start.date(),
+            "last": last.date(),
+            "cutoff_usato": cutoff_date.date(),
+            "giorni_osservati": observed_days,
+            "time": time,
+            "event": int(event),
+            "incluso": include,
+            "motivo": reason
+        })
+
+    full = pd.DataFrame(rows)
+    included = full[full["incluso"]].copy()
+    return full, included, int(invalid_dates)
+
+
+def preprocess_prism(df, id_col, date_col, strat_col, period, cutoff_date):
+    """
+    Tempo/evento per paziente stile Prism, vettoriale (min/max per gruppo e
+    regole con np.select): evento se l'ultima dispensazione è entro il cutoff
+    e prima di `period` giorni, censura se osservato per ≥ `period`, altrimenti
+    escluso. Gruppo = valore più frequente di `strat_col`.
+    Ritorna (tutti, inclusi, n date non valide).
+    """
+    dates = pd.to_datetime(df[date_col], errors="coerce", dayfirst=True)
+    invalid_dates = int(dates.isna().sum())
+    d = df.assign(**{date_col: dates}).dropna(subset=[date_col])
+
+    g = d.groupby(id_col)[date_col]
+    start, last = g.min(), g.max()
+    gruppo = group_mode(d, [id_col], strat_col, default="NA").reindex(start.index).to_numpy()
+    full, included = prism_table(start, last, gruppo, period, cutoff_date)
+    return full, included, invalid_dates
+
+
+def prism_table(start, last, gruppo, period, cutoff_date):
+    """
+    Regole di `preprocess_prism` da prima/ultima dispensazione (Series
+    indicizzate dal paziente) e gruppo per paziente: le usa anche il ricalcolo
+    incrementale (core/incremental.py). Ritorna (tutti, inclusi).
+    """
+    cutoff_date = pd.Timestamp(cutoff_date)
+    observed_days = ((last.clip(upper=cutoff_date) - start) // pd.Timedelta(days=1)).astype(np.int64)
+    is_event = (last <= cutoff_date) & (observed_days < period)
+    is_cens = ~is_event & (observed_days >= period)
+
+    full = pd.DataFrame({
+        "paziente": start.index,
+        "gruppo": gruppo,
+        "start": start.dt.date.to_numpy(),
+        "last": last.dt.date.to_numpy(),
+        "cutoff_usato": cutoff_date.date(),
+        "giorni_osservati": observed_days.to_numpy(),
+        "time": np.minimum(observed_days, period).astype(int).to_numpy(),
+        "event": is_event.astype(int).to_numpy(),
+        "incluso": (is_event | is_cens).to_numpy(),
+        "motivo": np.select(
+            [is_event, is_cens],
+            ["Evento entro cutoff", "Censura (persistente >= periodo)"],
+            default="Escluso (follow-up insufficiente e nessun evento)",
+        ),
+    })
+    included = full[full["incluso"]].copy()
+    return full, included
+
+
+# -------------------- Kaplan–Meier --------------------
+def km_curve_from_times_reference(times, events, period):
+    """Versione di riferimento (ciclo sui tempi) di `km_curve_from_times`."""
+    df = pd.DataFrame({"time": times, "event": events}).sort_values("time")
+    df = df[df["time"] > 0]  # FIX: escludi time=0 anche dalle curve
+    S = 1.0
+    t_coords = [0]
+    s_coords = [1.0]
+    at_risk = len(df)
+    for t in df["time"].unique():
+        if t > period:
+            break
+        d = int(df[(df["time"] == t) & (df["event"] == 1)].shape[0])
+        c = int(df[(df["time"] == t) & (df["event"] == 0)].shape[0])
+        if d > 0 and at_risk > 0:
+            S *= (at_risk - d) / at_risk
+        at_risk -= (d + c)
+        t_coords.append(int(t))
+        s_coords.append(S)
+    if t_coords[-1] < period:
+        t_coords.append(int(period))
+        s_coords.append(S)
+    return t_coords, s_coords
+
+
+def km_curve_from_times(times, events, period, weights=None):
+    """
+    Curva KM a gradini (tempi > 0, troncata a `period`): conteggi per tempo
+    distinto con np.unique/bincount e prodotto cumulativo dei fattori, negli
+    stessi passi del riferimento (valori identici). `weights`: pazienti per
+    riga, per righe già aggregate (core/outofcore.py). Ritorna (tempi, S).
+    """
+    times = np.asarray(times, dtype=float)
+    events = np.asarray(events)
+    w = np.ones(times.size, dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    keep = times > 0
+    times, events, w = times[keep], events[keep], w[keep]
+    uniq, inv = np.unique(times, return_inverse=True)
+    d = np.bincount(inv, weights=(events == 1) * w, minlength=len(uniq)).astype(np.int64)
+    c = np.bincount(inv, weights=(events == 0) * w, minlength=len(uniq)).astype(np.int64)
+    at_risk = w.sum() - np.concatenate([[0], np.cumsum(d + c)[:-1]])
+    upto = np.searchsorted(uniq, period, side="right")
+    uniq, d, at_risk = uniq[:upto], d[:upto], at_risk[:upto]
+    factor = np.ones(len(uniq))
+    hit = (d > 0) & (at_risk > 0)
+    factor[hit] = (at_risk[hit] - d[hit]) / at_risk[hit]
+    S = np.cumprod(factor)
+    t_coords = [0] + uniq.astype(int).tolist()
+    s_coords = [1.0] + S.tolist()
+    if t_coords[-1] < period:
+        t_coords.append(int(period))
+        s_coords.append(s_coords[-1])
+    return t_coords, s_coords
+
+
+def km_by_group(groups, times, events, weights=None):
+    """
+    Kaplan–Meier per gruppo, vettoriale (nessun loop sui tempi):
+    una riga per (gruppo, tempo) con a rischio, eventi, censure e S(t).
+    `weights`: pazienti per riga, per righe già aggregate.
+    """
+    w = np.ones(len(groups), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    d = pd.DataFrame({"gruppo": np.asarray(groups), "time": np.asarray(times, dtype=float), "n": w})
+    d["eventi"] = np.asarray(events, dtype=int) * w
+    t = d.groupby(["gruppo", "time"], sort=True).agg(n=("n", "sum"), eventi=("eventi", "sum")).reset_index()
+    t["censure"] = t["n"] - t["eventi"]
+    t["a_rischio"] = t.groupby("gruppo")["n"].transform("sum") - t.groupby("gruppo")["n"].cumsum() + t["n"]
+    t["S"] = (1.0 - t["eventi"] / t["a_rischio"]).groupby(t["gruppo"]).cumprod()
+    return t.drop(columns="n")
+
+
+# -------------------- Log-rank Mantel–Cox --------------------
+def logrank_prism_reference(times, events, groups, debug=False):
+    """Versione di riferimento (scansioni per ogni tempo d'evento) di `logrank_prism`."""
+    df = pd.DataFrame({"time": times, "event": events, "group": groups})
+    # FIX: escludi eventi con time=0
+    event_times = np.sort(df.loc[(df["event"] == 1) & (df["time"] > 0), "time"].unique())
+    groups_unique = sorted(df["group"].unique())
+    k = len(groups_unique)
+    if k < 2 or event_times.size == 0:
+        return math.nan, math.nan, k, pd.DataFrame()
+
+    debug_rows = []
+
+    if k == 2:
+        # Formula Mantel–Haenszel classica (come Prism)
+        O1, E1, V1 = 0.0, 0.0, 0.0
+        g1, g2 = groups_unique
+        for t in event_times:
+            R = int((df["time"] >= t).sum())
+            d = int(((df["time"] == t) & (df["event"] == 1)).sum())
+            if R <= 1 or d == 0:
+                continue
+            R1 = int(((df["group"] == g1) & (df["time"] >= t)).sum())
+            R2 = R - R1
+            d1 = int(((df["group"] == g1) & (df["time"] == t) & (df["event"] == 1)).sum())
+            E1_t = d * (R1 / R)
+            V1_t = (R1 * R2 * d * (R - d)) / (R**2 * (R - 1))
+            O1 += d1
+            E1 += E1_t
+            V1 += V1_t
+            if debug:
+                debug_rows.append({"time": t, "R": R, "d": d, "R1": R1, "R2": R2,
+                                   "d1": d1, "E1_t": E1_t, "V1_t": V1_t})
+        chi2_stat = (O1 - E1) ** 2 / V1 if V1 > 0 else math.nan
+        pval = 1.0 - chi2_cdf(chi2_stat, 1)
+        debug_df = pd.DataFrame(debug_rows)
+        return chi2_stat, pval, k, debug_df
+    else:
+        # Formula generale (matrice di varianza)
+        O = np.zeros(k)
+        E = np.zeros(k)
+        V = np.zeros((k, k))
+        for t in event_times:
+            R = int((df["time"] >= t).sum())
+            d = int(((df["time"] == t) & (df["event"] == 1)).sum())
+            if R <= 1 or d == 0:
+                continue
+            Rg = np.array([int(((df["group"] == g) & (df["time"] >= t)).sum()) for g in groups_unique])
+            dg = np.array([int(((df["group"] == g) & (df["time"] == t) & (df["event"] == 1)).sum()) for g in groups_unique])
+            Eg = d * (Rg / R)
+            common = d * (R - d) / (R**2 * (R - 1))
+            V += np.diag(Rg * (R - Rg) * common)
+            V -= np.outer(Rg, Rg) * common
+            O += dg
+            E += Eg
+        D = O - E
+        try:
+            Vinv = np.linalg.pinv(V)
+            chi2_stat = float(D.T @ Vinv @ D)
+        except Exception:
+            return math.nan, math.nan, k, pd.DataFrame()
+        dfree = k - 1
+        pval = 1.0 - chi2_cdf(chi2_stat, dfree)
+        return chi2_stat, pval, k, pd.DataFrame()
+
+
+def _at_risk(time, w, at):
+    """Pazienti (somma dei pesi) con tempo ≥ ciascun valore di `at`."""
+    order = np.argsort(time, kind="stable")
+    cw = np.concatenate([[0], np.cumsum(w[order])])
+    return cw[-1] - cw[np.searchsorted(time[order], at, side="left")]
+
+
+def logrank_prism(times, events, groups, debug=False, weights=None):
+    """
+    Log-rank Mantel–Cox (2 gruppi: formula classica come Prism; k gruppi:
+    matrice di varianza), vettoriale: a rischio per tempo d'evento con
+    searchsorted sui tempi ordinati (anche per gruppo), eventi con bincount.
+    `weights`: pazienti per riga, per righe già aggregate.
+    Ritorna (chi², p-value, k, tabella debug per k = 2).
+    """
+    time = np.asarray(times, dtype=float)
+    event = np.asarray(events)
+    groups = np.asarray(groups)
+    w = np.ones(time.size, dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    groups_unique = sorted(pd.unique(groups))
+    k = len(groups_unique)
+    is_ev = (event == 1) & (time > 0)
+    event_times = np.unique(time[is_ev])
+    if k < 2 or event_times.size == 0:
+        return math.nan, math.nan, k, pd.DataFrame()
+
+    g_code = pd.Index(groups_unique).get_indexer(groups)
+    T = event_times.size
+    R = _at_risk(time, w, event_times)
+    ev_idx = np.searchsorted(event_times, time[is_ev])
+    d = np.bincount(ev_idx, weights=w[is_ev], minlength=T).astype(np.int64)
+    Rg = np.empty((T, k), dtype=np.int64)
+    for j in range(k):
+        in_j = g_code == j
+        Rg[:, j] = _at_risk(time[in_j], w[in_j], event_times)
+    dg = np.bincount(ev_idx * k + g_code[is_ev], weights=w[is_ev], minlength=T * k).astype(np.int64).reshape(T, k)
+
+    ok = (R > 1) & (d > 0)
+    event_times, R, d, Rg, dg = event_times[ok], R[ok], d[ok].astype(float), Rg[ok], dg[ok]
+    Rf = R.astype(float)
+
+    if k == 2:
+        R1 = Rg[:, 0]
+        R2 = R - R1
+        E1_t = d * (R1 / Rf)
+        V1_t = (R1.astype(float) * R2 * d * (Rf - d)) / (Rf**2 * (Rf - 1))
+        O1 = float(dg[:, 0].sum())
+        E1 = float(np.cumsum(E1_t)[-1]) if E1_t.size else 0.0
+        V1 = float(np.cumsum(V1_t)[-1]) if V1_t.size else 0.0
+        chi2_stat = (O1 - E1) ** 2 / V1 if V1 > 0 else math.nan
+        pval = 1.0 - chi2_cdf(chi2_stat, 1)
+        debug_df = pd.DataFrame({
+            "time": event_times, "R": R, "d": d.astype(int), "R1": R1, "R2": R2,
+            "d1": dg[:, 0], "E1_t": E1_t, "V1_t": V1_t,
+        }) if debug else pd.DataFrame()
+        return chi2_stat, pval, k, debug_df
+
+    # Formula generale (matrice di varianza), somme sui tempi in forma matriciale
+    Rgf = Rg.astype(float)
+    common = d * (Rf - d) / (Rf**2 * (Rf - 1))
+    O = dg.sum(axis=0).astype(float)
+    E = (d[:, None] * (Rgf / Rf[:, None])).sum(axis=0)
+    V = np.diag((Rgf * (Rf[:, None] - Rgf) * common[:, None]).sum(axis=0))
+    V -= (Rgf * common[:, None]).T @ Rgf
+    D = O - E
+    try:
+        Vinv = np.linalg.pinv(V)
+        chi2_stat = float(D.T @ Vinv @ D)
+    except Exception:
+        return math.nan, math.nan, k, pd.DataFrame()
+    pval = 1.0 - chi2_cdf(chi2_stat, k - 1)
+    return chi2_stat, pval, k, pd.DataFrame()
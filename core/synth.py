@@ -0,0 +1,131 @@
+"""
+Dati sintetici di dispensazione (nessun dato reale): pazienti, switch di ATC,
+buchi di rifornimento, terapie di combinazione, duplicati nello stesso giorno,
+tabella DDD e date "sporche". Tutto vettoriale e riproducibile dal seed.
+"""
+import numpy as np
+import pandas as pd
+
+# (ATC, principio attivo, DDD standard giornaliera)
+ATC_TABLE = [
+    ("L04AB04", "ADALIMUMAB", 2.9),
+    ("L04AB01", "ETANERCEPT", 7.0),
+    ("L04AC05", "USTEKINUMAB", 0.54),
+    ("L04AC10", "SECUKINUMAB", 10.0),
+    ("L04AC18", "RISANKIZUMAB", 1.07),
+    ("L04AC13", "IXEKIZUMAB", 2.86),
+    ("L04AC16", "GUSELKUMAB", 1.79),
+    ("L04AA33", "VEDOLIZUMAB", 5.4),
+    ("L04AB02", "INFLIXIMAB", 3.75),
+    ("L04AB06", "GOLIMUMAB", 1.66),
+    ("L04AA29", "TOFACITINIB", 10.0),
+    ("L04AA37", "BARICITINIB", 4.0),
+]
+
+_DAY_NS = 86_400 * 10**9
+
+
+def generate(n_rows=100_000, seed=0, start="2019-01-01", end="2024-12-31", mean_disp=12,
+             p_switch=0.04, p_gap=0.08, p_combo=0.05, p_dup=0.01, messy_dates=True,
+             p_iso=0.05, p_time=0.02, p_invalid=0.005):
+    """
+    Circa `n_rows` dispensazioni. Per paziente: data d'inizio uniforme, numero di
+    dispensazioni ~ 1 + Poisson(mean_disp - 1), rifornimenti ogni 28/30/56/84
+    giorni con ritardo casuale e, con probabilità `p_gap`, un'interruzione lunga
+    (60–400 giorni). Ogni dispensazione cambia ATC con probabilità `p_switch`;
+    una quota `p_combo` dei pazienti riceve un secondo farmaco entro 0–5 giorni
+    (combinazione), `p_dup` delle righe è spezzata in due nello stesso giorno.
+    Con `messy_dates` DATA è testo gg/mm/aaaa con una quota di formati ISO,
+    con ora o non validi (come negli estratti reali); altrimenti datetime.
+    Ritorna (dispensazioni, tabella DDD).
+    """
+    rng = np.random.default_rng(seed)
+    n_atc = len(ATC_TABLE)
+    n_pat = max(1, int(n_rows / mean_disp))
+    n_disp = 1 + rng.poisson(mean_disp - 1, n_pat)
+    pid = np.repeat(np.arange(n_pat), n_disp)
+    n = pid.size
+    first = np.ones(n, dtype=bool)
+    first[1:] = pid[1:] != pid[:-1]
+
+    # timeline: intervalli di rifornimento + ritardi + interruzioni lunghe
+    pack = rng.choice([28, 30, 56, 84], size=n, p=[0.45, 0.25, 0.2, 0.1])
+    step = pack + rng.integers(-3, 15, n)
+    step = np.where(rng.random(n) < p_gap, rng.integers(60, 400, n), step)
+    t0 = pd.Timestamp(start).value
+    span = (pd.Timestamp(end).value - t0) // _DAY_NS
+    start_day = rng.integers(0, max(1, span - 180), n_pat)
+    day = np.where(first, 0, step)
+    day = np.cumsum(day)
+    day = day - np.repeat(day[first], n_disp)
+    day = day + start_day[pid]
+
+    # ATC: primo farmaco per paziente, switch cumulativi
+    atc_first = rng.integers(0, n_atc, n_pat)
+    sw = np.where(first, 0, (rng.random(n) < p_switch) * rng.integers(1, n_atc, n))
+    csw = np.cumsum(sw)
+    csw = csw - np.repeat(csw[first], n_disp)
+    atc = (atc_first[pid] + csw) % n_atc
+
+    std = np.array([a[2] for a in ATC_TABLE])
+    qty = pack * std[atc]
+    sex = rng.choice(np.array(["M", "F"]), n_pat)
+    age = rng.integers(18, 90, n_pat)
+
+    # combinazioni: secondo farmaco a 0–5 giorni per una quota dei pazienti
+    combo_pat = rng.random(n_pat) < p_combo
+    c_rows = np.flatnonzero(combo_pat[pid] & (rng.random(n) < 0.7))
+    c_atc = (atc[c_rows] + rng.integers(1, n_atc, c_rows.size)) % n_atc
+    # duplicati nello stesso giorno (stessa terapia, quantità spezzata)
+    d_rows = np.flatnonzero(rng.random(n) < p_dup)
+
+    rows = np.concatenate([np.arange(n), c_rows, d_rows])
+    atc_all = np.concatenate([atc, c_atc, atc[d_rows]])
+    day_all = np.concatenate([day, day[c_rows] + rng.integers(0, 6, c_rows.size), day[d_rows]])
+    qty_all = np.concatenate([qty, pack[c_rows] * std[c_atc], qty[d_rows] / 2])
+    qty_all[d_rows] /= 2
+    order = np.lexsort((day_all, pid[rows]))
+    rows, atc_all, day_all, qty_all = rows[order], atc_all[order], day_all[order], qty_all[order]
+    p = pid[rows]
+
+    dates = pd.to_datetime(t0 + day_all.astype(np.int64) * _DAY_NS)
+    codes = np.array([a[0] for a in ATC_TABLE], dtype=object)
+    names = np.array([a[1] for a in ATC_TABLE], dtype=object)
+    disp = pd.DataFrame({
+        "CF": pd.Index(np.char.add("P", np.char.zfill(np.arange(n_pat).astype(str), 8)))[p],
+        "ATC": codes[atc_all],
+        "PRINCIPIO": names[atc_all],
+        "DATA": dates,
+        "DDD": np.round(qty_all, 2),
+        "SESSO": sex[p],
+        "ETA": age[p],
+    })
+    if messy_dates:
+        disp["DATA"] = _messy_dates(dates, rng, p_iso, p_time, p_invalid)
+
+    return disp, ddd_table()
+
+
+def ddd_table():
+    """Tabella DDD di ATC_TABLE, imperfetta: l'ultimo standard è 0 e il penultimo ATC manca."""
+    ddd = pd.DataFrame(ATC_TABLE, columns=["ATC", "PRINCIPIO", "DDD_standard"])
+    ddd.loc[len(ddd) - 1, "DDD_standard"] = 0.0
+    return ddd.drop(index=len(ddd) - 2).reset_index(drop=True)
+
+
+def _messy_dates(dates, rng, p_iso, p_time, p_invalid):
+    """Date in testo gg/mm/aaaa, con quote di formato ISO, con ora e non valide."""
+    d = pd.DatetimeIndex(dates)
+    dd = np.char.zfill(d.day.to_numpy().astype(str), 2)
+    mm = np.char.zfill(d.month.to_numpy().astype(str), 2)
+    yy = d.year.to_numpy().astype(str)
+    it = np.char.add(np.char.add(np.char.add(np.char.add(dd, "/"), mm), "/"), yy)
+    iso = np.char.add(np.char.add(np.char.add(np.char.add(yy, "-"), mm), "-"), dd)
+    u = rng.random(len(d))
+    out = it.astype(object)
+    out[u < p_iso] = iso[u < p_iso]
+    m_time = (u >= p_iso) & (u < p_iso + p_time)
+    out[m_time] = np.char.add(it[m_time], " 00:00")
+    m_bad = (u >= p_iso + p_time) & (u < p_iso + p_time + p_invalid)
+    out[m_bad] = rng.choice(np.array(["", "n.d.", "31/02/2023", "00/00/0000"], dtype=object), m_bad.sum())
+    return out
@@ -0,0 +1,65 @@
+"""
+Tabelle di risultato grandi lato server: ricerca, filtri per colonna,
+ordinamento e pagina corrente, così al browser arriva solo la pagina
+visibile (componente Streamlit in ui.py).
+"""
+import numpy as np
+import pandas as pd
+
+VALUES, RANGE, TEXT = "valori", "intervallo", "testo"
+
+
+def _contains(s, text):
+    """Confronto sui soli valori distinti (factorize), poi riportato alle righe."""
+    codes, uniques = pd.factorize(s)
+    hit = pd.Series(uniques).astype(str).str.contains(text, case=False, regex=False, na=False).to_numpy()
+    return np.append(hit, False)[codes]  # codice -1 (mancante) → False
+
+
+def filter_frame(df, search="", filters=None):
+    """
+    Righe che contengono `search` in almeno una colonna (senza distinzione di
+    maiuscole) e rispettano tutti i filtri per colonna:
+    {colonna: ("valori", lista) | ("intervallo", (min, max)) | ("testo", sottostringa)}.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if search:
+        hit = np.zeros(len(df), dtype=bool)
+        for c in df.columns:
+            hit |= _contains(df[c], search)
+        mask &= hit
+    for col, (kind, arg) in (filters or {}).items():
+        s = df[col]
+        if kind == VALUES:
+            mask &= s.isin(arg).to_numpy()
+        elif kind == RANGE:
+            mask &= s.between(*arg).to_numpy()
+        elif arg:
+            mask &= _contains(s, arg)
+    return df if mask.all() else df[mask]
+
+
+def sort_frame(df, by=None, ascending=True):
+    """Ordinamento stabile per una colonna (valori mancanti in fondo)."""
+    if by is None or by not in df.columns:
+        return df
+    return df.sort_values(by, ascending=ascending, kind="stable", na_position="last")
+
+
+def n_pages(n_rows, page_size):
+    return max(int(np.ceil(n_rows / page_size)), 1)
+
+
+def page_slice(df, page, page_size):
+    """Righe della pagina `page` (da 1)."""
+    start = (int(page) - 1) * int(page_size)
+    return df.iloc[start:start + int(page_size)]
+
+
+def filter_kind(s, max_values=500):
+    """Filtro adatto alla colonna: intervallo per numeri e date, valori per poche modalità, altrimenti testo."""
+    if pd.api.types.is_bool_dtype(s):
+        return VALUES
+    if pd.api.types.is_numeric_dtype(s) or pd.api.types.is_datetime64_any_dtype(s):
+        return RANGE
+    return VALUES if s.nunique(dropna=True) <= max_values else TEXT
@@ -0,0 +1,400 @@
+"""
+Verifica di equivalenza: motori ottimizzati contro le versioni di riferimento.
+
+    python equivalenza.py --casi 200
+    python equivalenza.py --engines pdc_atc,adh_periodo --casi 1000 --seed 7
+    python equivalenza.py --engines pdc_incrementale,km_incrementale,sankey_incrementale
+
+Ogni caso è un dataset casuale (core/synth.py con parametri estratti: numero
+di pazienti, switch, duplicati nello stesso giorno, date sporche, periodo e
+cutoff) più un dataset fisso di casi limite (dispensazione singola → time=0,
+duplicati nello stesso giorno, DDD_standard = 0, ATC senza lookup, DDD nulle o
+enormi, date non valide, eventi esattamente a fine finestra). Per ogni motore
+riferimento e ottimizzato ricevono lo stesso input e tutte le uscite sono
+confrontate entro tolleranza. Per un caso fallito si cerca il singolo paziente
+che riproduce la differenza e lo si salva in `--out` come CSV.
+
+I motori `*_incrementale` confrontano i job di core/batch.py ricalcolati da
+zero con il ricalcolo incrementale (stato salvato sull'estratto senza l'ultimo
+mese, poi aggiornato con le righe in coda, di cui un 2% retrodatate).
+I motori `*_fuori_memoria` confrontano gli stessi job sull'estratto scritto in
+CSV, letto intero oppure a blocchi e in shard (core/outofcore.py): tabelle
+per unità riordinate, quantili del PDC entro il passo dello sketch.
+I motori `*_polars` confrontano selezione naïve, merge DDD, somma dei
+duplicati e riepiloghi in pandas con il motore tabellare Polars
+(core/lazy.py); senza Polars installato sono saltati.
+
+L'aderenza a intervalli è verificata dopo la somma dei duplicati stesso
+giorno (default delle app): senza dedup l'ordine fra righe dello stesso giorno
+nel riferimento dipende dall'ordinamento instabile.
+"""
+import argparse
+import sys
+import tempfile
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from core import adherence, batch, cohort, incremental, lazy, outofcore, pathways, survival, synth
+from core.ingestion import read_path, safe_dt
+
+
+# ---------- preparazione input (come nelle app) ----------
+def _pdc_input(disp, ddd, p):
+    df = disp.assign(DATA=safe_dt(disp["DATA"])).dropna(subset=["DATA"])
+    df, _, _ = cohort.merge_ddd_standard(df, ddd, "ATC", "ATC", "DDD_standard", "DDD")
+    df["giorni_coperti"] = cohort.giorni_coperti(df["DDD"], df["DDD_standard"])
+    df["__date"] = df["DATA"]
+    return df
+
+
+def _adh_input(disp, ddd, p):
+    df = disp.assign(DATA=safe_dt(disp["DATA"])).dropna(subset=["DATA"])
+    df, _ = cohort.join_ddd_lookup(df, ddd, "ATC", "ATC", "DDD_standard", "DDD")
+    return cohort.dedup_same_day(df, ["CF", "PRINCIPIO", "__KEY__", "DATA"])
+
+
+def _km_input(disp, ddd, p):
+    _, inc, _ = survival.preprocess_prism(disp, "CF", "DATA", "ATC", p["periodo"], p["cutoff"])
+    return inc["time"].to_numpy(), inc["event"].to_numpy(), inc["gruppo"].to_numpy()
+
+
+def _lines_input(disp, ddd, p):
+    df = disp.assign(DATA=safe_dt(disp["DATA"])).dropna(subset=["DATA"])
+    return df.sort_values(["CF", "DATA"])[["CF", "ATC"]]
+
+
+def _ader_input(disp, ddd, p):
+    ader = adherence.pdc_persistenza(_pdc_input(disp, ddd, p), ["CF", "ATC"], p["periodo"])
+    ader = ader.rename(columns={"ATC": "ATC_unit"})
+    ader["Aderente"] = ader["PDC_persistenza"] >= 0.8
+    return ader
+
+
+def _adh_out_input(disp, ddd, p):
+    return adherence.adh_intervalli(_adh_input(disp, ddd, p), "CF", "PRINCIPIO", "DATA", p["periodo"])
+
+
+def _pdc_ref(keys):
+    def run(df, p):
+        rows = []
+        for k, g in df.sort_values("__date").groupby(keys, sort=True):
+            pdc, giorni = adherence.calcola_pdc_persistenza(g, g["__date"].min(), p["periodo"])
+            rows.append((*k, pdc, giorni))
+        return pd.DataFrame(rows, columns=keys + ["PDC_persistenza", "Persistenza_giorni"])
+    return run
+
+
+def _adh(fn, den):
+    return lambda df, p: fn(df, "CF", "PRINCIPIO", "DATA", p["periodo"], denominatore=den)
+
+
+def _prism(fn):
+    return lambda disp, p: fn(disp, "CF", "DATA", "ATC", p["periodo"], pd.Timestamp(p["cutoff"]))
+
+
+# ---------- ricalcolo incrementale ----------
+_COLONNE = dict(id="CF", atc="ATC", data="DATA", ddd="DDD", atc_ddd="ATC", ddd_std="DDD_standard", strat="ATC")
+
+
+def _month_appended(disp, ddd, p):
+    """Estratto del mese dopo: righe dell'ultimo mese (più un 2% retrodatato) in coda; ritorna anche le righe già viste."""
+    d = safe_dt(disp["DATA"])
+    late = (d > d.max() - pd.Timedelta(days=30)).to_numpy() if d.notna().any() else np.zeros(len(disp), bool)
+    tail = late | (np.random.default_rng(len(disp)).random(len(disp)) < 0.02)
+    return pd.concat([disp[~tail], disp[tail]], ignore_index=True), ddd, int((~tail).sum())
+
+
+def _incr_job(tipo, p, **extra):
+    job = {**batch.DEFAULTS[tipo], "tipo": tipo, "nome": tipo, "colonne": _COLONNE, "periodo": p["periodo"], **extra}
+    if tipo == "pdc":
+        job["data_indice"] = str((pd.Timestamp(p["cutoff"]) - pd.DateOffset(years=1)).date())
+    if tipo == "km":
+        job["cutoff"] = p["cutoff"]
+    return job
+
+
+def _incr_full(tipo, **extra):
+    def run(x, p):
+        df, ddd, _ = x
+        job = _incr_job(tipo, p, **extra)
+        tables, _ = batch.RUNNERS[tipo](df, ddd, _COLONNE, job)
+        return tuple(tables[k] for k in sorted(tables))
+    return run
+
+
+def _incr(tipo, **extra):
+    def run(x, p):
+        df, ddd, n_old = x
+        job = _incr_job(tipo, p, **extra)
+        with tempfile.TemporaryDirectory() as d:
+            batch.run_incremental(job, df.iloc[:n_old], ddd, d, incremental.row_hashes(df.iloc[:n_old]))
+            tables, _, _ = batch.run_incremental(job, df, ddd, d, incremental.row_hashes(df))
+        return tuple(tables[k] for k in sorted(tables))
+    return run
+
+
+# ---------- fuori memoria ----------
+def _read_tables(d):
+    """Tabelle di un job rilette da Parquet (parti per shard unite), ordinate per le prime due colonne."""
+    out = []
+    for p in sorted(d.iterdir(), key=lambda p: p.stem):
+        if p.suffix == ".parquet" or p.is_dir():
+            t = pd.read_parquet(p)
+            out.append(t.sort_values(list(t.columns[:2]), ignore_index=True))
+    return tuple(out)
+
+
+def _csv_job(tipo, sharded, **extra):
+    def run(x, p):
+        disp, ddd = x
+        job = _incr_job(tipo, p, **extra)
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            disp.to_csv(d / "disp.csv", index=False)
+            if sharded:
+                batch.run_sharded(d / "disp.csv", {"jobs": [job]}, ddd, d / "out", workers=1, formats=("parquet",),
+                                  n_shards=4, chunk_rows=max(len(disp) // 5, 1), log=lambda m: None)
+            else:
+                tables, _ = batch.RUNNERS[tipo](read_path(d / "disp.csv"), ddd, _COLONNE, job)
+                batch.write_outputs(tables, d / "out" / job["nome"], ("parquet",))
+            return _read_tables(d / "out" / job["nome"]) if (d / "out" / job["nome"]).exists() else ()
+    return run
+
+
+# nome: input, riferimento, ottimizzato (stessi argomenti: input preparato, parametri)
+# e, se l'ordine delle righe non è significativo, le colonne su cui riordinare prima del confronto;
+# `atol` allarga la tolleranza assoluta del motore (approssimazioni dichiarate)
+ENGINES = {
+    "pdc_paziente": dict(
+        prep=_pdc_input, ref=_pdc_ref(["CF"]),
+        fast=lambda df, p: adherence.pdc_persistenza(df, ["CF"], p["periodo"]),
+    ),
+    "pdc_atc": dict(
+        prep=_pdc_input, ref=_pdc_ref(["CF", "ATC"]),
+        fast=lambda df, p: adherence.pdc_persistenza(df, ["CF", "ATC"], p["periodo"]),
+    ),
+    "adh_periodo": dict(
+        prep=_adh_input, ref=_adh(adherence.adh_intervalli_reference, "periodo"),
+        fast=_adh(adherence.adh_intervalli, "periodo"), order=["CF", "PRINCIPIO"],
+    ),
+    "adh_persistenza": dict(
+        prep=_adh_input, ref=_adh(adherence.adh_intervalli_reference, "persistenza"),
+        fast=_adh(adherence.adh_intervalli, "persistenza"), order=["CF", "PRINCIPIO"],
+    ),
+    "prism": dict(
+        prep=lambda disp, ddd, p: disp,
+        ref=_prism(survival.preprocess_prism_reference), fast=_prism(survival.preprocess_prism),
+    ),
+    "km": dict(
+        prep=_km_input,
+        ref=lambda a, p: survival.km_curve_from_times_reference(a[0], a[1], p["periodo"]),
+        fast=lambda a, p: survival.km_curve_from_times(a[0], a[1], p["periodo"]),
+    ),
+    "logrank": dict(
+        prep=_km_input,
+        ref=lambda a, p: survival.logrank_prism_reference(*a)[:3],
+        fast=lambda a, p: survival.logrank_prism(*a)[:3],
+    ),
+    "linee": dict(
+        prep=_lines_input,
+        ref=lambda df, p: df.groupby("CF", group_keys=False)
+                            .apply(lambda g: pathways.assign_lines_by_first_seen(g, "ATC")).loc[df.index],
+        fast=lambda df, p: pathways.assign_lines_first_seen(df, "CF", "ATC"),
+    ),
+    "pdc_incrementale": dict(
+        prep=_month_appended, ref=_incr_full("pdc"), fast=_incr("pdc"),
+    ),
+    "pdc_atc_incrementale": dict(
+        prep=_month_appended, ref=_incr_full("pdc", naive="paziente+atc", unita="paziente+atc"),
+        fast=_incr("pdc", naive="paziente+atc", unita="paziente+atc"),
+    ),
+    "km_incrementale": dict(
+        prep=_month_appended, ref=_incr_full("km"), fast=_incr("km"),
+    ),
+    "sankey_incrementale": dict(
+        prep=_month_appended,
+        ref=_incr_full("sankey", min_flow=1, per_src_min=0, gap_days=90, non_study=["L04AB02"], n_boot=20),
+        fast=_incr("sankey", min_flow=1, per_src_min=0, gap_days=90, non_study=["L04AB02"], n_boot=20),
+    ),
+    "pdc_fuori_memoria": dict(
+        prep=lambda disp, ddd, p: (disp, ddd), ref=_csv_job("pdc", False, naive="paziente+atc"),
+        fast=_csv_job("pdc", True, naive="paziente+atc"), atol=1 / outofcore.SKETCH_BINS,
+    ),
+    "km_fuori_memoria": dict(
+        prep=lambda disp, ddd, p: (disp, ddd), ref=_csv_job("km", False), fast=_csv_job("km", True),
+    ),
+    "sankey_fuori_memoria": dict(
+        prep=lambda disp, ddd, p: (disp, ddd),
+        ref=_csv_job("sankey", False, min_flow=1, per_src_min=0, gap_days=90, non_study=["L04AB02"], n_boot=20),
+        fast=_csv_job("sankey", True, min_flow=1, per_src_min=0, gap_days=90, non_study=["L04AB02"], n_boot=20),
+    ),
+    "naive_polars": dict(
+        prep=_pdc_input,
+        ref=lambda df, p: cohort.select_naive(df, ["CF", "ATC"], "DATA", p["cutoff"], "__first_date"),
+        fast=lambda df, p: lazy.select_naive(df, ["CF", "ATC"], "DATA", p["cutoff"], "__first_date", engine=lazy.POLARS),
+    ),
+    "merge_ddd_polars": dict(
+        prep=lambda disp, ddd, p: (disp.assign(DATA=safe_dt(disp["DATA"])), ddd),
+        ref=lambda a, p: cohort.merge_ddd_standard(a[0], a[1], "ATC", "ATC", "DDD_standard", "DDD"),
+        fast=lambda a, p: lazy.merge_ddd_standard(a[0], a[1], "ATC", "ATC", "DDD_standard", "DDD", engine=lazy.POLARS),
+    ),
+    "dedup_polars": dict(
+        prep=lambda disp, ddd, p: cohort.join_ddd_lookup(disp.assign(DATA=safe_dt(disp["DATA"])), ddd,
+                                                         "ATC", "ATC", "DDD_standard", "DDD")[0],
+        ref=lambda df, p: cohort.dedup_same_day(df, ["CF", "PRINCIPIO", "__KEY__", "DATA"]),
+        fast=lambda df, p: lazy.dedup_same_day(df, ["CF", "PRINCIPIO", "__KEY__", "DATA"], engine=lazy.POLARS),
+    ),
+    "riepilogo_pdc_polars": dict(
+        prep=_ader_input, ref=lambda df, p: adherence.riepilogo_pdc(df),
+        fast=lambda df, p: lazy.riepilogo_pdc(df, engine=lazy.POLARS),
+    ),
+    "riepilogo_adh_polars": dict(
+        prep=_adh_out_input, ref=lambda df, p: adherence.riepilogo_adh(df, "PRINCIPIO", 0.8),
+        fast=lambda df, p: lazy.riepilogo_adh(df, "PRINCIPIO", 0.8, engine=lazy.POLARS),
+    ),
+}
+
+
+# ---------- confronto ----------
+def differences(ref, fast, rtol, atol, path="uscita"):
+    """Differenze fra due uscite (DataFrame, Series, tuple, liste, scalari); [] se equivalenti."""
+    if isinstance(ref, tuple):
+        if not isinstance(fast, tuple) or len(ref) != len(fast):
+            return [f"{path}: struttura diversa"]
+        return [d for i, (a, b) in enumerate(zip(ref, fast)) for d in differences(a, b, rtol, atol, f"{path}[{i}]")]
+    if isinstance(ref, pd.DataFrame):
+        if list(ref.columns) != list(fast.columns):
+            return [f"{path}: colonne {list(ref.columns)} ≠ {list(fast.columns)}"]
+        return [d for c in ref.columns for d in differences(ref[c], fast[c], rtol, atol, f"{path}.{c}")]
+    a = np.asarray(ref.to_numpy() if isinstance(ref, pd.Series) else ref)
+    b = np.asarray(fast.to_numpy() if isinstance(fast, pd.Series) else fast)
+    if a.shape != b.shape:
+        return [f"{path}: dimensioni {a.shape} ≠ {b.shape}"]
+    if a.dtype.kind in "biuf" and b.dtype.kind in "biuf":
+        ok = np.isclose(a.astype(float), b.astype(float), rtol=rtol, atol=atol, equal_nan=True)
+    else:
+        a, b = a.astype(object), b.astype(object)
+        ok = (a == b) | (pd.isna(a) & pd.isna(b))
+    bad = np.flatnonzero(~np.atleast_1d(ok))
+    if not len(bad):
+        return []
+    i = bad[0]
+    ai, bi = np.atleast_1d(a)[i], np.atleast_1d(b)[i]
+    return [f"{path}: {len(bad)} valori diversi (primo in posizione {i}: {ai!r} ≠ {bi!r})"]
+
+
+def check(engine, disp, ddd, p, rtol, atol):
+    e = ENGINES[engine]
+    x = e["prep"](disp, ddd, p)
+    ref, fast = e["ref"](x, p), e["fast"](x, p)
+    if e.get("order"):
+        ref, fast = (r.sort_values(e["order"]).reset_index(drop=True) for r in (ref, fast))
+    return differences(ref, fast, rtol, max(atol, e.get("atol", 0.0)))
+
+
+def shrink(engine, disp, ddd, p, rtol, atol, max_patients=500):
+    """Il primo paziente che da solo riproduce la differenza (o None)."""
+    for pid in disp["CF"].drop_duplicates().head(max_patients):
+        sub = disp[disp["CF"] == pid]
+        try:
+            if check(engine, sub, ddd, p, rtol, atol):
+                return sub
+        except Exception:
+            return sub
+    return None
+
+
+# ---------- dataset ----------
+def edge_cases():
+    """Casi limite scritti a mano (date gg/mm/aaaa come negli estratti)."""
+    rows = [
+        ("E01", "L04AB04", "ADALIMUMAB", "10/03/2022", 81.2),     # dispensazione singola → time=0
+        ("E02", "L04AB04", "ADALIMUMAB", "01/01/2022", 40.6),     # duplicati stesso giorno
+        ("E02", "L04AB04", "ADALIMUMAB", "01/01/2022", 29.0),
+        ("E02", "L04AB04", "ADALIMUMAB", "01/01/2022", 11.6),
+        ("E02", "L04AB04", "ADALIMUMAB", "29/01/2022", 81.2),
+        ("E03", "L04AA37", "BARICITINIB", "01/02/2022", 112.0),   # DDD_standard = 0
+        ("E03", "L04AA37", "BARICITINIB", "01/03/2022", 112.0),
+        ("E04", "L04AA29", "TOFACITINIB", "05/02/2022", 280.0),   # ATC assente dal lookup
+        ("E04", "L04AB01", "ETANERCEPT", "05/03/2022", 196.0),
+        ("E05", "L04AC05", "USTEKINUMAB", "01/01/2022", 45.0),    # evento esattamente a fine finestra
+        ("E05", "L04AC05", "USTEKINUMAB", "01/01/2023", 45.0),
+        ("E06", "L04AC10", "SECUKINUMAB", "15/01/2022", 0.0),     # DDD nulle
+        ("E06", "L04AC10", "SECUKINUMAB", "15/02/2022", 0.0),
+        ("E07", "L04AB02", "INFLIXIMAB", "20/01/2022", 1e6),      # copertura oltre la finestra
+        ("E07", "L04AB02", "INFLIXIMAB", "20/06/2022", 210.0),
+        ("E08", "L04AB06", "GOLIMUMAB", "31/02/2022", 46.5),      # date non valide
+        ("E08", "L04AB06", "GOLIMUMAB", "", 46.5),
+        ("E08", "L04AB06", "GOLIMUMAB", "12/04/2022", 46.5),
+        ("E09", "L04AB04", "ADALIMUMAB", "01/01/2022", 81.2),     # A → B → A (linee per prima comparsa)
+        ("E09", "L04AC16", "GUSELKUMAB", "01/03/2022", 50.1),
+        ("E09", "L04AB04", "ADALIMUMAB", "01/05/2022", 81.2),
+        ("E10", "L04AC13", "IXEKIZUMAB", "01/01/2022", 80.0),     # due terapie nello stesso giorno
+        ("E10", "L04AC18", "RISANKIZUMAB", "01/01/2022", 90.0),
+        ("E10", "L04AC13", "IXEKIZUMAB", "31/12/2024", 80.0),     # ultima data = cutoff
+    ]
+    disp = pd.DataFrame(rows, columns=["CF", "ATC", "PRINCIPIO", "DATA", "DDD"])
+    return disp, synth.ddd_table(), {"periodo": 365, "cutoff": "2024-12-31"}
+
+
+def random_case(rng):
+    """Dataset e parametri casuali: pochi pazienti, molte irregolarità."""
+    disp, ddd = synth.generate(
+        int(rng.integers(20, 1500)), seed=int(rng.integers(2**31)), mean_disp=float(rng.uniform(1.5, 15)),
+        p_switch=float(rng.uniform(0, 0.3)), p_gap=float(rng.uniform(0, 0.3)), p_combo=float(rng.uniform(0, 0.3)),
+        p_dup=float(rng.uniform(0, 0.2)), messy_dates=bool(rng.random() < 0.5),
+    )
+    dates = safe_dt(disp["DATA"]).dropna()
+    cutoff = dates.quantile(rng.uniform(0.3, 1.0)).normalize() if len(dates) else pd.Timestamp("2024-12-31")
+    return disp, ddd, {"periodo": int(rng.choice([30, 90, 180, 365, 730])), "cutoff": str(cutoff.date())}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Equivalenza motori ottimizzati / riferimento")
+    ap.add_argument("--casi", type=int, default=50, help="Numero di dataset casuali")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--engines", default=",".join(ENGINES), help=f"Motori ({', '.join(ENGINES)})")
+    ap.add_argument("--rtol", type=float, default=1e-9)
+    ap.add_argument("--atol", type=float, default=1e-12)
+    ap.add_argument("--out", default="equivalenza_falliti", help="Cartella per i casi minimi falliti")
+    args = ap.parse_args(argv)
+
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        ap.error(f"motori sconosciuti: {', '.join(sorted(unknown))}")
+
+    warnings.simplefilter("ignore", UserWarning)  # parsing delle date sporche, voluto
+    rng = np.random.default_rng(args.seed)
+    cases = [("limite", *edge_cases())] + [(f"casuale_{i + 1}", *random_case(rng)) for i in range(args.casi)]
+    failures = 0
+    for engine in engines:
+        if engine.endswith("_polars") and not lazy.available():
+            print(f"{engine:16s} saltato: Polars non installato")
+            continue
+        n_ok = 0
+        for name, disp, ddd, p in cases:
+            try:
+                diff = check(engine, disp, ddd, p, args.rtol, args.atol)
+            except Exception as e:
+                diff = [f"errore {type(e).__name__}: {e}"]
+            if not diff:
+                n_ok += 1
+                continue
+            failures += 1
+            print(f"[{engine}] {name} {p}: " + "; ".join(diff))
+            sub = shrink(engine, disp, ddd, p, args.rtol, args.atol)
+            if sub is not None:
+                Path(args.out).mkdir(parents=True, exist_ok=True)
+                path = Path(args.out) / f"{engine}_{name}.csv"
+                sub.to_csv(path, index=False, date_format="%d/%m/%Y")
+                print(f"    riproducibile con un solo paziente: {path}")
+        print(f"{engine:16s} {n_ok}/{len(cases)} casi equivalenti")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
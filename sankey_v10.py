@@ -3,47 +3,53 @@ import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
 import numpy as np
-import io
 import re
 from datetime import date
 
+from core import cohort, ingestion, jobs, pathways, perf, store, survival
+import ui
+
 st.set_page_config(layout="wide")
 st.title("Sankey — Linee terapeutiche (senza aggregazioni)")
-
-# ---------- helpers ----------
-def _safe_dt(s):
-    return pd.to_datetime(s, errors="coerce", dayfirst=True)
-
-def _collapse_consecutive(df, id_col, cat_col):
-    """Rimuove ripetizioni consecutive della stessa categoria per paziente."""
-    g = df.sort_values([id_col, "___DATE___"]).copy()
-    keep = g[cat_col] != g.groupby(id_col)[cat_col].shift(1)
-    return g[keep]
-
-def _assign_lines_by_first_seen(grp, cat_col):
-    """Linea = +1 alla prima NUOVA categoria (mai vista prima nel paziente)."""
-    seen, out = set(), []
-    k = 0
-    for v in grp[cat_col]:
-        if v not in seen:
-            k += 1
-            seen.add(v)
-        out.append(k)
-    return pd.Series(out, index=grp.index)
-
-def _stage_from_label(label: str) -> int:
-    """Estrae N da '(Linea N)'; usa 10000 per gli Esiti (così vanno a destra)."""
-    m = re.search(r"\(Linea\s+(\d+)\)$", str(label))
-    return int(m.group(1)) if m else 10_000
-
-def _pretty_label(s: str, maxlen: int = 28) -> str:
-    """Etichette in Title Case, a capo su '+' e prima di '(Linea N)'. """
-    s = str(s).strip()
-    s = s.replace(" + ", "<br>+ ").replace(" (Linea", "<br>(Linea")
-    plain = re.sub(r"<br>", " ", s).title()
-    if len(plain) > maxlen:
-        plain = plain[:maxlen] + "…"
-    return plain.replace(" + ", "<br>+ ").replace(" (Linea", "<br>(Linea")
+prof = perf.Profiler("sankey_v10")
+
+# ---------- cache (calcolo separato dallo stile) ----------
+@st.cache_data(show_spinner=False)
+def _read_excel(file_hash, _file_bytes):
+    """Legge l'Excel una sola volta per contenuto (chiave = hash del file)."""
+    return ingestion.read_excel(_file_bytes)
+
+@st.cache_data(show_spinner=False)
+def _date_bounds(file_hash, date_col, _df):
+    """Min/max della colonna data scelta (per il calendario)."""
+    return ingestion.date_bounds(_df[date_col])
+
+# job del server (core.jobs.shared): i flussi sono calcolati in background (la
+# pagina resta usabile), in coda con i job delle altre app, e restano in
+# memoria per parametri come la vecchia cache_resource
+def _flows_job(df, params, progress):
+    """
+    Flussi Sankey (core.pathways.compute_flows) eseguiti in un job: ritorna
+    (risultato, messaggio, fasi misurate). Gli array dell'indice e le
+    dispensazioni restano condivisi in sola lettura fra i rerun.
+    """
+    jp = perf.Profiler("sankey_v10")
+    args = {k: v for k, v in params.items() if k != "file_hash"}
+    with jp.stage("flussi (coorte, linee, link)", df) as fase:
+        res, msg = pathways.compute_flows(df, progress=progress, **args)
+        fase.out(None if res is None else res["links"])
+    return res, msg, jp.stages
+
+def _flows_job_archiviato(df, params, skey, motore, descrizione, progress):
+    """_flows_job con salvataggio di risultato e messaggio nell'archivio su disco (core.store)."""
+    res, msg, fasi = _flows_job(df, params, progress)
+    store.save(skey, dict(res=res, msg=msg), "sankey_v10", descrizione, params, motore)
+    return res, msg, fasi
+
+@st.cache_data(show_spinner="Bootstrap matrici di transizione…")
+def _transition_matrices(flows_key, n_boot, _line_trans):
+    """Matrici di transizione per anno con IC bootstrap, in cache per (parametri dei flussi, n_boot)."""
+    return pathways.transition_matrices(_line_trans, n_boot)
 
 # ---------- input ----------
 file = st.file_uploader("📁 Carica file Excel con dispensazioni singole", type=["xlsx"])
@@ -51,7 +57,10 @@ if not file:
     st.info("Carica un file per iniziare.")
     st.stop()
 
-df = pd.read_excel(file)
+file_bytes = file.getvalue()
+file_hash = ingestion.file_hash(file_bytes)
+with prof.stage("lettura Excel") as fase:
+    df = fase.out(_read_excel(file_hash, file_bytes))
 with st.expander("Anteprima"):
     st.dataframe(df.head())
 
@@ -65,12 +74,12 @@ with st.form("setup"):
         date_col = st.selectbox("Colonna data erogazione", df.columns)
 
     # range dinamico per il calendario (in base alla colonna data scelta)
-    tmp_dates = _safe_dt(df[date_col]).dropna()
-    if not tmp_dates.empty:
-        MIN_CAL = (tmp_dates.min() - pd.Timedelta(days=3650)).date()  # 10 anni prima del minimo
-        MAX_CAL = (tmp_dates.max() + pd.Timedelta(days=3650)).date()  # 10 anni dopo il massimo
-        default_naive = tmp_dates.min().date()
-        default_fu    = tmp_dates.max().date()
+    d_min, d_max = _date_bounds(file_hash, date_col, df)
+    if d_min is not None:
+        MIN_CAL = (d_min - pd.Timedelta(days=3650)).date()  # 10 anni prima del minimo
+        MAX_CAL = (d_max + pd.Timedelta(days=3650)).date()  # 10 anni dopo il massimo
+        default_naive = d_min.date()
+        default_fu    = d_max.date()
     else:
         MIN_CAL = date(1900, 1, 1)
         MAX_CAL = date(2200, 12, 31)
@@ -100,7 +109,7 @@ with st.form("setup"):
             format="YYYY-MM-DD",
         )
 
-    # opzioni grafiche/filtri
+    # filtri sui flussi
     c5, c6, c7 = st.columns(3)
     with c5:
         collapse = st.checkbox("Collassa ripetizioni consecutive", value=True)
@@ -109,6 +118,48 @@ with st.form("setup"):
     with c7:
         per_src_min = st.slider("Nascondi link < % della sorgente", 0.0, 20.0, 1.5, 0.5)
 
+    regimen_window = st.number_input(
+        "Combinazioni: unisci categorie diverse dispensate entro ± giorni (0 = disattivo)", 0, 90, 0, 1
+    )
+
+    # regole d'esito (modalità linee)
+    c18, c19 = st.columns(2)
+    with c18:
+        gap_days = st.number_input(
+            "Copertura attesa dopo l'ultima dispensazione per gli esiti (giorni; 0 = solo cut-off)", 0, 730, 0, 15
+        )
+    with c19:
+        non_study_txt = st.text_input("Categorie NON in studio (separate da ';')", value="")
+
+    # modalità: linee terapeutiche o stato ai checkpoint temporali
+    c15, c16, c17 = st.columns(3)
+    with c15:
+        mode = st.radio("Modalità Sankey", ["Linee terapeutiche", "Stato ai checkpoint"])
+    with c16:
+        checkpoints = st.multiselect("Checkpoint (mesi dall'inizio terapia)", [3, 6, 9, 12, 18, 24, 36, 48],
+                                     default=[3, 6, 12, 24])
+    with c17:
+        grace_days = st.number_input("Copertura dopo l'ultima dispensazione (giorni)", 0, 365, 60, 5)
+
+    submitted = st.form_submit_button("Avvia")
+
+# i parametri di calcolo restano in sessione: i widget di stile (fuori dal form)
+# rieseguono lo script ma trovano i flussi già calcolati dal job
+if submitted:
+    st.session_state["sankey_params"] = dict(
+        file_hash=file_hash, id_col=id_col, cat_col=cat_col, date_col=date_col,
+        cutoff_naive=cutoff_naive, cutoff_fu=cutoff_fu,
+        collapse=bool(collapse), min_flow=int(min_flow), per_src_min=float(per_src_min),
+        mode=mode, checkpoints=tuple(sorted(checkpoints)), grace_days=int(grace_days),
+        regimen_window=int(regimen_window), gap_days=int(gap_days),
+        non_study=tuple(sorted({c.strip() for c in non_study_txt.split(";") if c.strip()})),
+    )
+params = st.session_state.get("sankey_params")
+if not params or params["file_hash"] != file_hash:
+    st.stop()
+
+# ---------- opzioni grafiche (fuori dal form: non ricalcolano i flussi) ----------
+with st.expander("🎨 Opzioni grafiche", expanded=False):
     c8, c9, c10 = st.columns(3)
     with c8:
         label_min_total = st.number_input("Mostra etichetta se traffico totale ≥", 0, 999, 60, 1)
@@ -133,81 +184,53 @@ with st.form("setup"):
 
     link_alpha_min = st.slider("Opacità minima link", 0.05, 0.6, 0.15, 0.05)
 
-    submitted = st.form_submit_button("Avvia")
-
-if not submitted:
-    st.stop()
-
-# ---------- prep ----------
-df = df.copy()
-df[date_col] = _safe_dt(df[date_col])
-df = df.dropna(subset=[date_col])
-df["___DATE___"] = df[date_col]
-df[cat_col] = df[cat_col].astype(str).str.strip()
-
-# coorte NAÏVE
-first_disp = df.groupby(id_col)["___DATE___"].min().reset_index()
-naive_ids = first_disp[first_disp["___DATE___"] >= pd.to_datetime(cutoff_naive)][id_col]
-df = df[df[id_col].isin(naive_ids)].sort_values([id_col, "___DATE___"])
-
-if collapse:
-    df = _collapse_consecutive(df, id_col, cat_col)
-if df.empty:
-    st.warning("Nessun record dopo i filtri.")
-    st.stop()
-
-# linee terapeutiche = prima comparsa di nuova categoria
-df["Linea"] = df.groupby(id_col, group_keys=False).apply(lambda g: _assign_lines_by_first_seen(g, cat_col))
-df["Terapia"] = df[cat_col] + " (Linea " + df["Linea"].astype(int).astype(str) + ")"
-
-# esito
-last_dates = df.groupby(id_col)["___DATE___"].max().reset_index()
-last_dates["Esito"] = last_dates["___DATE___"].apply(
-    lambda x: "In trattamento" if x >= pd.to_datetime(cutoff_fu) else "Perso al follow-up"
-)
-df = df.merge(last_dates[[id_col, "Esito"]], on=id_col, how="left")
-
-max_line = int(df["Linea"].max())
-if max_line < 1:
-    st.warning("Dati insufficienti per il Sankey.")
-    st.stop()
-
-# ---------- flussi (no aggregazione) ----------
-flows = []
-# Linea i -> i+1
-for i in range(1, max_line):
-    step = df[df["Linea"].isin([i, i+1])]
-    piv = step.pivot_table(index=id_col, columns="Linea", values="Terapia", aggfunc="first").dropna()
-    if not piv.empty:
-        f = piv.groupby([i, i+1]).size().reset_index(name="Count")
-        f.columns = ["source", "target", "Count"]
-        flows.append(f)
-
-# Terapia finale -> Esito
-last_step = df.groupby(id_col).agg({"Linea": "max", "Terapia": "last", "Esito": "last"}).reset_index()
-f_end = last_step.groupby(["Terapia", "Esito"]).size().reset_index(name="Count")
-f_end.columns = ["source", "target", "Count"]
-flows.append(f_end)
-
-sankey_df = pd.concat(flows, ignore_index=True)
-# filtro assoluto
-sankey_df = sankey_df[sankey_df["Count"] >= int(min_flow)].copy()
-if sankey_df.empty:
-    st.warning("Tutti i flussi sono sotto la soglia selezionata (N).")
-    st.stop()
-
-# filtro per % della sorgente
-tot_src_tmp = sankey_df.groupby("source")["Count"].transform("sum")
-sankey_df["Perc_source_%"] = (sankey_df["Count"] / tot_src_tmp * 100)
-sankey_df = sankey_df[sankey_df["Perc_source_%"] >= float(per_src_min)].copy()
-if sankey_df.empty:
-    st.warning("Tutti i flussi sono sotto la soglia percentuale impostata.")
+# ---------- flussi (job in background) ----------
+runner = jobs.shared()
+flows_key = ("sankey",) + tuple(sorted(params.items()))
+job = runner.get(flows_key)
+if job is None or (submitted and job.status in (jobs.FAILED, jobs.CANCELLED)):
+    # archivio su disco: stesso file, mappatura, parametri e motore → nessun ricalcolo
+    # (motore = sorgente dei moduli core usati, anche indirettamente, e della pagina)
+    motore = store.engine_version(cohort, ingestion, pathways, survival, __file__)
+    skey = store.key("sankey_v10", [file_hash], {k: v for k, v in params.items() if k != "file_hash"}, motore)
+    with prof.stage("lettura archivio risultati"):
+        salvato = store.load(skey)
+    if salvato is not None:
+        job = runner.put(flows_key, (salvato["res"], salvato["msg"], []), label="Flussi Sankey")
+    else:
+        job = runner.submit(_flows_job_archiviato, df, params, skey, motore, f"{file.name} • {params['mode']}",
+                            key=flows_key, label="Flussi Sankey", cost_mb=jobs.estimate_mb(*df.shape))
+if job.status == jobs.DONE:
+    st.session_state["sankey_done"] = (flows_key, params)
+else:
+    if job.status == jobs.FAILED:
+        st.error(f"Calcolo non riuscito: {job.error}")
+    elif job.status == jobs.CANCELLED:
+        st.warning("Calcolo annullato: premi Avvia per ripeterlo.")
+    else:
+        ui.job_panel(flows_key)
+    # nel frattempo resta consultabile l'ultimo risultato completato sullo stesso file
+    prev = st.session_state.get("sankey_done")
+    if prev is None or prev[1]["file_hash"] != file_hash or runner.get(prev[0]) is None:
+        st.stop()
+    st.caption("Risultati dell'ultimo calcolo completato (i nuovi parametri non sono ancora applicati).")
+    flows_key, params = prev
+    job = runner.get(flows_key)
+res, msg, fasi = job.result
+if st.session_state.get("sankey_visto") != flows_key:  # fasi del job una sola volta nel profilo
+    st.session_state["sankey_visto"] = flows_key
+    prof.stages += [dict(r, fase=f"{r['fase']} (job)") for r in fasi]
+if res is None:
+    st.warning(msg)
     st.stop()
+sankey_df = res["links"].copy()
+all_labels = res["labels"]
+cutoff_naive, cutoff_fu = params["cutoff_naive"], params["cutoff_fu"]
 
 # ---------- layout nodi per fase + ordinamento per traffico ----------
-all_labels = pd.unique(sankey_df[["source","target"]].values.ravel()).tolist()
-stage_map = {lab: _stage_from_label(lab) for lab in all_labels}
-max_line_stage = max([v for v in stage_map.values() if v < 10_000] or [1])
+stage_map = {lab: pathways.stage_from_label(lab) for lab in all_labels}
+# fasi equispaziate (Linea 1..N oppure checkpoint in mesi); Esiti a destra
+stage_rank = {stg: k for k, stg in enumerate(sorted(v for v in set(stage_map.values()) if v < 10_000))}
 
 # traffico per nodo (entrate + uscite) per ordering/label
 tot_in  = sankey_df.groupby("target")["Count"].sum()
@@ -215,7 +238,7 @@ tot_out = sankey_df.groupby("source")["Count"].sum()
 node_total = (tot_in.add(tot_out, fill_value=0)).to_dict()
 
 # posizione orizzontale
-x_pos = {lab: (1.0 if stage_map[lab]==10_000 else (stage_map[lab]-1)/max(1, max_line_stage-1))
+x_pos = {lab: (1.0 if stage_map[lab]==10_000 else stage_rank[stage_map[lab]]/max(1, len(stage_rank)-1))
          for lab in all_labels}
 # posizione verticale (ordina per traffico decrescente in ogni fase)
 y_pos = {}
@@ -227,10 +250,7 @@ for stg in sorted(set(stage_map.values())):
     for l, y in zip(labs, ys):
         y_pos[l] = float(y)
 
-# id mapping
 id_map = {lab: i for i, lab in enumerate(all_labels)}
-sankey_df["source_id"] = sankey_df["source"].map(id_map)
-sankey_df["target_id"] = sankey_df["target"].map(id_map)
 
 # percentuali & opacità link (più morbidi)
 tot_src = sankey_df.groupby("source")["Count"].transform("sum")
@@ -239,69 +259,193 @@ gamma = 0.6  # più contrasto tra piccoli/grandi
 alphas = (float(link_alpha_min) + (1.0 - float(link_alpha_min)) * (rel ** gamma)).round(3)
 link_colors = [f"rgba(120,120,120,{a})" for a in alphas]
 
+# tempo allo switch nel tooltip (solo link Linea i → i+1)
+switch_txt = [
+    "" if pd.isna(md) else f"<br>Switch dopo: mediana {md:.0f} gg (IQR {q1:.0f}–{q3:.0f})"
+    for md, q1, q3 in sankey_df[["Giorni_switch_mediana", "Giorni_switch_Q1", "Giorni_switch_Q3"]].itertuples(index=False)
+]
+
 # colori nodi (esiti fissi)
 palette = px.colors.qualitative.Set3 * 20
 node_colors = [palette[i % len(palette)] for i in range(len(all_labels))]
 for i, lab in enumerate(all_labels):
-    if lab == "In trattamento":
+    base = re.sub(r"\s*\(Mese\s+\d+\)$", "", lab)
+    if base == "In trattamento":
         node_colors[i] = "#8E8CD8"  # lilla
-    elif lab == "Perso al follow-up":
+    elif base == "Perso al follow-up":
         node_colors[i] = "#F2C879"  # sabbia
+    elif base == "Interrotto":
+        node_colors[i] = "#E8998D"  # corallo
+    elif base == "Non osservabile":
+        node_colors[i] = "#D9D9D9"  # grigio
+    elif base == "Switch a farmaco non in studio":
+        node_colors[i] = "#9BC59D"  # salvia
 
 # etichette: mostra solo sopra soglia totale
 labels_pretty = [
-    _pretty_label(lab, maxlen=int(lbl_max)) if node_total.get(lab, 0) >= int(label_min_total) else ""
+    pathways.pretty_label(lab, maxlen=int(lbl_max)) if node_total.get(lab, 0) >= int(label_min_total) else ""
     for lab in all_labels
 ]
 
 # ---------- plot ----------
-fig = go.Figure(go.Sankey(
-    arrangement="freeform",
-    textfont=dict(family=font_family, size=int(font_size), color="#555"),  # testo più leggero (no “finto grassetto”)
-    node=dict(
-        label=labels_pretty,
-        pad=34, thickness=24,
-        color=node_colors,
-        line=dict(color="rgba(0,0,0,0.12)", width=0.3),  # bordo nodo soft
-        x=[x_pos[l] for l in all_labels],
-        y=[y_pos[l] for l in all_labels],
-    ),
-    link=dict(
-        source=sankey_df["source_id"],
-        target=sankey_df["target_id"],
-        value=sankey_df["Count"],
-        color=link_colors,
-        customdata=(sankey_df["Count"] / tot_src * 100).round(1),
-        hovertemplate="<b>%{source.label}</b> → <b>%{target.label}</b><br>"
-                      "N = %{value}  ( %{customdata}% della sorgente )<extra></extra>",
+with prof.stage("figura Sankey", sankey_df):
+    fig = go.Figure(go.Sankey(
+        arrangement="freeform",
+        textfont=dict(family=font_family, size=int(font_size), color="#555"),  # testo più leggero (no “finto grassetto”)
+        node=dict(
+            label=labels_pretty,
+            pad=34, thickness=24,
+            color=node_colors,
+            line=dict(color="rgba(0,0,0,0.12)", width=0.3),  # bordo nodo soft
+            x=[x_pos[l] for l in all_labels],
+            y=[y_pos[l] for l in all_labels],
+        ),
+        link=dict(
+            source=sankey_df["source_id"],
+            target=sankey_df["target_id"],
+            value=sankey_df["Count"],
+            color=link_colors,
+            customdata=np.column_stack([(sankey_df["Count"] / tot_src * 100).round(1), switch_txt]),
+            hovertemplate="<b>%{source.label}</b> → <b>%{target.label}</b><br>"
+                          "N = %{value}  ( %{customdata[0]}% della sorgente )"
+                          "%{customdata[1]}<extra></extra>",
+        )
+    ))
+    fig.update_layout(
+        height=int(fig_height),
+        title_text=f"NAÏVE da {pd.to_datetime(cutoff_naive).date()} • FU fino a {pd.to_datetime(cutoff_fu).date()}"
+                   + (f" • stato a {', '.join(map(str, params['checkpoints']))} mesi (copertura {params['grace_days']} gg)"
+                      if params["mode"] == "Stato ai checkpoint" else ""),
+        font=dict(family=font_family, size=int(font_size), color="#444"),
+        hoverlabel=dict(font=dict(family=font_family, size=max(int(font_size)-1, 10), color="#444")),
+        plot_bgcolor="white", paper_bgcolor="white"
     )
-))
-fig.update_layout(
-    height=int(fig_height),
-    title_text=f"NAÏVE da {pd.to_datetime(cutoff_naive).date()} • FU fino a {pd.to_datetime(cutoff_fu).date()}",
-    font=dict(family=font_family, size=int(font_size), color="#444"),
-    hoverlabel=dict(font=dict(family=font_family, size=max(int(font_size)-1, 10), color="#444")),
-    plot_bgcolor="white", paper_bgcolor="white"
-)
-st.plotly_chart(fig, use_container_width=True)
+with prof.stage("rendering Sankey"):
+    st.plotly_chart(fig, use_container_width=True)
+
+# ---------- tempo allo switch (KM) ----------
+km = res["km"] if res["km"] is not None else pd.DataFrame(columns=["gruppo", "time", "eventi", "censure", "a_rischio", "S"])
+if params["mode"] != "Stato ai checkpoint":
+    with st.expander("⏱️ Tempo allo switch di linea (Kaplan–Meier)", expanded=False):
+        km_med = km[km["S"] <= 0.5].groupby("gruppo")["time"].min()
+        km_tab = km.groupby("gruppo").agg(N=("a_rischio", "max"), Switch=("eventi", "sum"), Censure=("censure", "sum"))
+        km_tab["Mediana_KM_giorni"] = km_med
+        km_tab = km_tab.loc[[l for l in all_labels if l in km_tab.index]].reset_index()
+        st.dataframe(km_tab, hide_index=True)
+        km_sel = st.multiselect("Curve da mostrare", km_tab["gruppo"].tolist(), default=km_tab["gruppo"].tolist()[:5])
+        fig_km = go.Figure()
+        for lab in km_sel:
+            kg = km[km["gruppo"] == lab]
+            fig_km.add_trace(go.Scatter(x=[0] + kg["time"].tolist(), y=[1.0] + kg["S"].tolist(),
+                                        mode="lines", line_shape="hv", name=lab))
+        fig_km.update_layout(xaxis_title="Giorni dall'ingresso in linea", yaxis_title="Probabilità di non aver cambiato linea",
+                             yaxis=dict(range=[0, 1]))
+        st.plotly_chart(fig_km, use_container_width=True)
+
+# ---------- matrici di transizione per anno ----------
+trans_mat = None
+if res["line_trans"] is not None and not res["line_trans"].empty:
+    with st.expander("🧮 Matrici di transizione per anno (IC bootstrap)", expanded=False):
+        n_boot = st.number_input("Repliche bootstrap", 100, 5000, 500, 100)
+        with prof.stage("matrici di transizione", res["line_trans"]) as fase:
+            trans_mat = fase.out(_transition_matrices(flows_key, int(n_boot), res["line_trans"]))
+        anno = st.selectbox("Anno dello switch", sorted(trans_mat["Anno"].unique()))
+        tm = trans_mat[trans_mat["Anno"] == anno]
+        src_order = sorted(tm["source"].unique())
+        tgt_order = sorted(tm["target"].unique())
+        z = tm.pivot(index="source", columns="target", values="P").reindex(index=src_order, columns=tgt_order)
+        ci_lo = tm.pivot(index="source", columns="target", values="IC95_inf").reindex(index=src_order, columns=tgt_order)
+        ci_hi = tm.pivot(index="source", columns="target", values="IC95_sup").reindex(index=src_order, columns=tgt_order)
+        n_src = tm.groupby("source")["N_sorgente"].first().reindex(src_order)
+        fig_tm = go.Figure(go.Heatmap(
+            z=z.fillna(0).to_numpy(), x=tgt_order, y=[f"{s_} (n={n})" for s_, n in n_src.items()],
+            customdata=np.dstack([ci_lo.fillna(0).to_numpy(), ci_hi.fillna(0).to_numpy()]),
+            text=z.map(lambda v: "" if pd.isna(v) else f"{v:.2f}").to_numpy(), texttemplate="%{text}",
+            colorscale="Blues", zmin=0, zmax=1,
+            hovertemplate="%{y} → %{x}<br>P = %{z:.3f} (IC95 %{customdata[0]:.3f}–%{customdata[1]:.3f})<extra></extra>",
+        ))
+        fig_tm.update_layout(height=max(400, 40 * len(src_order) + 150),
+                             xaxis_title="Terapia successiva", yaxis_title="Terapia di partenza",
+                             yaxis=dict(autorange="reversed"))
+        st.plotly_chart(fig_tm, use_container_width=True)
 
 # ---------- export ----------
 st.subheader("📥 Scarica dati (links + nodes)")
-buf = io.BytesIO()
-with pd.ExcelWriter(buf, engine="openpyxl") as w:
-    sankey_df.to_excel(w, index=False, sheet_name="links")
-    pd.DataFrame({
-        "id": [id_map[l] for l in all_labels],
-        "label": all_labels,
-        "label_shown": labels_pretty,
-        "stage": [stage_map[l] for l in all_labels],
-        "x": [x_pos[l] for l in all_labels],
-        "y": [y_pos[l] for l in all_labels],
-        "node_total": [int(node_total.get(l, 0)) for l in all_labels],
-    }).to_excel(w, index=False, sheet_name="nodes")
-st.download_button(
-    "💾 Scarica Excel",
-    data=buf.getvalue(),
-    file_name="sankey_linee.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-)
+nodes_df = pd.DataFrame({
+    "id": [id_map[l] for l in all_labels],
+    "label": all_labels,
+    "label_shown": labels_pretty,
+    "stage": [stage_map[l] for l in all_labels],
+    "x": [x_pos[l] for l in all_labels],
+    "y": [y_pos[l] for l in all_labels],
+    "node_total": [int(node_total.get(l, 0)) for l in all_labels],
+})
+ui.download_buttons({
+    "links": sankey_df,
+    "nodes": nodes_df,
+    "tempi_switch": sankey_df.loc[sankey_df["Giorni_switch_mediana"].notna(),
+                                  ["source", "target", "Count", "Giorni_switch_Q1", "Giorni_switch_mediana", "Giorni_switch_Q3"]],
+    "km_switch": km,
+    "transizioni_anno": trans_mat,
+}, "sankey_linee", extra={"Performance": prof.to_frame()})
+
+# ---------- drill-down pazienti (indice invertito, niente riscansione) ----------
+st.subheader("🔎 Drill-down pazienti")
+kind = st.radio("Seleziona", ["Link", "Nodo"], horizontal=True)
+if kind == "Link":
+    opts = list(range(len(sankey_df)))
+    sel = st.selectbox(
+        "Flusso", opts,
+        format_func=lambda i: f"{sankey_df.at[i, 'source']} → {sankey_df.at[i, 'target']} (N = {sankey_df.at[i, 'Count']})",
+    )
+    ptr, pids_all = res["link_ptr"], res["link_pids"]
+    sel_name = f"link_{sel}"
+else:
+    opts = list(range(len(all_labels)))
+    sel = st.selectbox(
+        "Nodo", opts,
+        format_func=lambda i: f"{all_labels[i]} (traffico = {int(node_total.get(all_labels[i], 0))})",
+    )
+    ptr, pids_all = res["node_ptr"], res["node_pids"]
+    sel_name = f"nodo_{sel}"
+
+sel_pids = pids_all[ptr[sel]:ptr[sel + 1]]
+with prof.stage("drill-down", len(sel_pids)) as fase:
+    sel_disp = fase.out(pathways.drilldown_rows(res, sel_pids))
+st.caption(f"{len(sel_pids):,} pazienti • {len(sel_disp):,} dispensazioni")
+sel_pat = pd.DataFrame({params["id_col"]: res["patients"][sel_pids]})
+# solo la pagina visibile al browser; elenchi completi nel download
+tab_pat, tab_disp = st.tabs(["Pazienti", "Dispensazioni"])
+with tab_pat:
+    ui.result_table(sel_pat, "drill_pazienti")
+with tab_disp:
+    ui.result_table(sel_disp, "drill_dispensazioni")
+
+ui.download_buttons({
+    "pazienti": sel_pat,
+    "dispensazioni": sel_disp,
+}, f"drilldown_{sel_name}", "💾 Scarica pazienti selezionati")
+
+# ---------- note ----------
+with st.expander("ℹ️ Note metodologiche"):
+    st.markdown(
+        f"""
+- **Coorte**: pazienti naïve, cioè con prima dispensazione ≥ **{cutoff_naive}**.
+- **Esiti** (modalità linee; regole in ordine, vale la prima vera; `fine copertura = ultima dispensazione + {params['gap_days']} gg`):
+
+| Esito | Regola |
+|---|---|
+| In trattamento | fine copertura ≥ cut-off follow-up ({cutoff_fu}) |
+| Switch a farmaco non in studio | dispensazione di una categoria non in studio dopo l'ultima in studio |
+| Interrotto | solo con giorni > 0: fine copertura prima del cut-off e della fine dei dati (gap osservato dopo la copertura attesa) |
+| Perso al follow-up | altrimenti: i dati finiscono prima che la copertura scada (uscita dall'osservazione) o, con 0 giorni, nessuna dispensazione al cut-off |
+
+- **Checkpoint**: terapia attiva se l'ultima dispensazione è entro **{params['grace_days']}** giorni; *Non osservabile* oltre il cut-off.
+"""
+    )
+
+# ---------- performance ----------
+prof.log()
+with st.expander("⏱️ Performance", expanded=False):
+    st.caption(f"Totale fasi misurate: {prof.total():.2f} s")
+    st.dataframe(prof.to_frame(), hide_index=True)
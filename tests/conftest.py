@@ -0,0 +1,5 @@
+# i test importano `core`, `equivalenza` e le app dalla radice del repository
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,137 @@
+"""Coda di ammissione di core.jobs: ordine FIFO, limiti e assenza di stalli con job e slot concorrenti."""
+import threading
+import time
+
+import pytest
+
+from core import jobs
+
+TIMEOUT = 20
+
+
+def _wait(cond, timeout=TIMEOUT):
+    end = time.time() + timeout
+    while not cond():
+        assert time.time() < end, "timeout: la coda non avanza"
+        time.sleep(0.005)
+
+
+class _Probe:
+    """Conta i blocchi in esecuzione contemporanea e registra l'ordine di partenza."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.now = self.peak = 0
+        self.started = []
+
+    def run(self, name, seconds=0.002):
+        with self.lock:
+            self.now += 1
+            self.peak = max(self.peak, self.now)
+            self.started.append(name)
+        time.sleep(seconds)
+        with self.lock:
+            self.now -= 1
+        return name
+
+
+def test_submit_e_slot_concorrenti_senza_stallo():
+    runner = jobs.JobRunner(max_running=2, mem_budget_mb=1e9, keep_done=1000)
+    probe = _Probe()
+    submitted = []
+
+    def submitter(t):
+        for i in range(25):
+            submitted.append(runner.submit(lambda name, progress: probe.run(name), f"job-{t}-{i}",
+                                           key=("job", t, i)))
+
+    def slotter(t):
+        for i in range(10):
+            with runner.slot(label=f"slot-{t}-{i}", every=0.01):
+                probe.run(f"slot-{t}-{i}")
+
+    threads = [threading.Thread(target=submitter, args=(t,)) for t in range(4)]
+    threads += [threading.Thread(target=slotter, args=(t,)) for t in range(3)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join(TIMEOUT)
+        assert not th.is_alive(), "timeout: slot mai ammesso"
+    _wait(lambda: all(j.done for j in submitted))
+
+    assert all(j.status == jobs.DONE for j in submitted)
+    assert sorted(j.result for j in submitted) == sorted(f"job-{t}-{i}" for t in range(4) for i in range(25))
+    assert len(probe.started) == 4 * 25 + 3 * 10
+    assert probe.peak <= 2
+    assert runner.load() == (0, 0, 0)
+
+
+def test_ordine_fifo_fra_job_e_slot():
+    runner = jobs.JobRunner(max_running=1)
+    probe = _Probe()
+    gate = threading.Event()
+    runner.submit(lambda progress: gate.wait(TIMEOUT), key="gate")
+    _wait(lambda: runner.load()[0] == 1)
+
+    a = runner.submit(lambda progress: probe.run("a"), key="a")
+
+    def slot_b():
+        with runner.slot(label="b", every=0.01):
+            probe.run("b")
+
+    slot_thread = threading.Thread(target=slot_b)
+    slot_thread.start()
+    _wait(lambda: runner.load()[2] == 2)
+    c = runner.submit(lambda progress: probe.run("c"), key="c")
+    assert runner.position(a) == 1 and runner.position(c) == 3
+
+    gate.set()
+    slot_thread.join(TIMEOUT)
+    _wait(lambda: a.done and c.done)
+    assert probe.started == ["a", "b", "c"]
+    assert probe.peak == 1
+
+
+def test_budget_memoria_e_annullamento_in_coda():
+    runner = jobs.JobRunner(max_running=3, mem_budget_mb=100)
+    gate = threading.Event()
+    big = runner.submit(lambda progress: gate.wait(TIMEOUT), key="grande", cost_mb=500)
+    _wait(lambda: big.status == jobs.RUNNING)
+    # oltre il budget: il job grande gira da solo, gli altri restano in coda
+    small = runner.submit(lambda progress: "ok", key="piccolo", cost_mb=10)
+    dropped = runner.submit(lambda progress: "no", key="annullato", cost_mb=10)
+    time.sleep(0.05)
+    assert small.status == jobs.QUEUED and runner.position(small) == 1
+    dropped.cancel()
+    assert dropped.status == jobs.CANCELLED and runner.position(dropped) == 0
+
+    gate.set()
+    _wait(lambda: small.done)
+    assert small.result == "ok" and dropped.result is None
+    assert runner.load() == (0, 0, 0)
+
+
+def test_attesa_interrotta_non_blocca_la_coda():
+    runner = jobs.JobRunner(max_running=1)
+    gate = threading.Event()
+    runner.submit(lambda progress: gate.wait(TIMEOUT), key="gate")
+    _wait(lambda: runner.load()[0] == 1)
+
+    class Rerun(Exception):
+        """Come RerunException di Streamlit lanciata dal messaggio d'attesa."""
+
+    def on_wait(pos):
+        raise Rerun()
+
+    with pytest.raises(Rerun):
+        with runner.slot(label="interrotto", on_wait=on_wait, every=0.01):
+            pytest.fail("lo slot interrotto non deve eseguire il blocco")
+    assert runner.load() == (1, 0, 0)
+
+    after = runner.submit(lambda progress: "ok", key="dopo")
+    gate.set()
+    _wait(lambda: after.done)
+    assert after.result == "ok"
+    with runner.slot(label="slot successivo", every=0.01) as job:
+        assert job.status == jobs.RUNNING
+    assert runner.load() == (0, 0, 0)
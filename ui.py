@@ -0,0 +1,127 @@
+"""
+Componenti Streamlit condivisi dalle pagine (i calcoli restano in `core`).
+"""
+import pandas as pd
+import streamlit as st
+
+from core import export, jobs, lazy, tables
+
+PAGE_SIZES = [25, 50, 100, 500]
+
+
+def result_table(df, key, page_size=50):
+    """
+    Tabella di risultato paginata lato server: ricerca, filtri per colonna e
+    ordinamento su tutto `df`, ma al browser arriva solo la pagina visibile.
+    L'export completo resta il download della pagina. `key` rende unici i widget.
+    """
+    c1, c2, c3 = st.columns([3, 2, 1])
+    with c1:
+        search = st.text_input("🔎 Cerca", key=f"{key}_cerca", placeholder="testo in qualunque colonna")
+    with c2:
+        sort_by = st.selectbox("Ordina per", ["(nessuno)"] + list(df.columns), key=f"{key}_ordina")
+    with c3:
+        ascending = st.radio("Verso", ["↑", "↓"], horizontal=True, key=f"{key}_verso") == "↑"
+
+    filters = {}
+    with st.expander("Filtri per colonna", expanded=False):
+        for col in st.multiselect("Colonne da filtrare", list(df.columns), key=f"{key}_filtri"):
+            s = df[col]
+            kind = tables.filter_kind(s)
+            wkey = f"{key}_filtro_{col}"
+            if kind == tables.RANGE and pd.api.types.is_datetime64_any_dtype(s):
+                lo, hi = s.min(), s.max()
+                if pd.isna(lo):
+                    continue
+                sel = st.date_input(str(col), value=(lo.date(), hi.date()), key=wkey)
+                if len(sel) == 2:
+                    filters[col] = (tables.RANGE, (pd.Timestamp(sel[0]), pd.Timestamp(sel[1]) + pd.Timedelta(days=1) - pd.Timedelta(1)))
+            elif kind == tables.RANGE:
+                lo, hi = s.min(), s.max()
+                if pd.isna(lo) or lo == hi:
+                    continue
+                cast = int if pd.api.types.is_integer_dtype(s) else float
+                lo, hi = cast(lo), cast(hi)
+                filters[col] = (tables.RANGE, st.slider(str(col), lo, hi, (lo, hi), key=wkey))
+            elif kind == tables.VALUES:
+                values = sorted(s.dropna().unique().tolist(), key=str)
+                sel = st.multiselect(str(col), values, key=wkey)
+                if sel:
+                    filters[col] = (tables.VALUES, sel)
+            else:
+                filters[col] = (tables.TEXT, st.text_input(f"{col} contiene", key=wkey))
+
+    view = tables.filter_frame(df, search, filters)
+    view = tables.sort_frame(view, None if sort_by == "(nessuno)" else sort_by, ascending)
+
+    p1, p2, p3 = st.columns([1, 1, 4])
+    with p1:
+        size = st.selectbox("Righe per pagina", PAGE_SIZES, index=PAGE_SIZES.index(page_size), key=f"{key}_righe")
+    n_pages = tables.n_pages(len(view), size)
+    pkey = f"{key}_pagina"
+    if st.session_state.get(pkey, 1) > n_pages:  # filtri più stretti: torna all'ultima pagina valida
+        st.session_state[pkey] = n_pages
+    with p2:
+        page = st.number_input(f"Pagina (di {n_pages:,})", min_value=1, max_value=n_pages, step=1, key=pkey)
+    start = (page - 1) * size
+    with p3:
+        st.caption(f"Righe {min(start + 1, len(view)):,}–{min(start + size, len(view)):,} di {len(view):,}"
+                   + (f" (filtrate da {len(df):,})" if len(view) != len(df) else ""))
+    st.dataframe(tables.page_slice(view, page, size), use_container_width=True)
+    return view
+
+
+def download_buttons(sheets, stem, label="💾 Scarica", extra=None, key=None):
+    """
+    Un download per formato (Excel, Parquet, CSV.gz): il file si genera solo
+    al clic e resta in cache per hash del contenuto (`core.export`), quindi
+    i rerun non pagano l'export. `extra`: fogli di servizio esclusi dall'hash.
+    """
+    tutti = {**sheets, **(extra or {})}
+    for col, fmt in zip(st.columns(len(export.FORMATS)), export.FORMATS):
+        with col:
+            st.download_button(
+                f"{label} ({export.FORMATS[fmt][1]})",
+                data=export.deferred(sheets, fmt, extra),
+                file_name=export.file_name(stem, fmt, tutti),
+                mime=export.mime(fmt, tutti),
+                on_click="ignore",
+                key=None if key is None else f"{key}_{fmt}",
+            )
+
+
+def engine_select(key=None):
+    """
+    Scelta del motore per selezione naïve, merge, duplicati e riepiloghi
+    (`core.lazy`): stessi risultati, Polars solo se installato.
+    """
+    motore = st.radio("Motore tabellare", lazy.engines(), horizontal=True, key=key,
+                      help="Polars esegue join e raggruppamenti in parallelo; i risultati sono identici a pandas.")
+    if not lazy.available():
+        st.caption("Polars non installato (`pip install polars`): disponibile solo pandas.")
+    return motore
+
+
+@st.fragment(run_every=1.0)
+def job_panel(key):
+    """
+    Avanzamento (o posizione in coda) del job `key` di `core.jobs.shared()`,
+    aggiornato ogni secondo con il pulsante di annullamento; a fine calcolo
+    riesegue la pagina.
+    """
+    runner = jobs.shared()
+    job = runner.get(key)
+    if job is None or job.done:
+        st.rerun()
+    pos = runner.position(job)
+    if pos:
+        n_run, mb, _ = runner.load()
+        testo = f"{job.label}: in coda, posizione {pos} ({n_run} job in esecuzione sul server, ~{mb:,.0f} MB stimati)"
+    else:
+        testo = f"{job.label}: {job.message or job.status} ({job.elapsed():.0f} s)"
+    st.progress(job.progress, text=testo)
+    if job.cancelling:
+        st.caption("Annullamento in corso…")
+    elif st.button("⏹️ Annulla calcolo"):
+        job.cancel()
+        st.rerun(scope="fragment")